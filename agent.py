@@ -6,6 +6,7 @@ from pathlib import Path
 from termcolor import colored
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
+from llm_client import ResilientLLMClient
 import email.message
 from email import encoders
 from email.mime.text import MIMEText
@@ -15,13 +16,13 @@ from email.mime.multipart import MIMEMultipart
 load_dotenv()
 
 # Initialize OpenAI client
-client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+client = ResilientLLMClient(AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0))
 
 async def llm_call(system_prompt: str, user_prompt: str, model: str = "gpt-4o-mini") -> str:
     """Generic async function for LLM calls"""
     try:
         print(colored(f"Making LLM call with prompt: {user_prompt[:50]}...", "cyan"))
-        response = await client.chat.completions.create(
+        response = await client.create(
             model=model,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -0,0 +1,245 @@
+import os
+import re
+import time
+import json
+import hashlib
+import sqlite3
+import asyncio
+import threading
+from pathlib import Path
+from typing import List, Optional
+from termcolor import colored
+from prompts import PROMPT_VERSION
+
+from dotenv import load_dotenv
+load_dotenv()
+
+CACHE_DB_PATH = Path(os.getenv("ANALYSIS_CACHE_PATH", "cache/analysis_cache.db"))
+CACHE_TTL_SECONDS = int(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", 7 * 24 * 3600))  # One week
+CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 50000))
+CACHE_MAX_TERM_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_TERM_ENTRIES", 500000))  # Per (email, term) results
+
+class AnalysisCache:
+    """Persistent SQLite cache of LLM analysis results, per email/search terms and per (email, term)"""
+
+    def __init__(self, db_path: Path = CACHE_DB_PATH, ttl_seconds: int = CACHE_TTL_SECONDS,
+                 max_entries: int = CACHE_MAX_ENTRIES, max_term_entries: int = CACHE_MAX_TERM_ENTRIES):
+        self.db_path = Path(db_path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_term_entries = max_term_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.term_hits = 0
+        self.term_misses = 0
+        self._lock = threading.Lock()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_cache (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_accessed REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_accessed ON analysis_cache (last_accessed)")
+        # One row per email content and search term, so a changed term list only re-analyzes the new terms
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS term_analysis (
+                content_key TEXT NOT NULL,
+                term TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_accessed REAL NOT NULL,
+                PRIMARY KEY (content_key, term)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_term_analysis_last_accessed ON term_analysis (last_accessed)")
+        self._conn.commit()
+
+    @staticmethod
+    def normalize_content(email_content: str) -> str:
+        """Normalize line endings and whitespace so cosmetic differences share a cache entry"""
+        lines = email_content.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        lines = [re.sub(r'[ \t]+', ' ', line).strip() for line in lines]
+        return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+    @staticmethod
+    def normalize_term(term: str) -> str:
+        return term.strip().lower()
+
+    def make_key(self, email_content: str, search_terms: List[str], model: str) -> str:
+        """Build the content-addressed key for an email/search terms/model/prompt combination"""
+        terms = sorted({self.normalize_term(term) for term in search_terms if term.strip()})
+        payload = json.dumps({
+            "content": self.normalize_content(email_content),
+            "terms": terms,
+            "model": model,
+            "prompt_version": PROMPT_VERSION
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def make_content_key(self, email_content: str, model: str) -> str:
+        """Build the key shared by every per-term result of one email/model/prompt combination"""
+        payload = json.dumps({
+            "content": self.normalize_content(email_content),
+            "model": model,
+            "prompt_version": PROMPT_VERSION
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result, created_at FROM analysis_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            result, created_at = row
+            if now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self.evictions += 1
+                self.misses += 1
+                return None
+
+            self._conn.execute("UPDATE analysis_cache SET last_accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return result
+
+    def _set(self, key: str, result: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analysis_cache (key, result, created_at, last_accessed) VALUES (?, ?, ?, ?)",
+                (key, result, now, now)
+            )
+            self._conn.commit()
+        self._evict()
+
+    def _set_many(self, items: List[tuple]):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO analysis_cache (key, result, created_at, last_accessed) VALUES (?, ?, ?, ?)",
+                [(key, result, now, now) for key, result in items]
+            )
+            self._conn.commit()
+        self._evict()
+
+    def _get_terms(self, content_key: str, terms: List[str]) -> dict:
+        now = time.time()
+        found = {}
+        with self._lock:
+            for term in terms:
+                row = self._conn.execute(
+                    "SELECT result, created_at FROM term_analysis WHERE content_key = ? AND term = ?",
+                    (content_key, term)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    found[term] = json.loads(row[0])
+            if found:
+                self._conn.executemany(
+                    "UPDATE term_analysis SET last_accessed = ? WHERE content_key = ? AND term = ?",
+                    [(now, content_key, term) for term in found]
+                )
+                self._conn.commit()
+            self.term_hits += len(found)
+            self.term_misses += len(terms) - len(found)
+        return found
+
+    def _set_terms(self, items: List[tuple]):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO term_analysis (content_key, term, result, created_at, last_accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(content_key, term, json.dumps(result), now, now) for content_key, term, result in items]
+            )
+            self._conn.commit()
+        self._evict()
+
+    def _evict(self):
+        """Drop expired entries, then the least recently used ones above the size limits"""
+        evicted = 0
+        with self._lock:
+            for table, key_columns, max_entries in (("analysis_cache", "key", self.max_entries),
+                                                    ("term_analysis", "content_key, term", self.max_term_entries)):
+                cursor = self._conn.execute(
+                    f"DELETE FROM {table} WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+                )
+                evicted += cursor.rowcount
+
+                count = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                if count > max_entries:
+                    cursor = self._conn.execute(f"""
+                        DELETE FROM {table} WHERE ({key_columns}) IN (
+                            SELECT {key_columns} FROM {table} ORDER BY last_accessed ASC LIMIT ?
+                        )
+                    """, (count - max_entries,))
+                    evicted += cursor.rowcount
+
+            self._conn.commit()
+            self.evictions += evicted
+
+        if evicted:
+            print(colored(f"Analysis cache evicted {evicted} entries", "yellow"))
+
+    def _clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM analysis_cache")
+            self._conn.execute("DELETE FROM term_analysis")
+            self._conn.commit()
+
+    async def get(self, key: str) -> Optional[str]:
+        """Return the cached analysis for a key, or None on a miss"""
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, result: str):
+        """Store an analysis result and apply TTL/size eviction"""
+        await asyncio.to_thread(self._set, key, result)
+
+    async def set_many(self, items: List[tuple]):
+        """Store (key, result) pairs in one transaction, evicting once afterwards"""
+        await asyncio.to_thread(self._set_many, items)
+
+    async def get_terms(self, content_key: str, terms: List[str]) -> dict:
+        """Return {normalized term: per-term result} for the terms cached for this email"""
+        return await asyncio.to_thread(self._get_terms, content_key, terms)
+
+    async def set_terms(self, items: List[tuple]):
+        """Store (content key, normalized term, per-term result) entries in one transaction"""
+        await asyncio.to_thread(self._set_terms, items)
+
+    async def clear(self):
+        """Remove every cached analysis"""
+        await asyncio.to_thread(self._clear)
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the current cache size"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0]
+            term_entries = self._conn.execute("SELECT COUNT(*) FROM term_analysis").fetchone()[0]
+        lookups = self.hits + self.misses
+        term_lookups = self.term_hits + self.term_misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "term_entries": term_entries,
+            "term_hits": self.term_hits,
+            "term_misses": self.term_misses,
+            "term_hit_rate": round(self.term_hits / term_lookups, 4) if term_lookups else 0.0,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds
+        }
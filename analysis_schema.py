@@ -0,0 +1,99 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union
+import orjson
+from pydantic import TypeAdapter, ValidationError
+
+# Typed per-email analysis. The LLM answers with structured outputs generated from these types, the JSON is
+# validated once when it arrives, and the objects are serialized straight to API responses with orjson.
+
+@dataclass(slots=True)
+class Match:
+    text: str  # Verbatim snippet from the email
+    relevance: str  # One sentence on why the snippet matches the term
+
+@dataclass(slots=True)
+class EmailAnalysis:
+    semantic_matches: Dict[str, List[Match]]  # Search term -> matches; every requested term is present
+    overall_relevance_score: int = 0  # 0-100
+    key_insights: List[str] = field(default_factory=list)
+    skipped_by_prefilter: bool = False
+
+_analysis_adapter = TypeAdapter(EmailAnalysis)
+_match_adapter = TypeAdapter(Match)
+
+def parse_analysis(value: Union[str, bytes, dict]) -> EmailAnalysis:
+    """Validate LLM or cached JSON into an EmailAnalysis; raises ValueError if it does not fit the schema"""
+    try:
+        if isinstance(value, dict):
+            return _analysis_adapter.validate_python(value)
+        return _analysis_adapter.validate_json(value)
+    except ValidationError as e:
+        raise ValueError(f"Analysis does not match the schema: {e.error_count()} errors") from e
+
+def coerce_analysis(value) -> Optional[EmailAnalysis]:
+    """Return value as an EmailAnalysis whether it is one already, a dict or JSON; None if it is unusable"""
+    if value is None or isinstance(value, EmailAnalysis):
+        return value
+    try:
+        return parse_analysis(value)
+    except ValueError:
+        return None
+
+def dump_analysis(analysis: EmailAnalysis) -> str:
+    """Serialize an analysis for the caches"""
+    return orjson.dumps(analysis).decode()
+
+def parse_matches(matches: list) -> List[Match]:
+    return [_match_adapter.validate_python(match) for match in matches]
+
+def _strict(schema: dict) -> dict:
+    """Adapt a pydantic JSON schema to strict structured outputs: every property required, no extra keys"""
+    schema = {key: value for key, value in schema.items() if key not in ("title", "default", "description")}
+    if "properties" in schema:
+        schema["properties"] = {name: _strict(value) for name, value in schema["properties"].items()}
+        schema["required"] = list(schema["properties"])
+        schema["additionalProperties"] = False
+    if "items" in schema:
+        schema["items"] = _strict(schema["items"])
+    return schema
+
+def analysis_json_schema(search_terms: List[str]) -> dict:
+    """JSON schema of one EmailAnalysis, with the search terms as the fixed keys of semantic_matches"""
+    search_terms = list(dict.fromkeys(search_terms))
+    match_schema = _strict(_match_adapter.json_schema())
+    return {
+        "type": "object",
+        "properties": {
+            "semantic_matches": {
+                "type": "object",
+                "properties": {term: {"type": "array", "items": match_schema} for term in search_terms},
+                "required": list(search_terms),
+                "additionalProperties": False
+            },
+            "overall_relevance_score": {"type": "integer"},
+            "key_insights": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["semantic_matches", "overall_relevance_score", "key_insights"],
+        "additionalProperties": False
+    }
+
+def analysis_response_format(search_terms: List[str]) -> dict:
+    """response_format asking for one EmailAnalysis"""
+    return {"type": "json_schema", "json_schema": {
+        "name": "email_analysis", "strict": True, "schema": analysis_json_schema(search_terms)
+    }}
+
+def packed_response_format(email_ids: List[str], search_terms: List[str]) -> dict:
+    """response_format asking for {"results": {email id: EmailAnalysis}}"""
+    analysis_schema = analysis_json_schema(search_terms)
+    return {"type": "json_schema", "json_schema": {"name": "packed_email_analysis", "strict": True, "schema": {
+        "type": "object",
+        "properties": {"results": {
+            "type": "object",
+            "properties": {email_id: analysis_schema for email_id in email_ids},
+            "required": list(email_ids),
+            "additionalProperties": False
+        }},
+        "required": ["results"],
+        "additionalProperties": False
+    }}}
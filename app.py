@@ -1,33 +1,41 @@
 import os
+import orjson
+import time
+import uuid
 import asyncio
 from pathlib import Path
+from datetime import datetime, timedelta, timezone
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
 import uvicorn
 import webbrowser
-from typing import List
+from typing import List, Optional, Tuple
 import aiofiles
 from termcolor import colored
 from pydantic import BaseModel
 from llm_service import LLMService
+from analysis_schema import EmailAnalysis
+from scheduler import ConcurrencyScheduler
+from token_utils import estimate_tokens, pack_by_tokens
+from prefilter import Prefilter
+from email_threads import THREAD_FIELDS, plan_threads, thread_document, split_thread_analysis
+from jobs import JobManager, RESULT_ORDERS
+from pdf_renderer import PdfRenderer
+from attachments import AttachmentExtractor, ATTACHMENT_ANALYSIS, attachment_chunks, merge_attachment_analyses
+from csv_handler import ReportWriter
+from metrics import registry, span, record_cache_stats, monitor_event_loop_lag, MetricsMiddleware, LLM_CLIENT
 import shutil
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from bs4 import BeautifulSoup
-import html2text
 import email
 import mimetypes
-import extract_msg
-from email import policy
-from email.parser import BytesParser
 import jinja2
+from concurrent.futures import ProcessPoolExecutor
+from email_parser import SUPPORTED_FORMATS, parse_msg_file, parse_eml_file
+from email_store import EmailStore, EMAIL_FIELDS
+from upload_handler import UploadResult, ARCHIVE_FORMATS, stream_upload_to_disk, expand_archive, expand_mbox
+from mailbox_ingest import MailboxIngestor
 from io import BytesIO
 
 from dotenv import load_dotenv  
@@ -36,9 +44,32 @@ load_dotenv()
 # Define request models
 class SearchRequest(BaseModel):
     search_terms: List[str]
+    packed: Optional[bool] = None  # Pack several small emails per LLM request; defaults to PACKED_ANALYSIS
+    threads: Optional[bool] = None  # Analyze each thread once and collapse near duplicates; defaults to THREAD_ANALYSIS
+    attachments: Optional[bool] = None  # Also analyze attachment text; defaults to ATTACHMENT_ANALYSIS
+    include_summary: bool = False  # Also summarize the whole collection from the per-email analyses
+    prefilter: Optional[bool] = None  # Skip emails the local keyword/embedding prefilter rates irrelevant
+    report: Optional[str] = None  # Also write a "csv", "parquet" or "arrow" report while results arrive
 
-BATCH_SIZE = 10  # Maximum number of concurrent API calls
-SUPPORTED_FORMATS = {'.msg', '.eml'}  # Add supported email formats here
+class IngestRequest(BaseModel):
+    path: str  # .mbox file or Maildir directory, relative to INGEST_ROOT
+
+class BulkPdfRequest(BaseModel):
+    filenames: List[str] = []  # Empty exports every uploaded email
+    format: str = "zip"  # "zip" for one PDF per email, "merged" for a single PDF
+
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", 10))  # API calls kept in flight
+REQUESTS_PER_MINUTE = int(os.getenv("REQUESTS_PER_MINUTE", 0)) or None  # None disables the budget
+TOKENS_PER_MINUTE = int(os.getenv("TOKENS_PER_MINUTE", 0)) or None  # None disables the budget
+EXPECTED_COMPLETION_TOKENS = 500  # Completion tokens reserved per analysis call in the token budget
+PACKED_ANALYSIS = os.getenv("PACKED_ANALYSIS", "false").lower() == "true"  # Default for SearchRequest.packed
+PACK_TOKEN_BUDGET = int(os.getenv("PACK_TOKEN_BUDGET", 6000))  # Max email tokens packed into one request
+PACK_MAX_EMAILS = int(os.getenv("PACK_MAX_EMAILS", 10))  # Max emails packed into one request
+THREAD_ANALYSIS = os.getenv("THREAD_ANALYSIS", "false").lower() == "true"  # Default for SearchRequest.threads
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "false").lower() == "true"  # Default for SearchRequest.prefilter
+JOB_REPORT_PAGE_SIZE = 1000  # Job results read per query when exporting a report
+MAX_PAGE_SIZE = 1000  # Largest page the listing endpoints return
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", min(8, os.cpu_count() or 1)))  # Email parser processes
 
 # Define HTML styles - Updated for xhtml2pdf compatibility
 HTML_STYLES = '''
@@ -159,7 +190,14 @@ def convert_html_to_pdf(html_content: str, output_path: str) -> bool:
         print(colored(f"Error in PDF conversion: {str(e)}", "red"))
         return False
 
-app = FastAPI()
+class OrjsonResponse(JSONResponse):
+    """JSON response rendered with orjson, which serializes the analysis dataclasses natively"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+app = FastAPI(default_response_class=OrjsonResponse)
+app.add_middleware(MetricsMiddleware)
 
 # Create directories if they don't exist
 Path("static").mkdir(exist_ok=True)
@@ -177,6 +215,16 @@ templates = Jinja2Templates(directory="templates")
 
 # Initialize services
 llm_service = LLMService()
+parse_executor = None  # Created on first use by get_parse_executor()
+email_store = EmailStore()
+prefilter = Prefilter()
+job_manager = None  # Created on startup by start_job_manager()
+email_index_synced = False  # Set once every uploaded file has been parsed into the email store
+loop_lag_task = None  # Started on startup by start_loop_lag_monitor()
+pdf_renderer = PdfRenderer(get_executor=lambda: get_parse_executor())
+attachment_extractor = AttachmentExtractor(get_executor=lambda: get_parse_executor())
+mailbox_ingestor = MailboxIngestor(Path("uploaded_emails"), email_store.find_by_hash,
+                                   index_email=lambda path: get_email_data(path))
 
 # Initialize Jinja2 environment for email templates
 template_env = jinja2.Environment(
@@ -184,47 +232,34 @@ template_env = jinja2.Environment(
     autoescape=True
 )
 
-async def read_msg_content(file_path: Path) -> dict:
-    """Read and parse .msg email content"""
-    msg = None
-    try:
-        msg = extract_msg.Message(str(file_path))
-        
-        sender = str(msg.sender or "")
-        to = str(msg.to or "")
-        subject = str(msg.subject or "")
-        date = str(msg.date or "")
-        body = msg.body or ""
-        html_body = msg.htmlBody or ""
-        
-        # Convert body to string and handle encoding
-        if isinstance(body, bytes):
-            body = body.decode('utf-8', errors='replace')
-        else:
-            body = str(body)
-            
-        # Handle HTML body encoding
-        if isinstance(html_body, bytes):
-            html_body = html_body.decode('utf-8', errors='replace')
+@app.on_event("startup")
+async def start_job_manager():
+    global job_manager
+    job_manager = JobManager(analyze=run_job_analysis, load_emails=load_job_emails)
+    await job_manager.start()
+
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    global loop_lag_task
+    loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+
+@app.on_event("shutdown")
+async def stop_loop_lag_monitor():
+    if loop_lag_task is not None:
+        loop_lag_task.cancel()
+
+@app.on_event("shutdown")
+async def stop_job_manager():
+    if job_manager is not None:
+        print(colored("Stopping analysis job workers...", "yellow"))
+        await job_manager.stop()
+
+@app.on_event("shutdown")
+async def shutdown_parse_executor():
+    if parse_executor is not None:
+        print(colored("Shutting down email parser pool...", "yellow"))
+        parse_executor.shutdown(wait=False, cancel_futures=True)
 
-        return {
-            "from": sender,
-            "to": to,
-            "subject": subject,
-            "date": date,
-            "body": body,
-            "html_body": html_body
-        }
-    except Exception as e:
-        print(colored(f"Error reading .msg file {file_path}: {str(e)}", "red"))
-        raise
-    finally:
-        if msg is not None:
-            try:
-                msg.close()
-            except Exception as e:
-                print(colored(f"Warning: Error closing msg file: {str(e)}", "yellow"))
-    
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
@@ -232,73 +267,343 @@ async def read_root(request: Request):
 @app.post("/upload")
 async def upload_files(files: List[UploadFile] = File(...)):
     try:
-        uploaded_files = []
+        emails_dir = Path("uploaded_emails")
+        result = UploadResult(emails_dir, email_store.find_by_hash)
         for file in files:
             # Check if file extension is supported
             file_extension = Path(file.filename).suffix.lower()
-            if file_extension not in SUPPORTED_FORMATS:
+            if file_extension not in SUPPORTED_FORMATS and file_extension not in ARCHIVE_FORMATS:
                 print(colored(f"Skipping {file.filename} - unsupported format", "yellow"))
+                result.skipped.append(file.filename)
+                continue
+
+            if file_extension == '.mbox':
+                # Split straight from the received upload, one message at a time, without another copy
+                with span("upload", kind="mbox"):
+                    await asyncio.to_thread(expand_mbox, file.file, file.filename, result)
                 continue
-                
-            file_path = Path("uploaded_emails") / file.filename
-            async with aiofiles.open(file_path, 'wb') as f:
-                content = await file.read()
-                await f.write(content)
-            uploaded_files.append(file.filename)
-            print(colored(f"Successfully uploaded: {file.filename}", "green"))
+
+            # Stream to disk in chunks while hashing, so memory use does not grow with file size
+            with span("upload", kind="archive" if file_extension in ARCHIVE_FORMATS else "email"):
+                temp_path, sha256, size = await stream_upload_to_disk(file, emails_dir)
+                print(colored(f"Received {file.filename} ({size} bytes)", "cyan"))
+                if file_extension in ARCHIVE_FORMATS:
+                    try:
+                        await asyncio.to_thread(expand_archive, temp_path, file.filename, result)
+                    finally:
+                        temp_path.unlink(missing_ok=True)
+                else:
+                    result.commit(temp_path, sha256, file.filename)
+
+        # Parse the new files into the email store so analysis and viewing never re-parse them
+        parsed = await asyncio.gather(
+            *[get_email_data(emails_dir / filename) for filename in result.uploaded_files],
+            return_exceptions=True
+        )
+        for filename, parse_result in zip(result.uploaded_files, parsed):
+            if isinstance(parse_result, Exception):
+                print(colored(f"Warning: could not index {filename}: {str(parse_result)}", "yellow"))
             
-        return {"status": "success", "uploaded_files": uploaded_files}
+        return {"status": "success", **result.to_dict()}
     except Exception as e:
         print(colored(f"Error uploading files: {str(e)}", "red"))
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/ingest")
+async def start_mailbox_ingestion(ingest_request: IngestRequest):
+    """Start streaming a server-side mbox file or Maildir into the uploaded emails; poll /ingest/{id} for progress"""
+    try:
+        return mailbox_ingestor.start(ingest_request.path)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(colored(f"Error starting mailbox ingestion: {str(e)}", "red"))
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/ingest")
+async def list_mailbox_ingestions():
+    return {"ingestions": mailbox_ingestor.list_ingestions()}
+
+@app.get("/ingest/{ingestion_id}")
+async def get_mailbox_ingestion(ingestion_id: str):
+    status = mailbox_ingestor.get_status(ingestion_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Ingestion not found")
+    return status
+
+@app.post("/ingest/{ingestion_id}/cancel")
+async def cancel_mailbox_ingestion(ingestion_id: str):
+    status = mailbox_ingestor.get_status(ingestion_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Ingestion not found")
+    if not mailbox_ingestor.cancel(ingestion_id):
+        raise HTTPException(status_code=409, detail=f"Ingestion is already {status['status']}")
+    return mailbox_ingestor.get_status(ingestion_id)
+
 @app.post("/analyze")
 async def analyze_emails(search_request: SearchRequest):
     try:
-        # Read all supported email formats from the uploaded_emails directory
-        emails_dir = Path("uploaded_emails")
-        email_files = []
-        for format in SUPPORTED_FORMATS:
-            email_files.extend(list(emails_dir.glob(f"*{format}")))
-        
-        emails = []
-        for file in email_files:
-            try:
-                email_data = await read_email_content(file)
-                # Format content for analysis
-                formatted_content = f"""From: {email_data['from']}
-To: {email_data['to']}
-Subject: {email_data['subject']}
-Date: {email_data['date']}
-
-{email_data['body']}"""
-                
-                emails.append({
-                    "filename": file.name,
-                    "subject": email_data['subject'],
-                    "content": formatted_content
-                })
-            except Exception as e:
-                print(colored(f"Error processing {file.name}: {str(e)}", "red"))
-                continue
-
+        emails = await load_emails_for_analysis()
         print(colored(f"Found {len(emails)} emails to analyze", "blue"))
         
-        # Process email analysis in batches
-        print(colored("Starting email analysis in batches...", "blue"))
-        analysis_results = await process_emails_in_batches(emails, search_request.search_terms)
+        plan = await prefilter_emails(emails, search_request.search_terms, search_request.prefilter)
+        report_writer = await open_report_writer(search_request)
+
+        # Process email analysis with bounded concurrency
+        print(colored("Starting email analysis...", "blue"))
+        try:
+            analysis_results = await process_emails_in_batches(emails, search_request.search_terms,
+                                                               search_request.packed, plan, report_writer,
+                                                               search_request.threads, search_request.attachments)
+        finally:
+            if report_writer is not None:
+                await report_writer.close()
         
         print(colored("Analysis complete!", "green"))
-        
-        return {
+
+        response = {
             "status": "success",
             "analysis_results": analysis_results,
-            "num_emails": len(emails)
+            "num_emails": len(emails),
+            "failed": sum(1 for result in analysis_results if result.get("error")),
+            "prefilter": plan[2],
+            "normalization": normalization_report(emails)
         }
+        if report_writer is not None:
+            response["report"] = report_writer.url()
+        if search_request.include_summary:
+            response["summary"] = await summarize_analysis(emails, analysis_results, search_request.search_terms)
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         print(colored(f"Error in analysis: {str(e)}", "red"))
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/analyze/stream")
+async def analyze_emails_stream(search_request: SearchRequest):
+    """Stream analysis results as NDJSON events while each email completes"""
+    try:
+        emails = await load_emails_for_analysis()
+        print(colored(f"Found {len(emails)} emails to analyze (streaming)", "blue"))
+        analyze_indices, skipped_indices, prefilter_report = await prefilter_emails(
+            emails, search_request.search_terms, search_request.prefilter
+        )
+        report_writer = await open_report_writer(search_request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(colored(f"Error in streaming analysis: {str(e)}", "red"))
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def event_stream():
+        try:
+            async for event in analysis_events():
+                yield event
+        finally:
+            # Also runs when the client disconnects, so the report file is always finished
+            if report_writer is not None:
+                await report_writer.close()
+
+    async def analysis_events():
+        start_time = time.monotonic()
+        completed = 0
+        failed = 0
+        analyses = [None] * len(emails)
+        yield orjson.dumps({
+            "type": "start",
+            "total": len(emails),
+            "prefilter": prefilter_report,
+            "normalization": normalization_report(emails)
+        }) + b"\n"
+
+        # Emails the prefilter skipped are reported immediately, without an LLM call
+        for index in skipped_indices:
+            completed += 1
+            analyses[index] = skipped_result(emails[index], search_request.search_terms)
+            if report_writer is not None:
+                await report_writer.write(analyses[index])
+            yield orjson.dumps({
+                "type": "result",
+                "index": index,
+                "completed": completed,
+                "total": len(emails),
+                "result": analyses[index]
+            }) + b"\n"
+
+        try:
+            async for index, result in stream_email_analysis(emails, search_request.search_terms,
+                                                             packed=search_request.packed, indices=analyze_indices,
+                                                             threads=search_request.threads,
+                                                             attachments=search_request.attachments):
+                completed += 1
+                failed += 1 if result.get("error") else 0
+                analyses[index] = result
+                if report_writer is not None:
+                    await report_writer.write(result)
+                yield orjson.dumps({
+                    "type": "result",
+                    "index": index,
+                    "completed": completed,
+                    "total": len(emails),
+                    "result": result
+                }) + b"\n"
+        except Exception as e:
+            print(colored(f"Error in streaming analysis: {str(e)}", "red"))
+            yield orjson.dumps({"type": "error", "message": str(e), "completed": completed, "total": len(emails)}) + b"\n"
+            return
+
+        print(colored("Streaming analysis complete!", "green"))
+        summary_event = {
+            "type": "summary",
+            "status": "success",
+            "num_emails": len(emails),
+            "completed": completed,
+            "failed": failed,
+            "prefilter": prefilter_report,
+            "normalization": normalization_report(emails)
+        }
+        if report_writer is not None:
+            summary_event["report"] = report_writer.url()
+        if search_request.include_summary:
+            try:
+                summary_event["summary"] = await summarize_analysis(emails, analyses, search_request.search_terms)
+            except Exception as e:
+                print(colored(f"Error generating summary: {str(e)}", "red"))
+                summary_event["summary_error"] = str(e)
+        summary_event["elapsed_seconds"] = round(time.monotonic() - start_time, 2)
+        yield orjson.dumps(summary_event) + b"\n"
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+@app.post("/analyze/jobs")
+async def create_analysis_job(search_request: SearchRequest):
+    """Queue an analysis job and return its id immediately"""
+    # Jobs store per-email results only; their report is exported afterwards and there is no job summary
+    if search_request.report:
+        raise HTTPException(status_code=400, detail="report is not supported for jobs; "
+                                                    "download GET /analyze/jobs/{job_id}/report when the job is done")
+    if search_request.include_summary:
+        raise HTTPException(status_code=400, detail="include_summary is not supported for jobs; use /analyze")
+    try:
+        emails = await load_emails_for_analysis()
+        analyze_indices, skipped_indices, prefilter_report = await prefilter_emails(
+            emails, search_request.search_terms, search_request.prefilter
+        )
+        precomputed = {index: skipped_result(emails[index], search_request.search_terms) for index in skipped_indices}
+        options = {"packed": search_request.packed, "threads": search_request.threads,
+                   "attachments": search_request.attachments}
+        job_id = await job_manager.submit(emails, search_request.search_terms, options, precomputed)
+        status = await job_manager.get_status(job_id)
+        status["prefilter"] = prefilter_report
+        status["normalization"] = normalization_report(emails)
+        return status
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(colored(f"Error creating analysis job: {str(e)}", "red"))
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/analyze/jobs")
+async def list_analysis_jobs(limit: int = 50):
+    try:
+        return {"jobs": await job_manager.list_jobs(limit)}
+    except Exception as e:
+        print(colored(f"Error listing analysis jobs: {str(e)}", "red"))
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/analyze/jobs/{job_id}")
+async def get_analysis_job(job_id: str):
+    status = await job_manager.get_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
+
+@app.get("/analyze/jobs/{job_id}/results")
+async def get_analysis_job_results(job_id: str, offset: int = 0, limit: int = 100, order: str = "position",
+                                   term: Optional[str] = None, matched: Optional[bool] = None,
+                                   min_score: Optional[int] = None, max_score: Optional[int] = None,
+                                   sender: Optional[str] = None, date_from: Optional[str] = None,
+                                   date_to: Optional[str] = None):
+    """One page of a job's finished results, filtered by term, relevance score, sender and date"""
+    status = await job_manager.get_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if order not in RESULT_ORDERS:
+        raise HTTPException(status_code=400, detail=f"order must be one of {', '.join(RESULT_ORDERS)}")
+    filters = {
+        "term": term,
+        "matched": matched,
+        "min_score": min_score,
+        "max_score": max_score,
+        "sender": sender,
+        "sent_after": parse_date_filter(date_from, "date_from"),
+        "sent_before": parse_date_filter(date_to, "date_to", end_of_day=True)
+    }
+    limit = page_limit(limit)
+    results = await job_manager.get_results(job_id, offset, limit, order, **filters)
+    total_matching = await job_manager.count_results(job_id, **filters)
+    return {**status, "offset": offset, "total_matching": total_matching, "analysis_results": results}
+
+@app.get("/analyze/jobs/{job_id}/report")
+async def get_analysis_job_report(job_id: str, format: str = "csv"):
+    """Export a job's finished results as a CSV, Parquet or Arrow file, reading them page by page"""
+    status = await job_manager.get_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    try:
+        report_writer = ReportWriter(status["search_terms"], format, name=f"job_{job_id}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        async with report_writer:
+            offset = 0
+            while True:
+                page = await job_manager.get_results(job_id, offset, JOB_REPORT_PAGE_SIZE)
+                for result in page:
+                    await report_writer.write(result)
+                offset += len(page)
+                if len(page) < JOB_REPORT_PAGE_SIZE:
+                    break
+        return FileResponse(report_writer.path, filename=report_writer.path.name)
+    except Exception as e:
+        print(colored(f"Error exporting job report: {str(e)}", "red"))
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/analyze/jobs/{job_id}/summary")
+async def summarize_analysis_job(job_id: str):
+    """Summarize a job's finished results with the map-reduce summarizer"""
+    status = await job_manager.get_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    try:
+        results = []
+        while True:
+            page = await job_manager.get_results(job_id, len(results), JOB_REPORT_PAGE_SIZE)
+            results.extend(page)
+            if len(page) < JOB_REPORT_PAGE_SIZE:
+                break
+        emails = await load_job_emails([{"filename": result["filename"], "subject": result["subject"]}
+                                        for result in results])
+        readable = [(email, result) for email, result in zip(emails, results) if "content" in email]
+        summary = await summarize_analysis([email for email, _ in readable], [result for _, result in readable],
+                                           status["search_terms"])
+        return {"job_id": job_id, "summary": summary}
+    except Exception as e:
+        print(colored(f"Error summarizing analysis job: {str(e)}", "red"))
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/analyze/jobs/{job_id}/cancel")
+async def cancel_analysis_job(job_id: str):
+    status = await job_manager.get_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not await job_manager.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Job is already {status['status']}")
+    return await job_manager.get_status(job_id)
+
 @app.get("/convert-to-pdf/{filename}")
 async def convert_to_pdf(filename: str):
     try:
@@ -315,9 +620,46 @@ async def convert_to_pdf(filename: str):
             
         pdf_path = await email_to_pdf(str(email_path))
         return FileResponse(pdf_path, media_type="application/pdf", filename=f"{filename}.pdf")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/convert-to-pdf")
+async def convert_many_to_pdf(bulk_request: BulkPdfRequest):
+    """Render many emails in parallel into a ZIP of PDFs or one merged PDF"""
+    if bulk_request.format not in ("zip", "merged"):
+        raise HTTPException(status_code=400, detail="format must be 'zip' or 'merged'")
+
+    emails_dir = Path("uploaded_emails")
+    if bulk_request.filenames:
+        email_paths = [emails_dir / Path(filename).name for filename in bulk_request.filenames]
+        missing = [path.name for path in email_paths if not path.exists()]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Email files not found: {', '.join(missing)}")
+    else:
+        email_paths = sorted(path for path in emails_dir.glob("*.*") if path.suffix.lower() in SUPPORTED_FORMATS)
+    if not email_paths:
+        raise HTTPException(status_code=404, detail="No emails to convert")
+
+    try:
+        start_time = time.perf_counter()
+        emails = await asyncio.gather(*[get_email_data(path) for path in email_paths])
+        if bulk_request.format == "merged":
+            pdf_path = await pdf_renderer.render_merged(emails)
+            response = FileResponse(pdf_path, media_type="application/pdf", filename="emails.pdf")
+        else:
+            zip_path = pdf_renderer.cache_dir / f".export-{uuid.uuid4().hex}.zip"
+            await pdf_renderer.render_zip([path.name for path in email_paths], emails, zip_path)
+            response = FileResponse(zip_path, media_type="application/zip", filename="emails.zip",
+                                    background=BackgroundTask(zip_path.unlink, missing_ok=True))
+        print(colored(f"✓ Exported {len(email_paths)} emails as {bulk_request.format} PDF "
+                      f"in {time.perf_counter() - start_time:.2f}s", "green"))
+        return response
+    except Exception as e:
+        print(colored(f"Error exporting PDFs: {str(e)}", "red"))
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/view-email/{filename}")
 async def view_email(filename: str):
     try:
@@ -325,12 +667,81 @@ async def view_email(filename: str):
         if not email_path.exists():
             raise HTTPException(status_code=404, detail="Email file not found")
         
-        email_data = await read_email_content(email_path)
-        return email_data
+        email_data = await get_email_data(email_path)
+        return {field: email_data[field] for field in EMAIL_FIELDS}
     except Exception as e:
         print(colored(f"Error viewing email: {str(e)}", "red"))
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/emails")
+async def list_emails(offset: int = 0, limit: int = 100, sender: Optional[str] = None,
+                      date_from: Optional[str] = None, date_to: Optional[str] = None):
+    """One page of uploaded emails, newest first, filtered by sender and date"""
+    sent_after = parse_date_filter(date_from, "date_from")
+    sent_before = parse_date_filter(date_to, "date_to", end_of_day=True)
+    try:
+        await ensure_email_index()
+        total, emails = await email_store.list_emails(Path("uploaded_emails"), offset, page_limit(limit),
+                                                      sender, sent_after, sent_before)
+        return {"total": total, "offset": offset, "emails": emails}
+    except Exception as e:
+        print(colored(f"Error listing emails: {str(e)}", "red"))
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/search")
+async def search_emails(q: str, offset: int = 0, limit: int = 20, sender: Optional[str] = None,
+                        date_from: Optional[str] = None, date_to: Optional[str] = None):
+    """Full-text search over uploaded emails, best matches first, with highlighted snippets"""
+    sent_after = parse_date_filter(date_from, "date_from")
+    sent_before = parse_date_filter(date_to, "date_to", end_of_day=True)
+    try:
+        await ensure_email_index()
+        with span("search"):
+            total, results = await email_store.search(q, Path("uploaded_emails"), offset, page_limit(limit),
+                                                      sender, sent_after, sent_before)
+        return {"query": q, "total": total, "offset": offset, "results": results}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(colored(f"Error searching emails: {str(e)}", "red"))
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/cache/stats")
+async def cache_stats():
+    try:
+        return {
+            "analysis_cache": llm_service.cache.stats(),
+            "email_store": email_store.stats(),
+            "pdf_cache": pdf_renderer.stats(),
+            "attachment_cache": attachment_extractor.stats()
+        }
+    except Exception as e:
+        print(colored(f"Error reading cache stats: {str(e)}", "red"))
+        raise HTTPException(status_code=500, detail=str(e))
+
+def collect_component_metrics():
+    """Refresh cache and LLM client gauges from the services' own counters"""
+    analysis_stats = llm_service.cache.stats()
+    record_cache_stats("analysis", analysis_stats)
+    record_cache_stats("analysis_terms", {
+        "hits": analysis_stats["term_hits"],
+        "misses": analysis_stats["term_misses"],
+        "entries": analysis_stats["term_entries"]
+    })
+    record_cache_stats("email_store", email_store.stats())
+    record_cache_stats("pdf", pdf_renderer.stats())
+    record_cache_stats("attachments", attachment_extractor.stats())
+    for name, value in llm_service.client.stats().items():
+        if isinstance(value, (int, float)):
+            LLM_CLIENT.set(value, stat=name)
+
+registry.add_collector(collect_component_metrics)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of latency histograms, in-flight gauges, cache hit rates and LLM cost"""
+    return PlainTextResponse(await asyncio.to_thread(registry.render), media_type="text/plain; version=0.0.4")
+
 @app.delete("/delete-all-emails")
 async def delete_all_emails():
     try:
@@ -360,6 +771,8 @@ async def delete_all_emails():
                 print(colored(error_msg, "red"))
                 failed_files.append({"file": str(file), "error": str(e)})
         
+        await email_store.invalidate(deleted_files)
+
         response = {
             "status": "success",
             "deleted_files": deleted_files,
@@ -376,59 +789,50 @@ async def delete_all_emails():
         print(colored(f"Error in delete_all_emails: {str(e)}", "red"))
         raise HTTPException(status_code=500, detail=str(e))
 
+async def ensure_email_index():
+    """Index files copied into uploaded_emails without an upload, once per server start"""
+    if not email_index_synced:
+        await load_emails_for_analysis()
+
+def page_limit(limit: int) -> int:
+    return max(0, min(limit, MAX_PAGE_SIZE))
+
+def parse_date_filter(value: Optional[str], name: str, end_of_day: bool = False) -> Optional[float]:
+    """Unix timestamp of an ISO date or datetime query parameter; a plain date_to includes the whole day"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an ISO date such as 2024-05-31")
+    if end_of_day and len(value) == 10:
+        parsed += timedelta(days=1)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
 def open_browser():
     webbrowser.open("http://localhost:8000")
 
+def get_parse_executor() -> ProcessPoolExecutor:
+    """Return the shared process pool used for email parsing, creating it on first use"""
+    global parse_executor
+    if parse_executor is None:
+        print(colored(f"Starting email parser pool with {PARSE_WORKERS} workers", "blue"))
+        parse_executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    return parse_executor
+
 async def read_msg_content(file_path: Path) -> dict:
-    """Read and parse .msg email content"""
-    msg = None
-    try:
-        msg = extract_msg.Message(str(file_path))
-        
-        sender = str(msg.sender or "")
-        to = str(msg.to or "")
-        subject = str(msg.subject or "")
-        date = str(msg.date or "")
-        body = msg.body or ""
-        html_body = msg.htmlBody or ""
-        
-        # Convert body to string and handle encoding
-        if isinstance(body, bytes):
-            body = body.decode('utf-8', errors='replace')
-        else:
-            body = str(body)
-            
-        # Handle HTML body encoding
-        if isinstance(html_body, bytes):
-            html_body = html_body.decode('utf-8', errors='replace')
-
-        # Debugging: Print the email data
-        print("Email Data:", {
-            "from": sender,
-            "to": to,
-            "subject": subject,
-            "date": date,
-            "body": body,
-            "html_body": html_body
-        })
+    """Read and parse .msg email content in the parser pool"""
+    loop = asyncio.get_running_loop()
+    with span("parse", format="msg"):
+        return await loop.run_in_executor(get_parse_executor(), parse_msg_file, str(file_path))
 
-        return {
-            "from": sender,
-            "to": to,
-            "subject": subject,
-            "date": date,
-            "body": body,
-            "html_body": html_body
-        }
-    except Exception as e:
-        print(colored(f"Error reading .msg file {file_path}: {str(e)}", "red"))
-        raise
-    finally:
-        if msg is not None:
-            try:
-                msg.close()
-            except Exception as e:
-                print(colored(f"Warning: Error closing msg file: {str(e)}", "yellow"))
+async def read_eml_content(file_path: Path) -> dict:
+    """Read and parse .eml email content in the parser pool"""
+    loop = asyncio.get_running_loop()
+    with span("parse", format="eml"):
+        return await loop.run_in_executor(get_parse_executor(), parse_eml_file, str(file_path))
 
 async def read_email_content(file_path: Path) -> dict:
     """Read and parse email content based on file extension"""
@@ -441,247 +845,316 @@ async def read_email_content(file_path: Path) -> dict:
         return await read_msg_content(file_path)
     elif file_extension == '.eml':
         return await read_eml_content(file_path)
-    
-async def read_eml_content(file_path: Path) -> dict:
-    """Read and parse .eml email content"""
-    try:
-        async with aiofiles.open(file_path, 'rb') as f:
-            content = await f.read()
-        
-        email_message = BytesParser(policy=policy.default).parsebytes(content)
-        
-        sender = str(email_message.get('From', ''))
-        to = str(email_message.get('To', ''))
-        subject = str(email_message.get('Subject', ''))
-        date = str(email_message.get('Date', ''))
-        
-        body = ''
-        html_body = ''
-        
-        if email_message.is_multipart():
-            for part in email_message.walk():
-                content_type = part.get_content_type()
-                if content_type == "text/plain":
-                    body_part = part.get_payload(decode=True)
-                    try:
-                        body += body_part.decode('utf-8', errors='replace')
-                    except Exception:
-                        body += body_part.decode('latin-1', errors='replace')
-                elif content_type == "text/html":
-                    html_part = part.get_payload(decode=True)
-                    try:
-                        html_body += html_part.decode('utf-8', errors='replace')
-                    except Exception:
-                        html_body += html_part.decode('latin-1', errors='replace')
-        else:
-            content_type = email_message.get_content_type()
-            payload = email_message.get_payload(decode=True)
-            try:
-                decoded_content = payload.decode('utf-8', errors='replace')
-            except Exception:
-                decoded_content = payload.decode('latin-1', errors='replace')
-                
-            if content_type == "text/html":
-                html_body = decoded_content
-                # Extract plain text from HTML for body
-                from bs4 import BeautifulSoup
-                soup = BeautifulSoup(html_body, 'html.parser')
-                body = soup.get_text()
-            else:
-                body = decoded_content
 
-        return {
-            "from": sender,
-            "to": to,
-            "subject": subject,
-            "date": date,
-            "body": body,
-            "html_body": html_body
-        }
-    except Exception as e:
-        print(colored(f"Error reading .eml file {file_path}: {str(e)}", "red"))
-        raise
+async def get_email_data(file_path: Path) -> dict:
+    """Return parsed email data from the email store, parsing the file only if it changed"""
+    return await email_store.get(file_path, read_email_content)
 
-async def process_batch(emails_batch: List[dict], search_terms: List[str]) -> List[dict]:
-    """Process a batch of emails with concurrent API calls"""
-    try:
-        print(colored(f"Starting analysis for {len(emails_batch)} emails...", "cyan"))
-        tasks = [llm_service.analyze_email_content(email["content"], search_terms) for email in emails_batch]
-        
-        # Wait for all tasks in this batch to complete
-        results = await asyncio.gather(*tasks)
-        return results
-    except Exception as e:
-        print(colored(f"Error processing batch: {str(e)}", "red"))
-        raise
+async def load_emails_for_analysis() -> List[dict]:
+    """Read every supported email in uploaded_emails concurrently and format it for analysis"""
+    global email_index_synced
+    emails_dir = Path("uploaded_emails")
+    email_files = []
+    for format in SUPPORTED_FORMATS:
+        email_files.extend(list(emails_dir.glob(f"*{format}")))
 
-async def process_emails_in_batches(emails: List[dict], search_terms: List[str]) -> List[dict]:
-    """Process emails in batches of BATCH_SIZE"""
-    try:
-        results = []
-        total_batches = (len(emails) + BATCH_SIZE - 1) // BATCH_SIZE
-        
-        for i in range(0, len(emails), BATCH_SIZE):
-            batch_num = i // BATCH_SIZE + 1
-            batch = emails[i:i + BATCH_SIZE]
-            print(colored(f"\nProcessing batch {batch_num}/{total_batches} ({len(batch)} emails)...", "blue"))
-            
-            try:
-                batch_results = await process_batch(batch, search_terms)
-                for j, result in enumerate(batch_results):
-                    email_index = i + j
-                    results.append({
-                        "filename": emails[email_index]["filename"],
-                        "subject": emails[email_index]["subject"],
-                        "analysis": result
-                    })
-                print(colored(f"✓ Batch {batch_num}/{total_batches} completed successfully", "green"))
-                
-                if batch_num < total_batches:
-                    remaining = len(emails) - (i + BATCH_SIZE)
-                    print(colored(f"Waiting before starting next batch... ({remaining} emails remaining)", "yellow"))
-                    await asyncio.sleep(2)
-                
-            except Exception as e:
-                print(colored(f"Error in batch {batch_num}: {str(e)}", "red"))
-                raise
-                
-        print(colored(f"\nAll {total_batches} batches processed successfully!", "green"))
-        return results
-    except Exception as e:
-        print(colored(f"Error in batch processing: {str(e)}", "red"))
-        raise
+    await email_store.prune_missing()
+    print(colored(f"Loading {len(email_files)} email files...", "blue"))
+    parsed = await asyncio.gather(*[get_email_data(file) for file in email_files], return_exceptions=True)
 
-async def convert_email_to_pdf(email_data: dict, output_path: str) -> bool:
-    """Convert email to PDF using reportlab with better table and formatting support"""
-    try:
-        # Create the PDF document
-        doc = SimpleDocTemplate(
-            output_path,
-            pagesize=A4,
-            rightMargin=72,
-            leftMargin=72,
-            topMargin=72,
-            bottomMargin=72
-        )
+    emails = []
+    for file, email_data in zip(email_files, parsed):
+        if isinstance(email_data, Exception):
+            print(colored(f"Error processing {file.name}: {str(email_data)}", "red"))
+            continue
+        emails.append({
+            "filename": file.name,
+            "subject": email_data['subject'],
+            "from": email_data['from'],
+            "date": email_data['date'],
+            "content": email_data['analysis_content'],
+            "raw_tokens": email_data['raw_tokens'],
+            "tokens": email_data['tokens'],
+            **{field: email_data[field] for field in THREAD_FIELDS}
+        })
+    email_index_synced = True
+    return emails
 
-        # Prepare the story (content elements)
-        story = []
-        styles = getSampleStyleSheet()
-        
-        # Create custom styles
-        header_style = ParagraphStyle(
-            'HeaderStyle',
-            parent=styles['Heading1'],
-            fontSize=14,
-            spaceAfter=20
-        )
-        
-        label_style = ParagraphStyle(
-            'LabelStyle',
-            parent=styles['Normal'],
-            fontSize=10,
-            fontName='Helvetica-Bold'
-        )
-        
-        value_style = ParagraphStyle(
-            'ValueStyle',
-            parent=styles['Normal'],
-            fontSize=10
+def tokens_saved(email: dict) -> int:
+    """Tokens normalization removed from one email before it reaches the LLM"""
+    return (email.get("raw_tokens") or 0) - (email.get("tokens") or 0)
+
+def normalization_report(emails: List[dict]) -> dict:
+    """Total tokens of the emails before and after normalization"""
+    raw_tokens = sum(email.get("raw_tokens") or 0 for email in emails)
+    tokens = sum(email.get("tokens") or 0 for email in emails)
+    return {"raw_tokens": raw_tokens, "tokens": tokens, "tokens_saved": raw_tokens - tokens}
+
+def estimate_analysis_tokens(email: dict) -> int:
+    """Estimate the tokens one analysis call consumes against the per-minute budget"""
+    return estimate_tokens(email["content"], llm_service.MODEL) + EXPECTED_COMPLETION_TOKENS
+
+def create_scheduler() -> ConcurrencyScheduler:
+    """Create a scheduler using the configured concurrency and per-minute budgets"""
+    return ConcurrencyScheduler(
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE
+    )
+
+async def prefilter_emails(emails: List[dict], search_terms: List[str],
+                           enabled: Optional[bool] = None) -> Tuple[List[int], List[int], dict]:
+    """Return (indices to analyze, most relevant first; skipped indices; report) from the local prefilter"""
+    enabled = PREFILTER_ENABLED if enabled is None else enabled
+    if not enabled:
+        return list(range(len(emails))), [], {"enabled": False}
+
+    documents = {email["filename"]: email["content"] for email in emails}
+    keep, skipped, scores = await asyncio.to_thread(prefilter.plan, documents, search_terms)
+    index_of = {email["filename"]: i for i, email in enumerate(emails)}
+    report = {
+        "enabled": True,
+        "analyzed": len(keep),
+        "skipped": len(skipped),
+        "llm_calls_avoided": len(skipped)
+    }
+    print(colored(f"Prefilter kept {len(keep)} emails and skipped {len(skipped)} LLM calls", "blue"))
+    return [index_of[doc_id] for doc_id in keep], [index_of[doc_id] for doc_id in skipped], report
+
+def skipped_result(email: dict, search_terms: List[str]) -> dict:
+    """Build the empty analysis reported for an email the prefilter skipped"""
+    return {
+        "filename": email["filename"],
+        "subject": email["subject"],
+        "analysis": EmailAnalysis(semantic_matches={term: [] for term in search_terms}, skipped_by_prefilter=True),
+        "tokens_saved": tokens_saved(email)
+    }
+
+async def stream_email_analysis(emails: List[dict], search_terms: List[str], packed: Optional[bool] = None,
+                                indices: Optional[List[int]] = None, threads: Optional[bool] = None,
+                                attachments: Optional[bool] = None):
+    """Yield (index, {filename, subject, analysis}) as each email's analysis finishes
+
+    indices limits the analysis to those emails and sets the order in which they are scheduled.
+    With threads, each thread is analyzed once and near duplicates reuse their original's analysis.
+    With attachments, each attachment chunk is analyzed on its own and merged into its email's result.
+    An email whose LLM call still fails after retries is yielded with analysis None and an error.
+    """
+    scheduler = create_scheduler()
+    packed = PACKED_ANALYSIS if packed is None else packed
+    threads = THREAD_ANALYSIS if threads is None else threads
+    attachments = ATTACHMENT_ANALYSIS if attachments is None else attachments
+    indices = list(range(len(emails))) if indices is None else indices
+
+    # Attachment chunks are appended after the emails, so units index into one list of analysis inputs
+    items = emails
+    chunk_results = {index: [] for index in indices}  # Email -> (attachment name, analysis or error)
+    if attachments:
+        chunks, failures = await load_attachment_chunks(emails, indices)
+        items = emails + chunks
+        for index, failed in failures.items():
+            chunk_results[index].extend(failed)
+    remaining = {index: 1 for index in indices}  # Analyses an email still waits for before it is yielded
+    for item in items[len(emails):]:
+        remaining[item["parent"]] += 1
+
+    # Each unit is a list of item indices analyzed by one LLM request
+    plan = await asyncio.to_thread(plan_threads, emails, indices, llm_service.MODEL) if threads else None
+    thread_units = [unit for unit in plan.units if len(unit) > 1] if plan is not None else []
+    singles = [unit[0] for unit in plan.units if len(unit) == 1] if plan is not None else indices
+    singles = singles + list(range(len(emails), len(items)))
+    if packed:
+        units = pack_by_tokens(
+            singles,
+            lambda i: estimate_tokens(items[i]["content"], llm_service.MODEL),
+            PACK_TOKEN_BUDGET,
+            PACK_MAX_EMAILS
         )
+        print(colored(f"Packed {len(singles)} emails into {len(units)} requests", "blue"))
+    else:
+        units = [[i] for i in singles]
+    units = thread_units + units
+    # Thread members never appear in packed units, so a unit's indices identify it as a thread
+    thread_keys = {tuple(unit) for unit in thread_units}
+    duplicates = {}
+    if plan is not None:
+        for duplicate, original in plan.duplicate_of.items():
+            duplicates.setdefault(original, []).append(duplicate)
+    print(colored(f"Starting analysis for {len(indices)} emails with up to {scheduler.max_concurrency} concurrent calls...", "blue"))
 
-        # Define custom colors
-        header_bg_color = colors.Color(red=(0.95), green=(0.95), blue=(0.95))  # Light grey for header
-
-        # Add email header information
-        header_data = [
-            ['From:', email_data.get('from', 'N/A')],
-            ['To:', email_data.get('to', 'N/A')],
-            ['Subject:', email_data.get('subject', 'N/A')],
-            ['Date:', email_data.get('date', 'N/A')]
-        ]
-
-        # Create header table
-        header_table = Table(header_data, colWidths=[1*inch, 5*inch])
-        header_table.setStyle(TableStyle([
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-            ('BACKGROUND', (0, 0), (-1, -1), colors.whitesmoke),
-        ]))
-        story.append(header_table)
-        story.append(Spacer(1, 20))
-
-        # Process email body
-        body_content = email_data.get('html_body', '') or email_data.get('body', '')
-        
-        if body_content:
-            if email_data.get('html_body'):
-                # Parse HTML content
-                soup = BeautifulSoup(body_content, 'html.parser')
-                
-                # Handle tables in HTML
-                for table in soup.find_all('table'):
-                    # Convert HTML table to reportlab table
-                    table_data = []
-                    for row in table.find_all('tr'):
-                        table_row = []
-                        for cell in row.find_all(['td', 'th']):
-                            table_row.append(Paragraph(cell.get_text(), value_style))
-                        table_data.append(table_row)
-                    
-                    if table_data:
-                        pdf_table = Table(table_data)
-                        pdf_table.setStyle(TableStyle([
-                            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-                            ('FONTSIZE', (0, 0), (-1, -1), 10),
-                            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                            ('BACKGROUND', (0, 0), (-1, 0), header_bg_color),
-                        ]))
-                        story.append(pdf_table)
-                        story.append(Spacer(1, 12))
-                
-                # Convert remaining HTML to text
-                h = html2text.HTML2Text()
-                h.body_width = 0
-                text_content = h.handle(str(soup))
+    async def analyze(unit: List[int]) -> List:
+        try:
+            if tuple(unit) in thread_keys:
+                document, member_texts = thread_document(emails, unit)
+                analysis = await llm_service.analyze_email_content(document, search_terms)
+                return split_thread_analysis(analysis, member_texts, search_terms)
+            if len(unit) == 1:
+                return [await llm_service.analyze_email_content(items[unit[0]]["content"], search_terms)]
+            return await llm_service.analyze_email_pack([items[i]["content"] for i in unit], search_terms)
+        except Exception as e:
+            # Record the failure against these emails instead of aborting the whole analysis
+            return [e] * len(unit)
+
+    def estimate_unit_tokens(unit: List[int]) -> int:
+        return sum(estimate_analysis_tokens(items[i]) for i in unit)
+
+    def email_result(index: int, result) -> dict:
+        output = {"filename": emails[index]["filename"], "subject": emails[index]["subject"]}
+        if isinstance(result, Exception):
+            output.update({"analysis": None, "error": str(result)})
+        else:
+            output["analysis"] = result
+        if attachments:
+            analysis, output["attachments"] = merge_attachment_analyses(
+                output["analysis"], chunk_results[index], search_terms
+            )
+            if output["analysis"] is not None:
+                output["analysis"] = analysis
+        output["tokens_saved"] = tokens_saved(emails[index])
+        if plan is not None:
+            output["thread_id"] = emails[plan.thread_of.get(index, index)]["filename"]
+        return output
+
+    body_results = {}  # Email -> (its own analysis or error, the email it was analyzed as)
+    completed = 0
+    async for unit_index, unit_results in scheduler.as_completed(units, analyze, estimate_unit_tokens):
+        finished = []
+        for item, result in zip(units[unit_index], unit_results):
+            if item >= len(emails):
+                index = items[item]["parent"]
+                chunk_results[index].append((items[item]["attachment"], result))
+                finished.append(index)
+                continue
+            # Near duplicates of an email get its analysis without a request of their own
+            for index in [item] + duplicates.get(item, []):
+                body_results[index] = (result, item)
+                finished.append(index)
+
+        for index in finished:
+            remaining[index] -= 1
+            if remaining[index]:
+                continue
+            result, original = body_results[index]
+            completed += 1
+            if isinstance(result, Exception):
+                print(colored(f"✗ Failed {completed}/{len(indices)}: {emails[index]['filename']}: {str(result)}", "red"))
             else:
-                text_content = body_content
+                print(colored(f"✓ Analyzed {completed}/{len(indices)}: {emails[index]['filename']}", "green"))
+            output = email_result(index, result)
+            if index != original:
+                output["duplicate_of"] = emails[original]["filename"]
+            yield index, output
 
-            # Split content into paragraphs and add to story
-            for paragraph in text_content.split('\n\n'):
-                if paragraph.strip():
-                    story.append(Paragraph(paragraph.replace('\n', '<br/>'), value_style))
-                    story.append(Spacer(1, 12))
+async def load_attachment_chunks(emails: List[dict], indices: List[int]) -> Tuple[List[dict], dict]:
+    """Extract and chunk the attachments of emails[indices] in the parser pool
 
-        # Build the PDF
-        doc.build(story)
-        return True
+    Returns (chunks, each with the index of its "parent" email, {index: [(attachment, error)]}).
+    """
+    emails_dir = Path("uploaded_emails")
+    extracted = await asyncio.gather(
+        *[attachment_extractor.extract(emails_dir / emails[index]["filename"]) for index in indices],
+        return_exceptions=True
+    )
+    chunks = []
+    failures = {}
+    for index, email_attachments in zip(indices, extracted):
+        if isinstance(email_attachments, Exception):
+            print(colored(f"Error extracting attachments of {emails[index]['filename']}: {str(email_attachments)}", "red"))
+            failures[index] = [("attachments", email_attachments)]
+            continue
+        failures[index] = [(attachment["name"], ValueError(attachment["error"]))
+                           for attachment in email_attachments if attachment["error"]]
+        chunks.extend({**chunk, "parent": index}
+                      for chunk in attachment_chunks(emails[index], email_attachments, llm_service.MODEL))
+    print(colored(f"Extracted {len(chunks)} attachment chunks from {len({chunk['parent'] for chunk in chunks})} emails", "blue"))
+    return chunks, failures
+
+async def run_job_analysis(emails: List[dict], search_terms: List[str], options: dict):
+    """Analysis callback for background jobs"""
+    async for index, result in stream_email_analysis(emails, search_terms, packed=options.get("packed"),
+                                                     threads=options.get("threads"),
+                                                     attachments=options.get("attachments")):
+        yield index, result
+
+async def load_job_emails(entries: List[dict]) -> List[dict]:
+    """Reload the analysis content of job emails from the email store"""
+    emails_dir = Path("uploaded_emails")
+    loaded = await asyncio.gather(*[get_email_data(emails_dir / entry["filename"]) for entry in entries],
+                                  return_exceptions=True)
+    emails = []
+    for entry, email_data in zip(entries, loaded):
+        if isinstance(email_data, Exception):
+            print(colored(f"Error loading {entry['filename']} for job: {str(email_data)}", "red"))
+            emails.append({**entry, "error": str(email_data)})
+        else:
+            emails.append({**entry, "content": email_data["analysis_content"],
+                           "raw_tokens": email_data["raw_tokens"], "tokens": email_data["tokens"],
+                           "date": email_data["date"],
+                           **{field: email_data[field] for field in THREAD_FIELDS}})
+    return emails
+
+async def summarize_analysis(emails: List[dict], analysis_results: List[dict], search_terms: List[str]) -> str:
+    """Summarize the collection from the per-email analyses with the map-reduce summarizer"""
+    print(colored(f"Generating summary for {len(emails)} emails...", "blue"))
+    return await llm_service.generate_summary(
+        [email["content"] for email in emails],
+        search_terms,
+        analyses=[result["analysis"] for result in analysis_results]
+    )
+
+async def open_report_writer(search_request: SearchRequest) -> Optional[ReportWriter]:
+    """Open the report requested by search_request, or return None; an unknown format is a 400"""
+    if not search_request.report:
+        return None
+    try:
+        report_writer = ReportWriter(search_request.search_terms, search_request.report)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await report_writer.open()
+
+async def process_emails_in_batches(emails: List[dict], search_terms: List[str], packed: Optional[bool] = None,
+                                    plan: Optional[Tuple[List[int], List[int], dict]] = None,
+                                    report_writer: Optional[ReportWriter] = None,
+                                    threads: Optional[bool] = None, attachments: Optional[bool] = None) -> List[dict]:
+    """Analyze emails with a sliding window of MAX_CONCURRENT_REQUESTS calls, returning results in input order
+
+    plan is the output of prefilter_emails; without one every email is analyzed.
+    report_writer, if given, receives each result as soon as it is available.
+    """
+    try:
+        analyze_indices, skipped_indices, _ = plan or (None, [], None)
+        results = [None] * len(emails)
+        for index in skipped_indices:
+            results[index] = skipped_result(emails[index], search_terms)
+            if report_writer is not None:
+                await report_writer.write(results[index])
+        async for index, result in stream_email_analysis(emails, search_terms, packed=packed, indices=analyze_indices,
+                                                         threads=threads, attachments=attachments):
+            results[index] = result
+            if report_writer is not None:
+                await report_writer.write(result)
+        failed = sum(1 for result in results if result.get("error"))
+        if failed:
+            print(colored(f"\nAll {len(emails)} emails processed, {failed} failed", "yellow"))
+        else:
+            print(colored(f"\nAll {len(emails)} emails processed successfully!", "green"))
+        return results
     except Exception as e:
-        print(colored(f"Error in PDF conversion: {str(e)}", "red"))
-        return False
+        print(colored(f"Error in batch processing: {str(e)}", "red"))
+        raise
 
 async def email_to_pdf(email_path: str) -> str:
-    """Convert email to PDF using enhanced reportlab conversion"""
+    """Convert email to PDF, returning the path of the cached rendering"""
     try:
         # Get file extension and read email content
         file_extension = Path(email_path).suffix.lower()
         if file_extension not in SUPPORTED_FORMATS:
             raise ValueError(f"Unsupported file format: {file_extension}")
 
-        email_data = await read_email_content(Path(email_path))
-        
-        # Set output PDF path
-        pdf_path = str(email_path).rsplit('.', 1)[0] + '.pdf'
-        
-        # Convert to PDF using the new conversion function
-        if not await convert_email_to_pdf(email_data, pdf_path):
-            raise Exception("Failed to convert email to PDF")
-        
-        return pdf_path
+        email_data = await get_email_data(Path(email_path))
+
+        # Rendered in the worker pool, or served from the PDF cache if this content was rendered before
+        return str(await pdf_renderer.render(email_data))
     except Exception as e:
         print(colored(f"Error converting email to PDF: {str(e)}", "red"))
         raise HTTPException(status_code=500, detail=f"Error converting email to PDF: {str(e)}")
@@ -0,0 +1,308 @@
+import io
+import os
+import re
+import asyncio
+import hashlib
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from concurrent.futures import Executor
+from xml.etree import ElementTree
+from email import policy
+from email.parser import BytesParser
+from termcolor import colored
+import extract_msg
+from extract_msg.enums import AttachmentType
+from metrics import span
+from analysis_schema import EmailAnalysis, Match
+from email_parser import parse_eml_bytes, format_email_for_analysis
+from normalizer import html_to_text, clean_lines
+from token_utils import estimate_tokens, split_by_tokens
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+from dotenv import load_dotenv
+load_dotenv()
+
+ATTACHMENT_ANALYSIS = os.getenv("ATTACHMENT_ANALYSIS", "false").lower() == "true"  # Default for SearchRequest.attachments
+ATTACHMENT_CACHE_DIR = Path(os.getenv("ATTACHMENT_CACHE_DIR", "cache/attachments"))
+ATTACHMENT_CHUNK_TOKENS = int(os.getenv("ATTACHMENT_CHUNK_TOKENS", 4000))  # Max attachment tokens per LLM request
+ATTACHMENT_MAX_CHUNKS = int(os.getenv("ATTACHMENT_MAX_CHUNKS", 5))  # Chunks analyzed per attachment; the rest is dropped
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", 25 * 1024 * 1024))  # Larger attachments are skipped
+MAX_ATTACHMENT_DEPTH = 3  # Levels of attached messages inside attached messages that are opened
+ATTACHMENT_TEXT_VERSION = "1"  # Bump whenever conversion changes so cached texts are re-extracted
+
+TEXT_EXTENSIONS = {".txt", ".csv", ".md", ".json", ".log", ".xml", ".ics", ".vcf"}
+HTML_EXTENSIONS = {".html", ".htm"}
+MSG_TYPES = {"application/vnd.ms-outlook"}
+DOCX_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# Extraction and conversion functions are synchronous and module-level so they can run in a ProcessPoolExecutor
+
+def attachment_kind(name: str, content_type: str) -> Optional[str]:
+    """Converter for an attachment ("pdf", "docx", "eml", "msg", "html" or "text"), or None if unsupported"""
+    extension = Path(name).suffix.lower()
+    content_type = (content_type or "").lower()
+    if extension == ".pdf" or content_type == "application/pdf":
+        return "pdf"
+    if extension == ".docx":
+        return "docx"
+    if extension == ".eml" or content_type == "message/rfc822":
+        return "eml"
+    if extension == ".msg" or content_type in MSG_TYPES:
+        return "msg"
+    if extension in HTML_EXTENSIONS or content_type == "text/html":
+        return "html"
+    if extension in TEXT_EXTENSIONS or content_type.startswith("text/"):
+        return "text"
+    return None
+
+def _msg_attachments(msg, prefix: str, depth: int) -> List[dict]:
+    """Attachments of an open extract_msg message; attached messages become text plus their own attachments"""
+    attachments = []
+    for number, attachment in enumerate(msg.attachments, start=1):
+        name = f"{prefix}{attachment.longFilename or attachment.shortFilename or f'attachment-{number}'}"
+        if attachment.type == AttachmentType.MSG:
+            embedded = attachment.data
+            attachments.append({"name": name, "kind": "text", "data": _msg_text(embedded).encode("utf-8")})
+            if depth < MAX_ATTACHMENT_DEPTH:
+                attachments.extend(_msg_attachments(embedded, f"{name}/", depth + 1))
+        elif attachment.type == AttachmentType.DATA and isinstance(attachment.data, bytes):
+            attachments.extend(_data_attachments(name, attachment.mimetype or "", attachment.data, depth))
+    return attachments
+
+def _msg_text(msg) -> str:
+    body, html_body = msg.body or "", msg.htmlBody or ""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    if isinstance(html_body, bytes):
+        html_body = html_body.decode("utf-8", errors="replace")
+    return format_email_for_analysis({
+        "from": str(msg.sender or ""),
+        "to": str(msg.to or ""),
+        "subject": str(msg.subject or ""),
+        "date": str(msg.date or ""),
+        "body": str(body) if body.strip() else html_to_text(html_body)
+    })
+
+def _eml_attachments(message, prefix: str, depth: int) -> List[dict]:
+    """Binary attachments anywhere in a parsed .eml; its text parts are already part of the parsed body"""
+    attachments = []
+    for number, part in enumerate(message.walk(), start=1):
+        if part.is_multipart() or part.get_content_type() in ("text/plain", "text/html", "message/rfc822"):
+            continue
+        if not (part.is_attachment() or part.get_filename()):
+            continue
+        data = part.get_payload(decode=True)
+        if data:
+            name = f"{prefix}{part.get_filename() or f'attachment-{number}'}"
+            attachments.extend(_data_attachments(name, part.get_content_type(), data, depth))
+    return attachments
+
+def _data_attachments(name: str, content_type: str, data: bytes, depth: int) -> List[dict]:
+    kind = attachment_kind(name, content_type)
+    if kind is None or len(data) > MAX_ATTACHMENT_BYTES or (kind == "pdf" and PdfReader is None):
+        return []
+    if kind == "msg":
+        # An attached .msg file is opened like an embedded message
+        if depth >= MAX_ATTACHMENT_DEPTH:
+            return []
+        msg = extract_msg.openMsg(data)
+        try:
+            return [{"name": name, "kind": "text", "data": _msg_text(msg).encode("utf-8")}] + \
+                _msg_attachments(msg, f"{name}/", depth + 1)
+        finally:
+            msg.close()
+    if kind == "eml" and depth < MAX_ATTACHMENT_DEPTH:
+        nested = BytesParser(policy=policy.default).parsebytes(data)
+        return [{"name": name, "kind": kind, "data": data}] + _eml_attachments(nested, f"{name}/", depth + 1)
+    return [{"name": name, "kind": kind, "data": data}]
+
+def _read_attachments(file_path: str) -> List[dict]:
+    if Path(file_path).suffix.lower() == ".msg":
+        msg = extract_msg.openMsg(file_path)
+        try:
+            return _msg_attachments(msg, "", 1)
+        finally:
+            msg.close()
+    with open(file_path, "rb") as f:
+        return _eml_attachments(BytesParser(policy=policy.default).parse(f), "", 1)
+
+def list_attachments(file_path: str) -> List[dict]:
+    """Return [{name, kind, sha256, size}] for the supported attachments of an email, including nested ones"""
+    return [
+        {"name": attachment["name"], "kind": attachment["kind"],
+         "sha256": hashlib.sha256(attachment["data"]).hexdigest(), "size": len(attachment["data"])}
+        for attachment in _read_attachments(file_path)
+    ]
+
+def _docx_text(data: bytes) -> str:
+    with zipfile.ZipFile(io.BytesIO(data)) as docx:
+        root = ElementTree.fromstring(docx.read("word/document.xml"))
+    return "\n".join(
+        "".join(node.text or "" for node in paragraph.iter(f"{DOCX_NAMESPACE}t"))
+        for paragraph in root.iter(f"{DOCX_NAMESPACE}p")
+    )
+
+def attachment_text(kind: str, data: bytes) -> str:
+    """Plain text of one attachment"""
+    if kind == "pdf":
+        text = "\n\n".join(page.extract_text() or "" for page in PdfReader(io.BytesIO(data)).pages)
+    elif kind == "docx":
+        text = _docx_text(data)
+    elif kind == "eml":
+        text = format_email_for_analysis(parse_eml_bytes(data))
+    elif kind == "html":
+        text = html_to_text(data.decode("utf-8", errors="replace"))
+    else:
+        text = data.decode("utf-8", errors="replace")
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(clean_lines(text))).strip()
+
+def convert_attachments(file_path: str, output_paths: Dict[str, str]) -> Dict[str, str]:
+    """Write the text of the email's attachments whose sha256 is in output_paths; returns {sha256: error}"""
+    errors = {}
+    for attachment in _read_attachments(file_path):
+        sha256 = hashlib.sha256(attachment["data"]).hexdigest()
+        if sha256 not in output_paths or Path(output_paths[sha256]).exists():
+            continue
+        try:
+            text = attachment_text(attachment["kind"], attachment["data"])
+        except Exception as e:
+            errors[sha256] = str(e)
+            continue
+        # Write then rename so a concurrent reader never sees a partial file
+        temp_path = f"{output_paths[sha256]}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp_path, output_paths[sha256])
+    return errors
+
+def attachment_cache_key(sha256: str) -> str:
+    return hashlib.sha256(f"{ATTACHMENT_TEXT_VERSION}:{sha256}".encode("utf-8")).hexdigest()
+
+def attachment_chunks(email: dict, attachments: List[dict], model: str = "gpt-4o") -> List[dict]:
+    """Split each attachment's text into analysis inputs of at most ATTACHMENT_CHUNK_TOKENS tokens"""
+    chunks = []
+    for attachment in attachments:
+        if not attachment.get("text"):
+            continue
+        parts = split_by_tokens(attachment["text"], ATTACHMENT_CHUNK_TOKENS, model)
+        if len(parts) > ATTACHMENT_MAX_CHUNKS:
+            print(colored(f"Analyzing the first {ATTACHMENT_MAX_CHUNKS} of {len(parts)} chunks of "
+                          f"{email['filename']}/{attachment['name']}", "yellow"))
+        for number, part in enumerate(parts[:ATTACHMENT_MAX_CHUNKS], start=1):
+            header = f"Attachment: {attachment['name']}" + (f" (part {number} of {len(parts)})" if len(parts) > 1 else "")
+            content = f"{header}\nAttached to: {email['subject']}\n\n{part}"
+            tokens = estimate_tokens(content, model)
+            chunks.append({
+                "filename": email["filename"],
+                "subject": email["subject"],
+                "attachment": attachment["name"],
+                "content": content,
+                "raw_tokens": tokens,
+                "tokens": tokens
+            })
+    return chunks
+
+def merge_attachment_analyses(analysis: Optional[EmailAnalysis], chunk_analyses: List[tuple],
+                              search_terms: List[str]) -> tuple:
+    """Fold (attachment name, analysis or exception) pairs into the email's analysis
+
+    Returns (merged analysis, one {name, relevance_score, terms_found, error} entry per attachment).
+    Matches from an attachment are prefixed with its name; the email takes its best score.
+    """
+    matches = {term: list((analysis.semantic_matches.get(term) or []) if analysis else []) for term in search_terms}
+    score = analysis.overall_relevance_score if analysis else 0
+    insights = list(analysis.key_insights) if analysis else []
+    report: Dict[str, dict] = {}
+    for name, result in chunk_analyses:
+        entry = report.setdefault(name, {"name": name, "relevance_score": 0, "terms_found": [], "error": None})
+        if isinstance(result, Exception):
+            entry["error"] = str(result)
+            continue
+        entry["relevance_score"] = max(entry["relevance_score"], result.overall_relevance_score)
+        score = max(score, result.overall_relevance_score)
+        for term in search_terms:
+            found = result.semantic_matches.get(term) or []
+            matches[term].extend(Match(text=f"[{name}] {match.text}", relevance=match.relevance) for match in found)
+            if found and term not in entry["terms_found"]:
+                entry["terms_found"].append(term)
+        insights.extend(insight for insight in result.key_insights if insight not in insights)
+    merged = EmailAnalysis(semantic_matches=matches, overall_relevance_score=score, key_insights=insights)
+    return merged, list(report.values())
+
+class AttachmentExtractor:
+    """Extracts email attachments as text in a process pool and caches the text on disk by content hash"""
+
+    def __init__(self, get_executor: Callable[[], Executor], cache_dir: Path = ATTACHMENT_CACHE_DIR):
+        self.get_executor = get_executor
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._in_flight = {}  # cache key -> conversion future, so an attachment shared by emails is converted once
+        if PdfReader is None:
+            print(colored("Warning: pypdf is not installed, PDF attachments will be skipped (pip install pypdf)", "yellow"))
+
+    def _text_path(self, sha256: str) -> Path:
+        return self.cache_dir / f"{attachment_cache_key(sha256)}.txt"
+
+    async def extract(self, file_path: Path) -> List[dict]:
+        """Return [{name, kind, sha256, size, text, error}] for the email's supported attachments"""
+        loop = asyncio.get_running_loop()
+        with span("attachment_list"):
+            attachments = await loop.run_in_executor(self.get_executor(), list_attachments, str(file_path))
+        if not attachments:
+            return []
+
+        missing = {}
+        for attachment in attachments:
+            key = attachment_cache_key(attachment["sha256"])
+            if key in self._in_flight or attachment["sha256"] in missing:
+                continue
+            if self._text_path(attachment["sha256"]).exists():
+                self.hits += 1
+            else:
+                self.misses += 1
+                missing[attachment["sha256"]] = str(self._text_path(attachment["sha256"]))
+        if missing:
+            future = asyncio.ensure_future(
+                loop.run_in_executor(self.get_executor(), convert_attachments, str(file_path), missing)
+            )
+            for sha256 in missing:
+                key = attachment_cache_key(sha256)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda _, key=key: self._in_flight.pop(key, None))
+
+        keys = {attachment_cache_key(attachment["sha256"]) for attachment in attachments}
+        futures = {self._in_flight[key] for key in keys if key in self._in_flight}
+        errors = {}
+        with span("attachment_convert"):
+            for result in await asyncio.gather(*[asyncio.shield(future) for future in futures]):
+                errors.update(result)
+
+        def read_texts() -> Dict[str, Optional[str]]:
+            paths = {attachment["sha256"]: self._text_path(attachment["sha256"]) for attachment in attachments}
+            return {sha256: path.read_text(encoding="utf-8") if path.exists() else None for sha256, path in paths.items()}
+        texts = await asyncio.to_thread(read_texts)
+        for attachment in attachments:
+            attachment["text"] = texts[attachment["sha256"]]
+            attachment["error"] = errors.get(attachment["sha256"])
+            if attachment["error"]:
+                print(colored(f"Could not extract {Path(file_path).name}/{attachment['name']}: {attachment['error']}", "yellow"))
+        return attachments
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the number of cached attachment texts"""
+        return {"entries": sum(1 for _ in self.cache_dir.glob("*.txt")), "hits": self.hits, "misses": self.misses}
+
+    def clear(self) -> int:
+        """Delete every cached attachment text"""
+        removed = 0
+        for text_path in self.cache_dir.glob("*.txt"):
+            text_path.unlink(missing_ok=True)
+            removed += 1
+        return removed
@@ -0,0 +1,327 @@
+import os
+import json
+import orjson
+import time
+import uuid
+import asyncio
+import argparse
+from pathlib import Path
+from typing import List, Optional
+from openai import AsyncOpenAI
+from termcolor import colored
+from llm_service import LLMService
+from analysis_schema import parse_analysis, coerce_analysis, dump_analysis
+from email_store import EmailStore
+from email_parser import SUPPORTED_FORMATS, parse_email_file
+from csv_handler import ReportWriter, REPORTS_DIR, REPORT_FORMATS
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# Offline analysis through the Batch API: requests are written to JSONL files, submitted as batch jobs and
+# the results are ingested into the usual /analyze result format, the analysis cache and a CSV/Parquet report.
+# Batches are billed at a discount and do not count against the per-minute rate limits.
+
+BATCH_DIR = Path(os.getenv("BATCH_DIR", "cache/batches"))
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", 60))  # Delay between batch status checks
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 50000))  # Requests per batch file (API limit: 50k)
+BATCH_MAX_FILE_BYTES = int(os.getenv("BATCH_MAX_FILE_BYTES", 190 * 1024 * 1024))  # Stays under the 200 MB limit
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+def write_batch_files(requests: List[dict], run_dir: Path, max_requests: int = BATCH_MAX_REQUESTS,
+                      max_bytes: int = BATCH_MAX_FILE_BYTES) -> List[Path]:
+    """Write batch request lines into as many JSONL files as the per-batch limits require"""
+    paths = []
+    handle, count, size = None, 0, 0
+    try:
+        for request in requests:
+            line = (json.dumps(request) + "\n").encode('utf-8')
+            if handle is None or count >= max_requests or size + len(line) > max_bytes:
+                if handle is not None:
+                    handle.close()
+                paths.append(run_dir / f"input_{len(paths):03d}.jsonl")
+                handle = open(paths[-1], 'wb')
+                count, size = 0, 0
+            handle.write(line)
+            count += 1
+            size += len(line)
+    finally:
+        if handle is not None:
+            handle.close()
+    return paths
+
+def parse_batch_output(text: str) -> dict:
+    """Map custom_id to (EmailAnalysis, None) or (None, error) from a batch output or error file"""
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            error = record.get("error") or body.get("error") or {}
+            message = error.get("message") if isinstance(error, dict) else str(error)
+            results[record["custom_id"]] = (None, message or f"Batch request failed with status {response.get('status_code')}")
+            continue
+        try:
+            results[record["custom_id"]] = (parse_analysis(body["choices"][0]["message"]["content"]), None)
+        except Exception as e:
+            results[record["custom_id"]] = (None, f"Unreadable batch response: {str(e)}")
+    return results
+
+class BatchAnalysis:
+    """Prepares, submits, polls and ingests one offline analysis run, persisted as a manifest so it can resume"""
+
+    def __init__(self, run_id: str, llm_service: Optional[LLMService] = None, client: Optional[AsyncOpenAI] = None,
+                 batch_dir: Path = BATCH_DIR):
+        self.run_id = run_id
+        self.run_dir = Path(batch_dir) / run_id
+        self.manifest_path = self.run_dir / "manifest.json"
+        self.llm_service = llm_service or LLMService()
+        self.client = client or AsyncOpenAI()  # File uploads and batch polling use the SDK's own retries
+        self.manifest = json.loads(self.manifest_path.read_text()) if self.manifest_path.exists() else None
+
+    @classmethod
+    def new(cls, **kwargs) -> "BatchAnalysis":
+        return cls(f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}", **kwargs)
+
+    def _save(self):
+        temp_path = self.manifest_path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(self.manifest, indent=2))
+        os.replace(temp_path, self.manifest_path)
+
+    async def prepare(self, emails: List[dict], search_terms: List[str]):
+        """Write the batch input files; only terms an email was never analyzed for are sent"""
+        cache = self.llm_service.cache
+        model = self.llm_service.MODEL
+        requests, entries = [], []
+        cached = 0
+        for index, email in enumerate(emails):
+            entry = {
+                "custom_id": f"email-{index}",
+                "filename": email["filename"],
+                "subject": email["subject"],
+                "cache_key": cache.make_key(email["content"], search_terms, model),
+                "content_key": cache.make_content_key(email["content"], model),
+                "missing_terms": []
+            }
+            entries.append(entry)
+            if await cache.get(entry["cache_key"]) is None:
+                _, entry["missing_terms"] = await self.llm_service.cached_term_results(entry["content_key"], search_terms)
+            if not entry["missing_terms"]:
+                cached += 1
+                continue
+            requests.append({
+                "custom_id": entry["custom_id"],
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": self.llm_service.analysis_request(email["content"], entry["missing_terms"])
+            })
+
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        paths = await asyncio.to_thread(write_batch_files, requests, self.run_dir)
+        self.manifest = {
+            "run_id": self.run_id,
+            "search_terms": search_terms,
+            "model": model,
+            "created_at": time.time(),
+            "emails": entries,
+            "parts": [{"input_path": str(path), "file_id": None, "batch_id": None, "status": "prepared",
+                       "output_file_id": None, "error_file_id": None} for path in paths],
+            "ingested": False
+        }
+        self._save()
+        print(colored(f"Batch run {self.run_id}: {len(requests)} requests in {len(paths)} files, "
+                      f"{cached} emails already cached", "blue"))
+
+    async def submit(self):
+        """Upload and start every prepared batch file; parts that were already submitted are skipped"""
+        for part in self.manifest["parts"]:
+            if part["batch_id"]:
+                continue
+            try:
+                if not part["file_id"]:
+                    with open(part["input_path"], 'rb') as f:
+                        uploaded = await self.client.files.create(file=f, purpose="batch")
+                    part["file_id"] = uploaded.id
+                    self._save()
+                batch = await self.client.batches.create(
+                    input_file_id=part["file_id"],
+                    endpoint=BATCH_ENDPOINT,
+                    completion_window=BATCH_COMPLETION_WINDOW,
+                    metadata={"run_id": self.run_id}
+                )
+                part["batch_id"] = batch.id
+                part["status"] = batch.status
+                self._save()
+                print(colored(f"Submitted batch {batch.id} for {Path(part['input_path']).name}", "green"))
+            except Exception as e:
+                print(colored(f"Error submitting {part['input_path']}: {str(e)}", "red"))
+                raise
+
+    async def refresh(self) -> List[dict]:
+        """Fetch the current status of every submitted batch"""
+        for part in self.manifest["parts"]:
+            if not part["batch_id"] or part["status"] in TERMINAL_STATUSES:
+                continue
+            batch = await self.client.batches.retrieve(part["batch_id"])
+            part["status"] = batch.status
+            part["output_file_id"] = batch.output_file_id
+            part["error_file_id"] = batch.error_file_id
+            counts = batch.request_counts
+            if counts is not None:
+                part["request_counts"] = {"total": counts.total, "completed": counts.completed, "failed": counts.failed}
+        self._save()
+        return self.manifest["parts"]
+
+    async def wait(self, poll_seconds: float = BATCH_POLL_SECONDS):
+        """Poll until every batch reaches a terminal status"""
+        while True:
+            parts = await self.refresh()
+            done = sum(part.get("request_counts", {}).get("completed", 0) for part in parts)
+            total = sum(part.get("request_counts", {}).get("total", 0) for part in parts)
+            statuses = ", ".join(sorted({part["status"] for part in parts})) or "nothing to run"
+            print(colored(f"Batch run {self.run_id}: {statuses} ({done}/{total} requests done)", "cyan"))
+            if all(part["status"] in TERMINAL_STATUSES for part in parts):
+                return
+            await asyncio.sleep(poll_seconds)
+
+    async def _download(self, file_id: Optional[str]) -> str:
+        if not file_id:
+            return ""
+        content = await self.client.files.content(file_id)
+        return content.text
+
+    async def ingest(self, report_format: str = "csv") -> dict:
+        """Collect batch results into /analyze-style results, cache them and write a JSON and a tabular report"""
+        outputs = {}
+        for part in self.manifest["parts"]:
+            for file_id in (part["output_file_id"], part["error_file_id"]):
+                outputs.update(parse_batch_output(await self._download(file_id)))
+
+        search_terms = self.manifest["search_terms"]
+        cache = self.llm_service.cache
+        results, new_term_entries, new_cache_entries = [], [], []
+        report_writer = await ReportWriter(search_terms, report_format, name=f"batch_{self.run_id}").open()
+        try:
+            for entry in self.manifest["emails"]:
+                result = {"filename": entry["filename"], "subject": entry["subject"], "analysis": None}
+                analysis, error = outputs.get(entry["custom_id"], (None, None))
+                if error is None:
+                    analysis = coerce_analysis(await cache.get(entry["cache_key"]))
+                    if analysis is not None:
+                        analysis = self.llm_service.for_terms(analysis, search_terms)
+                if error is None and analysis is None:
+                    # Merge the batch answer for the missing terms with the terms cached before the run
+                    term_results, missing = await self.llm_service.cached_term_results(entry["content_key"], search_terms)
+                    if entry["custom_id"] in outputs:
+                        new_terms = self.llm_service.split_term_results(outputs[entry["custom_id"]][0],
+                                                                        entry["missing_terms"])
+                        term_results.update(new_terms)
+                        new_term_entries.extend((entry["content_key"], term, value) for term, value in new_terms.items())
+                        missing = [term for term in missing if term not in entry["missing_terms"]]
+                    if missing:
+                        error = "No batch result for this email"
+                    else:
+                        analysis = self.llm_service.merge_term_results(search_terms, term_results)
+                        new_cache_entries.append((entry["cache_key"], dump_analysis(analysis)))
+                result["analysis"] = analysis
+                if error:
+                    result["error"] = error
+                results.append(result)
+                await report_writer.write(result)
+        finally:
+            await report_writer.close()
+        # Later /analyze runs with the same or overlapping terms are served from the cache instead of the API
+        await cache.set_terms(new_term_entries)
+        await cache.set_many(new_cache_entries)
+
+        failed = sum(1 for result in results if result.get("error"))
+        report = {
+            "status": "success",
+            "run_id": self.run_id,
+            "analysis_results": results,
+            "num_emails": len(results),
+            "failed": failed
+        }
+        json_path = REPORTS_DIR / f"batch_{self.run_id}.json"
+        await asyncio.to_thread(json_path.write_bytes, orjson.dumps(report))
+
+        self.manifest["ingested"] = True
+        self.manifest["reports"] = {"json": str(json_path), report_format: str(report_writer.path)}
+        self._save()
+        print(colored(f"Ingested {len(results)} results ({failed} failed) into {json_path} and {report_writer.path}",
+                      "yellow" if failed else "green"))
+        return report
+
+    async def run(self, poll_seconds: float = BATCH_POLL_SECONDS, report_format: str = "csv") -> dict:
+        """Submit, wait for and ingest a prepared run; safe to call again after an interruption"""
+        await self.submit()
+        await self.wait(poll_seconds)
+        return await self.ingest(report_format)
+
+async def load_emails(emails_dir: Path) -> List[dict]:
+    """Read every supported email in a directory through the email store, like the app does"""
+    store = EmailStore()
+    email_files = sorted(path for path in Path(emails_dir).iterdir() if path.suffix.lower() in SUPPORTED_FORMATS)
+    parsed = await asyncio.gather(
+        *[store.get(path, lambda p: asyncio.to_thread(parse_email_file, str(p))) for path in email_files],
+        return_exceptions=True
+    )
+    emails = []
+    for path, email_data in zip(email_files, parsed):
+        if isinstance(email_data, Exception):
+            print(colored(f"Error processing {path.name}: {str(email_data)}", "red"))
+            continue
+        emails.append({"filename": path.name, "subject": email_data["subject"], "content": email_data["analysis_content"]})
+    return emails
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analyze emails offline through the OpenAI Batch API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Prepare, submit and ingest a new batch run")
+    run.add_argument("--terms", required=True, help="Comma-separated search terms")
+    run.add_argument("--emails-dir", default="uploaded_emails")
+    run.add_argument("--no-wait", action="store_true", help="Exit after submitting; finish later with 'resume'")
+    run.add_argument("--poll-seconds", type=float, default=BATCH_POLL_SECONDS)
+    run.add_argument("--report-format", choices=sorted(REPORT_FORMATS), default="csv")
+
+    resume = commands.add_parser("resume", help="Continue an interrupted or unfinished run")
+    resume.add_argument("run_id")
+    resume.add_argument("--poll-seconds", type=float, default=BATCH_POLL_SECONDS)
+    resume.add_argument("--report-format", choices=sorted(REPORT_FORMATS), default="csv")
+
+    status = commands.add_parser("status", help="Show the status of a run")
+    status.add_argument("run_id")
+    return parser.parse_args()
+
+async def main():
+    args = parse_args()
+    if args.command == "run":
+        search_terms = [term.strip() for term in args.terms.split(",") if term.strip()]
+        emails = await load_emails(Path(args.emails_dir))
+        batch = BatchAnalysis.new()
+        await batch.prepare(emails, search_terms)
+        if args.no_wait:
+            await batch.submit()
+            print(colored(f"Submitted; finish with: python batch_analysis.py resume {batch.run_id}", "blue"))
+            return
+        await batch.run(args.poll_seconds, args.report_format)
+        return
+
+    batch = BatchAnalysis(args.run_id)
+    if batch.manifest is None:
+        raise SystemExit(f"Unknown batch run: {args.run_id}")
+    if args.command == "status":
+        for part in await batch.refresh():
+            print(f"{Path(part['input_path']).name}: {part['status']} {part.get('request_counts', '')}")
+        return
+    await batch.run(args.poll_seconds, args.report_format)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,37 @@
+import sys
+import argparse
+from pathlib import Path
+from termcolor import colored
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from email_generator import email_path, existing_indices, generate_offline
+
+# Synthetic corpora for benchmarks, built with the offline template mode of email_generator.py.
+# Deterministic for a given seed, and reused across runs: only missing emails are written.
+
+THEMES = ["budget", "contract renewal", "hiring plan", "product launch", "security incident", "vendor invoice",
+          "quarterly forecast", "customer escalation", "travel approval", "data migration"]
+
+def generate_corpus(dest_dir: Path, count: int, msg_ratio: float = 0.2, seed: int = 42) -> list:
+    """Make sure dest_dir holds emails 0..count-1 and return their paths"""
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    done = existing_indices(dest_dir)
+    missing = [index for index in range(count) if index not in done]
+    if missing:
+        print(colored(f"Writing {len(missing)} synthetic emails to {dest_dir}...", "cyan"))
+        generate_offline(missing, THEMES, dest_dir, msg_ratio, seed)
+    return [email_path(dest_dir, index, msg_ratio, seed) for index in range(count)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic .eml/.msg corpus for benchmarks")
+    parser.add_argument("dest_dir", type=Path)
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--msg-ratio", type=float, default=0.2, help="Fraction of emails written as .msg")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    paths = generate_corpus(args.dest_dir, args.count, args.msg_ratio, args.seed)
+    print(colored(f"Corpus of {len(paths)} emails ready in {args.dest_dir}", "green"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from collections import deque
+from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
+import uvicorn
+from termcolor import colored
+
+# Local stand-in for the chat-completions, files and batches endpoints. Point the app at it with
+# OPENAI_BASE_URL=http://127.0.0.1:<port>/v1 to measure the pipeline without paying for API calls.
+
+CHARS_PER_TOKEN = 4
+EMAIL_ID_PATTERN = re.compile(r'<email id="([^"]+)">\n(.*?)\n</email>', re.S)
+SEARCH_TERMS_PATTERN = re.compile(r"search terms:\s*(.+)", re.I)
+
+class MockSettings:
+    """Latency, failure and rate-limit behaviour of the mock server"""
+
+    def __init__(self, latency_median: float = 0.8, latency_sigma: float = 0.4, error_rate: float = 0.0,
+                 requests_per_minute: int = 0, tokens_per_minute: int = 0, seed: int = None,
+                 batch_seconds: float = 2.0):
+        self.latency_median = latency_median  # Seconds; latencies are log-normal around this median
+        self.latency_sigma = latency_sigma  # Spread of the log-normal distribution; 0 gives a fixed latency
+        self.error_rate = error_rate  # Fraction of requests answered with a 500
+        self.requests_per_minute = requests_per_minute  # 0 disables the request limit
+        self.tokens_per_minute = tokens_per_minute  # 0 disables the token limit
+        self.batch_seconds = batch_seconds  # Time a batch spends in_progress before it completes
+        self.random = random.Random(seed)
+
+    def latency(self) -> float:
+        if self.latency_sigma <= 0:
+            return self.latency_median
+        return self.random.lognormvariate(0, self.latency_sigma) * self.latency_median
+
+class RateWindow:
+    """Sliding 60 second window of (timestamp, tokens) used to answer with 429s like the real API"""
+
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.events = deque()
+        self.tokens = 0
+
+    def _expire(self, now: float):
+        while self.events and now - self.events[0][0] >= 60:
+            self.tokens -= self.events.popleft()[1]
+
+    def admit(self, tokens: int):
+        """Return (admitted, seconds until capacity frees up, rate-limit headers)"""
+        now = time.monotonic()
+        self._expire(now)
+        rpm, tpm = self.settings.requests_per_minute, self.settings.tokens_per_minute
+        over_requests = rpm and len(self.events) + 1 > rpm
+        over_tokens = tpm and self.tokens + tokens > tpm
+        reset = 60 - (now - self.events[0][0]) if self.events else 0.0
+        if not (over_requests or over_tokens):
+            self.events.append((now, tokens))
+            self.tokens += tokens
+        headers = {}
+        if rpm:
+            headers["x-ratelimit-limit-requests"] = str(rpm)
+            headers["x-ratelimit-remaining-requests"] = str(max(0, rpm - len(self.events)))
+            headers["x-ratelimit-reset-requests"] = f"{reset:.3f}s"
+        if tpm:
+            headers["x-ratelimit-limit-tokens"] = str(tpm)
+            headers["x-ratelimit-remaining-tokens"] = str(max(0, tpm - self.tokens))
+            headers["x-ratelimit-reset-tokens"] = f"{reset:.3f}s"
+        return not (over_requests or over_tokens), reset, headers
+
+def fake_analysis(email_text: str, search_terms: list, rng: random.Random) -> dict:
+    """Analysis shaped like the real model output, matching terms that literally occur in the email"""
+    lowered = email_text.lower()
+    matches = {}
+    for term in search_terms:
+        position = lowered.find(term.lower())
+        matches[term] = [] if position < 0 else [{
+            "text": email_text[max(0, position - 40):position + len(term) + 40].strip(),
+            "relevance": f"Mentions {term}"
+        }]
+    found = sum(1 for term_matches in matches.values() if term_matches)
+    return {
+        "semantic_matches": matches,
+        "overall_relevance_score": min(100, found * 40 + rng.randint(0, 20)),
+        "key_insights": [f"Mock insight for {term}" for term, term_matches in matches.items() if term_matches]
+    }
+
+def build_content(body: dict, rng: random.Random) -> str:
+    messages = body.get("messages", [])
+    prompt = messages[-1]["content"] if messages else ""
+    wants_json = (body.get("response_format") or {}).get("type") in ("json_object", "json_schema")
+    if not wants_json:
+        return "Mock summary of the emails: " + prompt[:200].replace("\n", " ")
+
+    terms_match = SEARCH_TERMS_PATTERN.search(prompt)
+    search_terms = [term.strip() for term in terms_match.group(1).split(",")] if terms_match else []
+    packed = EMAIL_ID_PATTERN.findall(prompt)
+    if packed:
+        return json.dumps({"results": {email_id: fake_analysis(text, search_terms, rng) for email_id, text in packed}})
+    return json.dumps(fake_analysis(prompt, search_terms, rng))
+
+def create_mock_app(settings: MockSettings) -> FastAPI:
+    app = FastAPI()
+    window = RateWindow(settings)
+    stats = {"requests": 0, "rate_limited": 0, "errors": 0, "completed": 0, "batches_completed": 0}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        prompt_text = "".join(message.get("content") or "" for message in body.get("messages", []))
+        prompt_tokens = len(prompt_text) // CHARS_PER_TOKEN + 1
+
+        admitted, reset, headers = window.admit(prompt_tokens)
+        if not admitted:
+            stats["rate_limited"] += 1
+            headers["retry-after-ms"] = str(int(reset * 1000) + 1)
+            return JSONResponse(status_code=429, headers=headers, content={"error": {
+                "message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"
+            }})
+
+        await asyncio.sleep(settings.latency())
+        if settings.random.random() < settings.error_rate:
+            stats["errors"] += 1
+            return JSONResponse(status_code=500, content={"error": {"message": "Mock server error", "type": "server_error"}})
+
+        content = build_content(body, settings.random)
+        completion_tokens = len(content) // CHARS_PER_TOKEN + 1
+        stats["completed"] += 1
+        return JSONResponse(headers=headers, content={
+            "id": f"chatcmpl-mock-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        })
+
+    files = {}  # file id -> {"object": file metadata, "content": bytes}
+    batches = {}  # batch id -> batch object
+
+    def store_file(content: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-mock-{uuid.uuid4().hex}"
+        files[file_id] = {"content": content, "object": {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed"
+        }}
+        return files[file_id]["object"]
+
+    async def process_batch(batch: dict):
+        """Answer every request of a batch offline, failing error_rate of them like the live endpoint"""
+        await asyncio.sleep(settings.batch_seconds / 2)
+        if batch["status"] == "cancelling":
+            batch.update(status="cancelled", cancelled_at=int(time.time()))
+            return
+        batch.update(status="in_progress", in_progress_at=int(time.time()))
+        await asyncio.sleep(settings.batch_seconds / 2)
+
+        outputs, errors = [], []
+        for line in files[batch["input_file_id"]]["content"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            record = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "error": None}
+            if settings.random.random() < settings.error_rate:
+                record["response"] = {"status_code": 500, "request_id": uuid.uuid4().hex, "body": {
+                    "error": {"message": "Mock server error", "type": "server_error"}
+                }}
+                errors.append(record)
+                continue
+            body = request["body"]
+            content = build_content(body, settings.random)
+            prompt_tokens = len("".join(m.get("content") or "" for m in body.get("messages", []))) // CHARS_PER_TOKEN + 1
+            completion_tokens = len(content) // CHARS_PER_TOKEN + 1
+            record["response"] = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": {
+                "id": f"chatcmpl-mock-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens}
+            }}
+            outputs.append(record)
+
+        def jsonl(records: list) -> bytes:
+            return "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+
+        if outputs:
+            batch["output_file_id"] = store_file(jsonl(outputs), f"{batch['id']}_output.jsonl", "batch_output")["id"]
+        if errors:
+            batch["error_file_id"] = store_file(jsonl(errors), f"{batch['id']}_error.jsonl", "batch_output")["id"]
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+        batch.update(status="completed", completed_at=int(time.time()))
+        stats["batches_completed"] += 1
+
+    @app.post("/v1/files")
+    async def create_file(file: UploadFile = File(...), purpose: str = Form(...)):
+        return store_file(await file.read(), file.filename, purpose)
+
+    @app.get("/v1/files/{file_id}/content")
+    async def file_content(file_id: str):
+        if file_id not in files:
+            raise HTTPException(status_code=404, detail="No such file")
+        return PlainTextResponse(files[file_id]["content"].decode("utf-8"))
+
+    @app.post("/v1/batches")
+    async def create_batch(request: Request):
+        body = await request.json()
+        if body.get("input_file_id") not in files:
+            raise HTTPException(status_code=400, detail="Unknown input_file_id")
+        batch_id = f"batch_mock_{uuid.uuid4().hex}"
+        lines = sum(1 for line in files[body["input_file_id"]]["content"].splitlines() if line.strip())
+        batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": body["endpoint"], "errors": None,
+            "input_file_id": body["input_file_id"], "completion_window": body["completion_window"],
+            "status": "validating", "output_file_id": None, "error_file_id": None,
+            "created_at": int(time.time()), "metadata": body.get("metadata"),
+            "request_counts": {"total": lines, "completed": 0, "failed": 0}
+        }
+        asyncio.create_task(process_batch(batches[batch_id]))
+        return batches[batch_id]
+
+    @app.get("/v1/batches/{batch_id}")
+    async def retrieve_batch(batch_id: str):
+        if batch_id not in batches:
+            raise HTTPException(status_code=404, detail="No such batch")
+        return batches[batch_id]
+
+    @app.post("/v1/batches/{batch_id}/cancel")
+    async def cancel_batch(batch_id: str):
+        if batch_id not in batches:
+            raise HTTPException(status_code=404, detail="No such batch")
+        if batches[batch_id]["status"] == "validating":
+            batches[batch_id]["status"] = "cancelling"
+        return batches[batch_id]
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the OpenAI chat-completions API")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-median", type=float, default=0.8)
+    parser.add_argument("--latency-sigma", type=float, default=0.4)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute before answering 429 (0 = unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens per minute before answering 429 (0 = unlimited)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch-seconds", type=float, default=2.0, help="Time a submitted batch takes to complete")
+    args = parser.parse_args()
+
+    settings = MockSettings(args.latency_median, args.latency_sigma, args.error_rate, args.rpm, args.tpm, args.seed,
+                            args.batch_seconds)
+    print(colored(f"Mock OpenAI server on http://127.0.0.1:{args.port}/v1", "blue"))
+    uvicorn.run(create_mock_app(settings), host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from pathlib import Path
+from termcolor import colored
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.corpus import generate_corpus
+
+# Drives app.py end to end against the mock OpenAI server: starts both as subprocesses, copies a synthetic
+# corpus into a fresh working directory, streams /analyze/stream and reads the app's /metrics afterwards.
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+CORPUS_CACHE_DIR = REPO_ROOT / "benchmarks" / ".corpus"
+METRIC_LINE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL_PAIR = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2):
+                return
+        except Exception:
+            time.sleep(0.2)
+    raise TimeoutError(f"{url} did not come up within {timeout:.0f}s")
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def parse_metrics(text: str) -> list:
+    """Parse Prometheus text into (name, labels, value) samples"""
+    samples = []
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            labels = dict(LABEL_PAIR.findall(match.group(2) or ""))
+            samples.append((match.group(1), labels, float(match.group(3))))
+    return samples
+
+def histogram_quantile(samples: list, name: str, q: float, **labels) -> float:
+    """Estimate a quantile from cumulative histogram buckets by linear interpolation, like PromQL"""
+    buckets = sorted(
+        (float("inf") if sample_labels["le"] == "+Inf" else float(sample_labels["le"]), value)
+        for sample_name, sample_labels, value in samples
+        if sample_name == f"{name}_bucket" and all(sample_labels.get(k) == v for k, v in labels.items())
+    )
+    if not buckets or buckets[-1][1] == 0:
+        return 0.0
+    rank = q * buckets[-1][1]
+    previous_bound, previous_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return previous_bound
+            return previous_bound + (bound - previous_bound) * (rank - previous_count) / max(count - previous_count, 1)
+        previous_bound, previous_count = bound, count
+    return previous_bound
+
+def metric_value(samples: list, name: str, **labels) -> float:
+    return sum(value for sample_name, sample_labels, value in samples
+               if sample_name == name and all(sample_labels.get(k) == v for k, v in labels.items()))
+
+def stream_analysis(base_url: str, search_terms: list, packed: bool, timeout: float) -> dict:
+    """Run one streamed analysis and time each result as it arrives"""
+    request = urllib.request.Request(
+        f"{base_url}/analyze/stream",
+        data=json.dumps({"search_terms": search_terms, "packed": packed}).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST"
+    )
+    start = time.perf_counter()
+    arrivals = []
+    summary = {}
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        for line in response:
+            event = json.loads(line)
+            if event["type"] == "result":
+                arrivals.append(time.perf_counter() - start)
+            elif event["type"] == "summary":
+                summary = event
+            elif event["type"] == "error":
+                raise RuntimeError(f"Analysis failed: {event['message']}")
+    return {"elapsed": time.perf_counter() - start, "arrivals": arrivals, "summary": summary}
+
+def run_one(size: int, args) -> dict:
+    corpus_dir = CORPUS_CACHE_DIR / f"seed-{args.seed}-msg-{args.msg_ratio}"
+    print(colored(f"\n=== {size} emails ===", "blue"))
+    paths = generate_corpus(corpus_dir, size, args.msg_ratio, args.seed)
+
+    workdir = Path(tempfile.mkdtemp(prefix="email-bench-"))
+    emails_dir = workdir / "uploaded_emails"
+    emails_dir.mkdir()
+    for path in paths:
+        try:
+            os.link(path, emails_dir / path.name)
+        except OSError:
+            shutil.copy(path, emails_dir / path.name)
+
+    mock_port, app_port = free_port(), free_port()
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(REPO_ROOT),
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{mock_port}/v1",
+        "MAX_CONCURRENT_REQUESTS": str(args.concurrency),
+    }
+    processes = []
+    try:
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.mock_openai", "--port", str(mock_port),
+             "--latency-median", str(args.latency_median), "--latency-sigma", str(args.latency_sigma),
+             "--error-rate", str(args.error_rate), "--rpm", str(args.rpm), "--tpm", str(args.tpm),
+             "--seed", str(args.seed)],
+            cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL
+        ))
+        app_log = open(workdir / "app.log", "w")
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(app_port), "--log-level", "warning"],
+            cwd=workdir, env=env, stdout=app_log, stderr=subprocess.STDOUT
+        ))
+        base_url = f"http://127.0.0.1:{app_port}"
+        wait_for(f"http://127.0.0.1:{mock_port}/stats")
+        wait_for(f"{base_url}/metrics")
+
+        run = stream_analysis(base_url, args.search_terms, args.packed, args.timeout)
+        with urllib.request.urlopen(f"{base_url}/metrics") as response:
+            samples = parse_metrics(response.read().decode())
+        with urllib.request.urlopen(f"http://127.0.0.1:{mock_port}/stats") as response:
+            mock_stats = json.loads(response.read())
+
+        span = "email_analyser_span_duration_seconds"
+        lag = "email_analyser_event_loop_lag_seconds"
+        loop_lag_max = metric_value(samples, "email_analyser_event_loop_lag_max_seconds")
+        result = {
+            "emails": size,
+            "elapsed_seconds": round(run["elapsed"], 3),
+            "emails_per_second": round(len(run["arrivals"]) / run["elapsed"], 2) if run["elapsed"] else 0.0,
+            "failed": run["summary"].get("failed", 0),
+            "time_to_result_p50": round(percentile(run["arrivals"], 0.5), 3),
+            "time_to_result_p99": round(percentile(run["arrivals"], 0.99), 3),
+            "llm_call_p50": round(histogram_quantile(samples, span, 0.5, span="llm_call"), 3),
+            "llm_call_p99": round(histogram_quantile(samples, span, 0.99, span="llm_call"), 3),
+            "parse_p50": round(histogram_quantile(samples, span, 0.5, span="parse"), 4),
+            "parse_p99": round(histogram_quantile(samples, span, 0.99, span="parse"), 4),
+            # Bucket interpolation can overshoot the observed maximum, so cap it
+            "loop_lag_p99": round(min(histogram_quantile(samples, lag, 0.99), loop_lag_max), 4),
+            "loop_lag_max": round(loop_lag_max, 4),
+            "peak_rss_mb": round(metric_value(samples, "email_analyser_peak_rss_bytes", process="self") / 2**20, 1),
+            "peak_rss_children_mb": round(
+                metric_value(samples, "email_analyser_peak_rss_bytes", process="children") / 2**20, 1),
+            "llm_requests": mock_stats["requests"],
+            "rate_limited": mock_stats["rate_limited"],
+        }
+        print(colored(json.dumps(result, indent=2), "green"))
+        return result
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if args.keep_workdir:
+            print(colored(f"Working directory kept at {workdir}", "yellow"))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the /analyze pipeline against a mock OpenAI server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--search-terms", nargs="+", default=["budget", "security incident"])
+    parser.add_argument("--packed", action="store_true", help="Use packed multi-email requests")
+    parser.add_argument("--concurrency", type=int, default=10, help="MAX_CONCURRENT_REQUESTS for the app")
+    parser.add_argument("--msg-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency-median", type=float, default=0.5)
+    parser.add_argument("--latency-sigma", type=float, default=0.4)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rpm", type=int, default=0)
+    parser.add_argument("--tpm", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--output", type=Path, help="Write the results as JSON to this file")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the app working directory and log")
+    args = parser.parse_args()
+
+    results = [run_one(size, args) for size in args.sizes]
+
+    columns = ["emails", "emails_per_second", "time_to_result_p50", "time_to_result_p99", "llm_call_p99",
+               "loop_lag_max", "peak_rss_mb", "failed"]
+    print("\n" + " | ".join(f"{column:>18}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{result[column]:>18}" for column in columns))
+    if args.output:
+        args.output.write_text(json.dumps({"settings": {k: str(v) for k, v in vars(args).items()},
+                                           "results": results}, indent=2))
+        print(colored(f"Results written to {args.output}", "green"))
+
+if __name__ == "__main__":
+    main()
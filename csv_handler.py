@@ -1,63 +1,165 @@
+import io
+import os
 import csv
-import json
+import uuid
+import asyncio
 from pathlib import Path
-from typing import List, Dict
-import aiofiles
+from typing import List, Dict, Optional
 from datetime import datetime
+from termcolor import colored
+from metrics import span
+from analysis_schema import coerce_analysis
 
-class CSVHandler:
-    def __init__(self):
-        self.output_dir = Path("static/reports")
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
-    def generate_filename(self) -> str:
-        """Generate a unique filename for the CSV report"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        return f"email_analysis_{timestamp}.csv"
+from dotenv import load_dotenv
+load_dotenv()
 
-    async def create_analysis_csv(self, emails: List[str], analysis_results: List[Dict], search_terms: List[str]) -> str:
-        """
-        Create a CSV file with email analysis results
-        Returns the path to the generated CSV file
-        """
-        filename = self.generate_filename()
-        filepath = self.output_dir / filename
+REPORTS_DIR = Path(os.getenv("REPORTS_DIR", "static/reports"))
+REPORT_FLUSH_ROWS = int(os.getenv("REPORT_FLUSH_ROWS", 500))  # Rows buffered before a write in the worker thread
+REPORT_FORMATS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
 
-        # Prepare headers
-        headers = ["Subject", "Email Body", "Terms Found"] + [f"{term} - References" for term in search_terms]
+def report_row(result: Dict, search_terms: List[str]) -> Dict:
+    """Flatten one {filename, subject, analysis, error} result into a report row"""
+    analysis = coerce_analysis(result.get("analysis"))
+    semantic_matches = analysis.semantic_matches if analysis else {}
+    matches = [
+        {"term": term, "text": match.text, "relevance": match.relevance}
+        for term in search_terms
+        for match in semantic_matches.get(term) or []
+    ]
+    return {
+        "filename": result.get("filename", ""),
+        "subject": result.get("subject", ""),
+        "relevance_score": analysis.overall_relevance_score if analysis else None,
+        "terms_found": [term for term in search_terms if semantic_matches.get(term)],
+        "matches": matches,
+        "key_insights": list(analysis.key_insights) if analysis else [],
+        "skipped_by_prefilter": analysis.skipped_by_prefilter if analysis else False,
+        "error": result.get("error")
+    }
 
+def arrow_schema():
+    """Columnar schema of report rows; one row per email, matches nested as a list of structs"""
+    return pa.schema([
+        ("filename", pa.string()),
+        ("subject", pa.string()),
+        ("relevance_score", pa.int32()),
+        ("terms_found", pa.list_(pa.string())),
+        ("matches", pa.list_(pa.struct([
+            ("term", pa.string()),
+            ("text", pa.string()),
+            ("relevance", pa.string())
+        ]))),
+        ("key_insights", pa.list_(pa.string())),
+        ("skipped_by_prefilter", pa.bool_()),
+        ("error", pa.string())
+    ])
+
+class _CsvSink:
+    def __init__(self, path: Path, search_terms: List[str]):
+        self.search_terms = search_terms
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.headers = ["Filename", "Subject", "Relevance Score", "Terms Found"] + \
+            [f"{term} - References" for term in search_terms] + ["Key Insights", "Error"]
+        csv.writer(self.file).writerow(self.headers)
+
+    def write(self, rows: List[Dict]):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            references = {term: [] for term in self.search_terms}
+            for match in row["matches"]:
+                references[match["term"]].append(
+                    f"Text: {match['text']}\nRelevance: {match['relevance']}"
+                )
+            writer.writerow(
+                [row["filename"], row["subject"], "" if row["relevance_score"] is None else row["relevance_score"],
+                 ", ".join(row["terms_found"])]
+                + ["\n\n".join(references[term]) if references[term] else "No semantic matches found"
+                   for term in self.search_terms]
+                + ["\n".join(row["key_insights"]), row["error"] or ""]
+            )
+        self.file.write(buffer.getvalue())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class _ArrowSink:
+    def __init__(self, path: Path, format: str):
+        self.schema = arrow_schema()
+        if format == "parquet":
+            self.writer = pq.ParquetWriter(str(path), self.schema, compression="zstd")
+        else:
+            self.writer = pa_ipc.new_file(str(path), self.schema)
+
+    def write(self, rows: List[Dict]):
+        # Every flush becomes one Parquet row group / Arrow record batch
+        self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+class ReportWriter:
+    """Writes analysis results to a CSV, Parquet or Arrow report as they arrive, off the event loop"""
+
+    def __init__(self, search_terms: List[str], format: str = "csv", output_dir: Path = REPORTS_DIR,
+                 name: Optional[str] = None):
+        if format not in REPORT_FORMATS:
+            raise ValueError(f"Unsupported report format: {format} (expected one of {', '.join(REPORT_FORMATS)})")
+        if format != "csv" and pa is None:
+            raise ValueError(f"{format} reports need pyarrow: pip install pyarrow")
+        self.search_terms = search_terms
+        self.format = format
+        self.output_dir = Path(output_dir)
+        name = name or f"email_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        self.path = self.output_dir / f"{name}{REPORT_FORMATS[format]}"
+        self.rows_written = 0
+        self._pending: List[Dict] = []
+        self._sink = None
+
+    async def open(self) -> "ReportWriter":
+        def create():
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            return _CsvSink(self.path, self.search_terms) if self.format == "csv" else _ArrowSink(self.path, self.format)
+        self._sink = await asyncio.to_thread(create)
+        return self
+
+    async def write(self, result: Dict):
+        """Buffer one result, flushing to disk every REPORT_FLUSH_ROWS rows"""
+        self._pending.append(report_row(result, self.search_terms))
+        if len(self._pending) >= REPORT_FLUSH_ROWS:
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        with span("report_write", format=self.format):
+            await asyncio.to_thread(self._sink.write, rows)
+        self.rows_written += len(rows)
+
+    async def close(self) -> Path:
+        """Flush the remaining rows and finish the file; returns its path"""
         try:
-            with open(filepath, 'w', newline='', encoding='utf-8') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=headers)
-                writer.writeheader()
-
-                for email, analysis in zip(emails, analysis_results):
-                    # Parse the JSON string result
-                    result = json.loads(analysis)
-                    
-                    # Prepare row data
-                    row = {
-                        "Subject": result.get("subject", ""),
-                        "Email Body": result["original_email"],
-                        "Terms Found": ", ".join(result["terms_found"])
-                    }
-                    
-                    # Add semantic matches for each term
-                    for term in search_terms:
-                        matches = result["semantic_matches"].get(term, [])
-                        references = []
-                        for match in matches:
-                            references.append(
-                                f"Location: {match['location']}\n"
-                                f"Text: {match['text']}\n"
-                                f"Explanation: {match['explanation']}"
-                            )
-                        row[f"{term} - References"] = "\n\n".join(references) if references else "No semantic matches found"
-                    
-                    writer.writerow(row)
-
-            return str(filepath.relative_to(Path("static")))
-
-        except Exception as e:
-            print(f"Error creating CSV: {str(e)}")
-            raise 
\ No newline at end of file
+            await self.flush()
+        finally:
+            await asyncio.to_thread(self._sink.close)
+        print(colored(f"Wrote {self.rows_written} rows to {self.path}", "green"))
+        return self.path
+
+    async def __aenter__(self) -> "ReportWriter":
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def url(self) -> str:
+        """Path of the report under /static, for download links"""
+        return "/" + self.path.as_posix()
@@ -1,26 +1,45 @@
 import os
+import re
+import sys
+import time
+import random
+import hashlib
 import asyncio
-from datetime import datetime
+import argparse
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from typing import Dict, List, Optional
 from termcolor import colored
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
-import email.message
-from email import encoders
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from llm_client import ResilientLLMClient
+from scheduler import ConcurrencyScheduler
+from msg_writer import write_msg_file
+import email.utils
+from email.message import EmailMessage
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+OUTPUT_DIR = Path("emails")
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", 10))  # Generation requests kept in flight
+EMAIL_SEPARATOR = "=====END OF EMAIL====="  # Splits several emails returned by one completion
+FILENAME_PATTERN = re.compile(r"^email_(\d+)\.(eml|msg)$")
+
+# OpenAI client, created on first use so the offline mode works without an API key
+client = None
+
+def get_client() -> ResilientLLMClient:
+    global client
+    if client is None:
+        client = ResilientLLMClient(AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0))
+    return client
 
 async def llm_call(system_prompt: str, user_prompt: str, model: str = "gpt-4o-mini") -> str:
     """Generic async function for LLM calls"""
     try:
         print(colored(f"Making LLM call with prompt: {user_prompt[:50]}...", "cyan"))
-        response = await client.chat.completions.create(
+        response = await get_client().create(
             model=model,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -32,85 +51,252 @@ async def llm_call(system_prompt: str, user_prompt: str, model: str = "gpt-4o-mi
         print(colored(f"Error in LLM call: {str(e)}", "red"))
         raise
 
-async def generate_email(theme: str) -> str:
-    """Generate a single email using GPT-4o-mini with a specific theme"""
-    system_prompt = """You are an email writer. Generate a realistic email in plain text format.
+EMAIL_WRITER_SYSTEM_PROMPT = """You are an email writer. Generate a realistic email in plain text format.
     The email should be in English and follow this exact format:
 
     From: [realistic email address]
     To: [realistic email address]
     Subject: [clear subject related to the theme]
-   
+
     Keep the content natural and appropriate. Do not include any special characters or encoding.
     The email content should be focused on the specified theme."""
-    
+
+async def generate_email(theme: str) -> str:
+    """Generate a single email using GPT-4o-mini with a specific theme"""
     user_prompt = f"Generate a email about the theme: '{theme}'. Include realistic sender, recipient, and make it look like a real email exchange. The content should be specifically about {theme}."
-    return await llm_call(system_prompt, user_prompt)
+    return await llm_call(EMAIL_WRITER_SYSTEM_PROMPT, user_prompt)
+
+async def generate_email_batch(theme: str, count: int) -> List[str]:
+    """Generate several different emails on a theme with one completion"""
+    if count == 1:
+        return [await generate_email(theme)]
+    user_prompt = (
+        f"Generate {count} different emails about the theme: '{theme}'. Use different senders, recipients and "
+        f"situations for each, and make them look like real email exchanges specifically about {theme}. "
+        f"Put a line containing only {EMAIL_SEPARATOR} after each email."
+    )
+    content = await llm_call(EMAIL_WRITER_SYSTEM_PROMPT, user_prompt)
+    return [part.strip() for part in content.split(EMAIL_SEPARATOR) if "Subject:" in part]
+
+def parse_generated_email(email_content: str) -> dict:
+    """Split generated 'Header: value' lines and the body into the fields used to write email files"""
+    headers = {}
+    body_lines = []
+    in_headers = True
+    for line in email_content.strip().split('\n'):
+        if in_headers:
+            if not line.strip():  # Empty line marks end of headers
+                in_headers = False
+                continue
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+                continue
+            in_headers = False  # The model skipped the blank line; treat the rest as body
+        body_lines.append(line)
+
+    return {
+        "sender": headers.get("from", "no-reply@example.com"),
+        "to": [address.strip() for address in headers.get("to", "recipient@example.com").split(",")],
+        "subject": headers.get("subject", "No Subject"),
+        "body": '\n'.join(body_lines).strip(),
+        "html_body": "",
+        "date": datetime.now(timezone.utc),
+    }
+
+def _is_plain_7bit(*texts: str) -> bool:
+    return all(text.isascii() and "\r" not in text and max(map(len, text.split("\n"))) <= 900 for text in texts)
+
+def _format_eml_7bit(email_data: dict) -> bytes:
+    """Serialize ASCII-only email_data directly; much faster than EmailMessage for bulk corpora"""
+    headers = (f"From: {email_data['sender']}\nTo: {', '.join(email_data['to'])}\n"
+               f"Subject: {email_data['subject']}\nDate: {email.utils.format_datetime(email_data['date'])}\n"
+               "MIME-Version: 1.0\n")
+    text_part = "Content-Type: text/plain; charset=\"us-ascii\"\nContent-Transfer-Encoding: 7bit\n\n" + \
+        email_data["body"] + "\n"
+    if not email_data.get("html_body"):
+        return (headers + text_part).encode("ascii")
+    boundary = "=_alt_" + hashlib.sha1(email_data["body"].encode()).hexdigest()[:16]
+    html_part = "Content-Type: text/html; charset=\"us-ascii\"\nContent-Transfer-Encoding: 7bit\n\n" + \
+        email_data["html_body"] + "\n"
+    return (headers + f"Content-Type: multipart/alternative; boundary=\"{boundary}\"\n\n"
+            f"--{boundary}\n{text_part}--{boundary}\n{html_part}--{boundary}--\n").encode("ascii")
+
+def write_eml_file(path: Path, email_data: dict):
+    """Write an .eml file with a plain text part and an optional HTML alternative"""
+    header_values = (email_data["sender"], ", ".join(email_data["to"]), email_data["subject"])
+    if _is_plain_7bit(email_data["body"], email_data.get("html_body") or "", *header_values):
+        path.write_bytes(_format_eml_7bit(email_data))
+        return
+    message = EmailMessage()
+    message["From"] = email_data["sender"]
+    message["To"] = ", ".join(email_data["to"])
+    message["Subject"] = email_data["subject"]
+    message["Date"] = email.utils.format_datetime(email_data["date"])
+    message.set_content(email_data["body"])
+    if email_data.get("html_body"):
+        message.add_alternative(email_data["html_body"], subtype="html")
+    path.write_bytes(bytes(message))
+
+def write_email_file(path: Path, email_data: dict) -> Path:
+    """Write email_data as .eml or .msg depending on the path's extension"""
+    path = Path(path)
+    if path.suffix.lower() == ".msg":
+        write_msg_file(path, sender=email_data["sender"], to=email_data["to"], subject=email_data["subject"],
+                       body=email_data["body"], html_body=email_data.get("html_body", ""), date=email_data["date"])
+    else:
+        write_eml_file(path, email_data)
+    return path
 
 async def save_email_as_msg(email_content: str, index: int):
     """Save email content in EML format"""
     try:
-        emails_dir = Path("emails")
-        emails_dir.mkdir(exist_ok=True)
-        
-        # Parse email content
-        lines = email_content.split('\n')
-        headers = {}
-        body_lines = []
-        in_headers = True
-        
-        for line in lines:
-            if in_headers:
-                if not line.strip():  # Empty line marks end of headers
-                    in_headers = False
-                    continue
-                if ':' in line:
-                    key, value = line.split(':', 1)
-                    headers[key.strip()] = value.strip()
-            else:
-                body_lines.append(line)
-        
-        body = '\n'.join(body_lines)
-        
-        # Create email message
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = headers.get('Subject', 'No Subject')
-        msg['From'] = headers.get('From', 'no-reply@example.com')
-        msg['To'] = headers.get('To', 'recipient@example.com')
-        msg['Date'] = email.utils.formatdate(localtime=True)
-        
-        # Attach body as plain text
-        text_part = MIMEText(body, 'plain', 'utf-8')
-        msg.attach(text_part)
-        
-        # Create EML file
-        filename = f"email_{index}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.eml"
-        filepath = emails_dir / filename
-        
-        # Save as EML file with proper encoding
-        with open(filepath, 'w', encoding='utf-8') as f:
-            # Write headers
-            for key, value in headers.items():
-                f.write(f"{key}: {value}\n")
-            f.write("\n")  # Empty line between headers and body
-            f.write(body)  # Write the body directly
-            
+        OUTPUT_DIR.mkdir(exist_ok=True)
+        filepath = OUTPUT_DIR / f"email_{index}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.eml"
+        write_email_file(filepath, parse_generated_email(email_content))
         print(colored(f"Saved email {index} to {filepath}", "green"))
         return str(filepath)
     except Exception as e:
         print(colored(f"Error saving email as EML: {str(e)}", "red"))
         print(colored("Falling back to saving as text file...", "yellow"))
-        
+
         # Fallback to text file if EML creation fails
-        txt_filepath = emails_dir / f"email_{index}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        txt_filepath = OUTPUT_DIR / f"email_{index}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
         with open(txt_filepath, 'w', encoding='utf-8') as f:
             f.write(email_content)
-        
+
         print(colored(f"Saved email {index} to {txt_filepath}", "green"))
         return str(txt_filepath)
 
+# Offline templates: realistic-looking business emails without any API calls
+
+FIRST_NAMES = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi", "ivan", "judy", "mallory", "oscar"]
+LAST_NAMES = ["smith", "jones", "garcia", "chen", "patel", "nguyen", "muller", "rossi", "kim", "okafor"]
+DOMAINS = ["example.com", "contoso.com", "fabrikam.net", "northwind.org"]
+SUBJECT_TEMPLATES = ["{theme} update", "Re: {theme}", "Action needed: {theme}", "{theme} - next steps",
+                     "Fwd: {theme} review", "Question about the {theme}", "{theme} status for this week"]
+SENTENCES = [
+    "Please review the attached {theme} figures before Friday.",
+    "We need a decision on the {theme} by the end of the week.",
+    "The {theme} discussion moved to next Tuesday's meeting.",
+    "Finance flagged a discrepancy in the {theme} numbers.",
+    "Can you confirm who owns the {theme} going forward?",
+    "Legal has signed off on the {theme} with minor changes.",
+    "Let's keep the {theme} confidential until the announcement.",
+    "I have updated the tracker with the latest {theme} status.",
+    "The customer asked for an update on the {theme} timeline.",
+    "Our team will present the {theme} summary to leadership.",
+    "Thanks for pulling this together so quickly.",
+    "Let me know if anything here looks off.",
+]
+GREETINGS = ["Hi {name},", "Hello {name},", "Dear {name},", "{name},"]
+SIGN_OFFS = ["Regards,", "Best,", "Thanks,", "Cheers,", "Kind regards,"]
+
+def render_template_email(rng: random.Random, theme: str, number: int) -> dict:
+    """Build one synthetic email on a theme from templates"""
+    sender_first, recipient_first = rng.choice(FIRST_NAMES), rng.choice(FIRST_NAMES)
+    sender = f"{sender_first}.{rng.choice(LAST_NAMES)}@{rng.choice(DOMAINS)}"
+    recipients = [f"{recipient_first}.{rng.choice(LAST_NAMES)}@{rng.choice(DOMAINS)}"] + [
+        f"{rng.choice(FIRST_NAMES)}.{rng.choice(LAST_NAMES)}@{rng.choice(DOMAINS)}" for _ in range(rng.randint(0, 2))
+    ]
+    # Mostly short emails with a long tail, like real mailboxes
+    paragraphs = [
+        " ".join(rng.choice(SENTENCES).format(theme=theme) for _ in range(rng.randint(2, 5)))
+        for _ in range(min(30, int(rng.paretovariate(1.3))))
+    ]
+    body = "\n\n".join([rng.choice(GREETINGS).format(name=recipient_first.title())] + paragraphs
+                       + [f"{rng.choice(SIGN_OFFS)}\n{sender_first.title()}"])
+    html_body = ""
+    if rng.random() < 0.3:
+        html_body = "<html><body>" + "".join(f"<p>{p}</p>" for p in body.split("\n\n")) + "</body></html>"
+    return {
+        "sender": sender,
+        "to": recipients,
+        "subject": f"{rng.choice(SUBJECT_TEMPLATES).format(theme=theme)} #{number}",
+        "body": body,
+        "html_body": html_body,
+        "date": datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=rng.randint(0, 525600)),
+    }
+
+def email_path(output_dir: Path, index: int, msg_ratio: float, seed: int) -> Path:
+    """Deterministic file name and format for an email index, so reruns resume where they stopped"""
+    extension = ".msg" if random.Random(f"{seed}-{index}").random() < msg_ratio else ".eml"
+    return output_dir / f"email_{index:06d}{extension}"
+
+def existing_indices(output_dir: Path) -> set:
+    """Indices of emails already written by an earlier run"""
+    if not output_dir.exists():
+        return set()
+    return {int(match.group(1)) for match in map(FILENAME_PATTERN.match, os.listdir(output_dir)) if match}
+
+def generate_offline(indices: List[int], themes: List[str], output_dir: Path, msg_ratio: float, seed: int) -> int:
+    """Write template emails for the given indices without any API calls"""
+    for index in indices:
+        # Seeded per index so a resumed run writes the same email it would have written before
+        rng = random.Random(f"{seed}-{index}-content")
+        email_data = render_template_email(rng, themes[index % len(themes)], index)
+        write_email_file(email_path(output_dir, index, msg_ratio, seed), email_data)
+    return len(indices)
+
+async def generate_with_llm(indices: List[int], themes: List[str], output_dir: Path, msg_ratio: float, seed: int,
+                            concurrency: int, per_request: int) -> int:
+    """Generate emails with bounded concurrency, several per completion, writing each as soon as it arrives"""
+    # Each request covers up to per_request indices that share a theme
+    by_theme: Dict[str, List[int]] = {}
+    for index in indices:
+        by_theme.setdefault(themes[index % len(themes)], []).append(index)
+    requests = [(theme, group[i:i + per_request]) for theme, group in by_theme.items()
+                for i in range(0, len(group), per_request)]
+
+    async def generate(request: tuple) -> List[int]:
+        theme, group = request
+        try:
+            contents = await generate_email_batch(theme, len(group))
+            # A completion that returned too few emails is topped up one at a time
+            while len(contents) < len(group):
+                contents.append(await generate_email(theme))
+        except Exception as e:
+            print(colored(f"Error generating {len(group)} '{theme}' emails: {str(e)}", "red"))
+            return []
+        for index, content in zip(group, contents):
+            write_email_file(email_path(output_dir, index, msg_ratio, seed), parse_generated_email(content))
+        return group
+
+    scheduler = ConcurrencyScheduler(max_concurrency=concurrency)
+    written = 0
+    async for _, group in scheduler.as_completed(requests, generate):
+        written += len(group)
+        print(colored(f"Progress: {written}/{len(indices)} emails generated", "green"))
+    return written
+
+async def generate_corpus(count: int, themes: List[str], output_dir: Path = OUTPUT_DIR, offline: bool = False,
+                          concurrency: int = GENERATION_CONCURRENCY, per_request: int = 1, msg_ratio: float = 0.0,
+                          seed: int = 0) -> int:
+    """Generate emails 0..count-1 into output_dir, skipping those an earlier run already wrote"""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    done = existing_indices(output_dir)
+    pending = [index for index in range(count) if index not in done]
+    if done:
+        print(colored(f"Resuming: {count - len(pending)} of {count} emails already exist in {output_dir}", "yellow"))
+    if not pending:
+        return 0
+
+    start_time = time.perf_counter()
+    mode = "templates" if offline else f"{concurrency} concurrent requests, {per_request} emails per request"
+    print(colored(f"Generating {len(pending)} emails on {len(themes)} themes ({mode})...", "blue"))
+    if offline:
+        written = await asyncio.to_thread(generate_offline, pending, themes, output_dir, msg_ratio, seed)
+    else:
+        written = await generate_with_llm(pending, themes, output_dir, msg_ratio, seed, concurrency, per_request)
+    elapsed = time.perf_counter() - start_time
+    print(colored(f"Generated {written} emails in {elapsed:.1f}s ({written / elapsed if elapsed else 0:.0f}/s)", "green"))
+    if written < len(pending):
+        print(colored(f"{len(pending) - written} emails failed; rerun the same command to retry them", "yellow"))
+    return written
+
 async def generate_emails(num_emails: int = None):
-    """Generate multiple emails"""
+    """Generate multiple emails, asking for the count and theme interactively"""
     try:
         if num_emails is None:
             # Ask user for number of emails to generate
@@ -122,7 +308,7 @@ async def generate_emails(num_emails: int = None):
                     print(colored("Please enter a positive number.", "red"))
                 except ValueError:
                     print(colored("Please enter a valid number.", "red"))
-        
+
         # Get theme from user
         theme = input(colored("Please enter the theme for the emails (e.g., 'project updates', 'sales inquiries', 'team collaboration'): ", "yellow")).strip()
         while not theme:
@@ -130,36 +316,37 @@ async def generate_emails(num_emails: int = None):
             theme = input(colored("Please enter the theme for the emails: ", "yellow")).strip()
 
         print(colored(f"\nStarting generation of {num_emails} emails with theme: '{theme}'...", "blue"))
-        
-        emails = []
-        email_paths = []
-        
-        for i in range(num_emails):
-            print(colored(f"\nGenerating email {i+1}/{num_emails}...", "blue"))
-            email_content = await generate_email(theme)
-            emails.append(email_content)
-            
-            # Save email
-            email_path = await save_email_as_msg(email_content, i+1)
-            email_paths.append(email_path)
-            
-            # Show progress
-            print(colored(f"Progress: {i+1}/{num_emails} emails generated", "green"))
-            
+        await generate_corpus(num_emails, [theme])
         print(colored(f"\nSuccessfully generated {num_emails} themed emails!", "green"))
-        return emails, email_paths
     except Exception as e:
         print(colored(f"Error generating emails: {str(e)}", "red"))
         raise
 
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate a synthetic email corpus. Run without arguments for interactive mode.")
+    parser.add_argument("--count", type=int, required=True, help="Number of emails in the corpus")
+    parser.add_argument("--themes", nargs="+", required=True, help="Themes, assigned to emails round-robin")
+    parser.add_argument("--output", type=Path, default=OUTPUT_DIR, help="Output directory (reruns resume into it)")
+    parser.add_argument("--offline", action="store_true", help="Use templates instead of the API")
+    parser.add_argument("--concurrency", type=int, default=GENERATION_CONCURRENCY, help="Generation requests in flight")
+    parser.add_argument("--per-request", type=int, default=1, help="Emails requested per completion")
+    parser.add_argument("--msg-ratio", type=float, default=0.0, help="Fraction of emails written as .msg")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for file formats and offline content")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
     try:
-        print(colored("\n=== Themed Email Generator ===", "blue"))
-        print(colored("This script will generate synthetic business emails using AI based on your chosen theme.\n", "blue"))
-        asyncio.run(generate_emails())
+        if len(sys.argv) > 1:
+            args = parse_args(sys.argv[1:])
+            asyncio.run(generate_corpus(args.count, args.themes, args.output, args.offline, args.concurrency,
+                                        max(1, args.per_request), args.msg_ratio, args.seed))
+        else:
+            print(colored("\n=== Themed Email Generator ===", "blue"))
+            print(colored("This script will generate synthetic business emails using AI based on your chosen theme.\n", "blue"))
+            asyncio.run(generate_emails())
     except KeyboardInterrupt:
         print(colored("\nOperation cancelled by user.", "yellow"))
     except Exception as e:
         print(colored(f"\nAn error occurred: {str(e)}", "red"))
     finally:
-        print(colored("\nEmail generation complete.", "green")) 
\ No newline at end of file
+        print(colored("\nEmail generation complete.", "green"))
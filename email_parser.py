@@ -0,0 +1,166 @@
+from pathlib import Path
+from datetime import datetime, timezone
+from email.utils import parseaddr, parsedate_to_datetime
+from typing import Optional
+from termcolor import colored
+import extract_msg
+from email import policy
+from email.parser import BytesParser
+from bs4 import BeautifulSoup
+
+SUPPORTED_FORMATS = {'.msg', '.eml'}  # Add supported email formats here
+
+# These functions are synchronous and module-level so they can run in a ProcessPoolExecutor
+
+def parse_msg_file(file_path: str) -> dict:
+    """Read and parse .msg email content"""
+    msg = None
+    try:
+        msg = extract_msg.Message(str(file_path))
+
+        sender = str(msg.sender or "")
+        to = str(msg.to or "")
+        subject = str(msg.subject or "")
+        date = str(msg.date or "")
+        body = msg.body or ""
+        html_body = msg.htmlBody or ""
+        references = msg.header.get("References", "") if msg.header is not None else ""
+
+        # Convert body to string and handle encoding
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', errors='replace')
+        else:
+            body = str(body)
+
+        # Handle HTML body encoding
+        if isinstance(html_body, bytes):
+            html_body = html_body.decode('utf-8', errors='replace')
+
+        return {
+            "from": sender,
+            "to": to,
+            "subject": subject,
+            "date": date,
+            "body": body,
+            "html_body": html_body,
+            "message_id": str(msg.messageId or "").strip(),
+            "in_reply_to": str(msg.inReplyTo or "").strip(),
+            "references": str(references or "")
+        }
+    except Exception as e:
+        print(colored(f"Error reading .msg file {file_path}: {str(e)}", "red"))
+        raise
+    finally:
+        if msg is not None:
+            try:
+                msg.close()
+            except Exception as e:
+                print(colored(f"Warning: Error closing msg file: {str(e)}", "yellow"))
+
+def parse_eml_bytes(content: bytes) -> dict:
+    """Parse raw .eml bytes into the standard email dict"""
+    email_message = BytesParser(policy=policy.default).parsebytes(content)
+
+    sender = str(email_message.get('From', ''))
+    to = str(email_message.get('To', ''))
+    subject = str(email_message.get('Subject', ''))
+    date = str(email_message.get('Date', ''))
+
+    body = ''
+    html_body = ''
+
+    if email_message.is_multipart():
+        for part in email_message.walk():
+            content_type = part.get_content_type()
+            if content_type == "text/plain":
+                body_part = part.get_payload(decode=True)
+                try:
+                    body += body_part.decode('utf-8', errors='replace')
+                except Exception:
+                    body += body_part.decode('latin-1', errors='replace')
+            elif content_type == "text/html":
+                html_part = part.get_payload(decode=True)
+                try:
+                    html_body += html_part.decode('utf-8', errors='replace')
+                except Exception:
+                    html_body += html_part.decode('latin-1', errors='replace')
+        if not body.strip() and html_body:
+            # HTML-only messages get their visible text as the body, for viewing and search
+            body = BeautifulSoup(html_body, 'html.parser').get_text()
+    else:
+        content_type = email_message.get_content_type()
+        payload = email_message.get_payload(decode=True)
+        try:
+            decoded_content = payload.decode('utf-8', errors='replace')
+        except Exception:
+            decoded_content = payload.decode('latin-1', errors='replace')
+
+        if content_type == "text/html":
+            html_body = decoded_content
+            # Extract plain text from HTML for body
+            soup = BeautifulSoup(html_body, 'html.parser')
+            body = soup.get_text()
+        else:
+            body = decoded_content
+
+    return {
+        "from": sender,
+        "to": to,
+        "subject": subject,
+        "date": date,
+        "body": body,
+        "html_body": html_body,
+        "message_id": str(email_message.get('Message-ID', '')).strip(),
+        "in_reply_to": str(email_message.get('In-Reply-To', '')).strip(),
+        "references": str(email_message.get('References', ''))
+    }
+
+def parse_eml_file(file_path: str) -> dict:
+    """Read and parse .eml email content"""
+    try:
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        return parse_eml_bytes(content)
+    except Exception as e:
+        print(colored(f"Error reading .eml file {file_path}: {str(e)}", "red"))
+        raise
+
+def parse_email_file(file_path: str) -> dict:
+    """Read and parse email content based on file extension"""
+    file_extension = Path(file_path).suffix.lower()
+
+    if file_extension not in SUPPORTED_FORMATS:
+        raise ValueError(f"Unsupported file format: {file_extension}")
+
+    if file_extension == '.msg':
+        return parse_msg_file(file_path)
+    elif file_extension == '.eml':
+        return parse_eml_file(file_path)
+
+def format_email_for_analysis(email_data: dict) -> str:
+    """Format parsed email data as the text sent to the LLM"""
+    return f"""From: {email_data['from']}
+To: {email_data['to']}
+Subject: {email_data['subject']}
+Date: {email_data['date']}
+
+{email_data['body']}"""
+
+def parse_sent_at(date: str) -> Optional[float]:
+    """Unix timestamp of an RFC 2822 (.eml) or ISO (.msg) date header, or None if it cannot be parsed"""
+    if not date:
+        return None
+    try:
+        sent_at = parsedate_to_datetime(date)
+    except (TypeError, ValueError):
+        try:
+            sent_at = datetime.fromisoformat(date.strip())
+        except ValueError:
+            return None
+    if sent_at.tzinfo is None:
+        sent_at = sent_at.replace(tzinfo=timezone.utc)
+    return sent_at.timestamp()
+
+def sender_address(sender: str) -> str:
+    """Lowercased address of a From header, or the lowercased header if it holds no address"""
+    return (parseaddr(sender)[1] or sender).strip().lower()
@@ -0,0 +1,335 @@
+import os
+import html
+import time
+import re
+import hashlib
+import sqlite3
+import asyncio
+import threading
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple
+from termcolor import colored
+from metrics import span
+from email_parser import parse_sent_at, sender_address
+from normalizer import normalize_email, normalization_fingerprint
+
+from dotenv import load_dotenv
+load_dotenv()
+
+EMAIL_STORE_PATH = Path(os.getenv("EMAIL_STORE_PATH", "cache/email_store.db"))
+SCHEMA_VERSION = 6  # Bump when the stored fields change; the store is rebuilt from the raw files
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Parsed email fields and the parsed_emails columns that store them
+EMAIL_COLUMNS = {
+    "from": "from_addr", "to": "to_addr", "subject": "subject", "date": "date", "body": "body",
+    "html_body": "html_body", "message_id": "message_id", "in_reply_to": "in_reply_to", "references": "reference_ids"
+}
+EMAIL_FIELDS = tuple(EMAIL_COLUMNS)
+LISTING_FIELDS = ("from", "to", "subject", "date", "sent_at", "raw_tokens", "tokens")
+SEARCH_FIELDS = {"from": "from_addr", "to": "to_addr"}  # Query field names that differ from the indexed columns
+SEARCH_WEIGHTS = "3.0, 1.0, 1.0, 0.5, 1.0"  # bm25 weights of subject, from, to, date and body
+SNIPPET_TOKENS = 16  # Tokens of context in each search snippet
+HIGHLIGHT_START, HIGHLIGHT_END = "\x02", "\x03"  # Marks around matches, swapped for <mark> after escaping
+
+def sender_filter(column: str, sender: str) -> Tuple[str, list]:
+    """SQL condition on a lowercased sender column: an exact address when sender has an "@", else a substring"""
+    sender = sender.strip().lower()
+    if "@" in sender and not sender.startswith("@"):
+        return f"{column} = ?", [sender]
+    return f"{column} LIKE ?", [f"%{sender}%"]
+
+def _search_term(match) -> str:
+    term = match.group(0)
+    if term.startswith('"'):
+        return term
+    field, colon, value = term.rpartition(":")
+    if colon and re.fullmatch(r"\w+", field):
+        field = SEARCH_FIELDS.get(field.lower(), field)
+    else:
+        field, value = "", term
+    # Addresses, domains and dates are not FTS5 barewords; searching them as phrases matches their parts in order
+    if value and not re.fullmatch(r"[\w*]+|\^\w+\*?", value):
+        value = f'"{value}"'
+    return f"{field}:{value}" if field else value
+
+def search_query(query: str) -> str:
+    """Adapt a user query to FTS5: from:/to: become the indexed column names and non-word terms are quoted"""
+    return re.sub(r'"[^"]*"?|[^\s"(),]+', _search_term, query)
+
+def highlight_snippet(snippet: str) -> str:
+    """HTML-escape a snippet and wrap its matches in <mark>"""
+    return html.escape((snippet or "").strip()).replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_END, "</mark>")
+
+def hash_file(file_path: Path) -> str:
+    """Return the SHA-256 hex digest of a file, read in fixed-size chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class EmailStore:
+    """SQLite index of parsed emails, validated against each file's size, mtime and content hash"""
+
+    def __init__(self, db_path: Path = EMAIL_STORE_PATH):
+        self.db_path = Path(db_path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # INSERT OR REPLACE must fire the delete trigger that removes the old row from the full-text index
+        self._conn.execute("PRAGMA recursive_triggers = ON")
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            print(colored("Email store schema changed, rebuilding index...", "yellow"))
+            self._conn.execute("DROP TABLE IF EXISTS email_fts")
+            self._conn.execute("DROP TABLE IF EXISTS parsed_emails")
+            self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS parsed_emails (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                from_addr TEXT,
+                to_addr TEXT,
+                subject TEXT,
+                date TEXT,
+                body TEXT,
+                html_body TEXT,
+                message_id TEXT,
+                in_reply_to TEXT,
+                reference_ids TEXT,
+                analysis_content TEXT,
+                raw_tokens INTEGER,
+                tokens INTEGER,
+                normalized_with TEXT,
+                sender TEXT,
+                sent_at REAL,
+                parsed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_parsed_emails_sha256 ON parsed_emails (sha256)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_parsed_emails_sender ON parsed_emails (sender)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_parsed_emails_sent_at ON parsed_emails (sent_at)")
+        # Full-text index over the stored headers and body, kept in sync by triggers
+        self._conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS email_fts USING fts5(
+                subject, from_addr, to_addr, date, body,
+                content='parsed_emails', content_rowid='id', tokenize='porter unicode61 remove_diacritics 2'
+            )
+        """)
+        self._conn.executescript("""
+            CREATE TRIGGER IF NOT EXISTS parsed_emails_fts_insert AFTER INSERT ON parsed_emails BEGIN
+                INSERT INTO email_fts (rowid, subject, from_addr, to_addr, date, body)
+                VALUES (new.id, new.subject, new.from_addr, new.to_addr, new.date, new.body);
+            END;
+            CREATE TRIGGER IF NOT EXISTS parsed_emails_fts_delete AFTER DELETE ON parsed_emails BEGIN
+                INSERT INTO email_fts (email_fts, rowid, subject, from_addr, to_addr, date, body)
+                VALUES ('delete', old.id, old.subject, old.from_addr, old.to_addr, old.date, old.body);
+            END;
+        """)
+        self._conn.commit()
+
+    @staticmethod
+    def _row_to_email(row) -> dict:
+        email_data = dict(zip(EMAIL_FIELDS, row[:len(EMAIL_FIELDS)]))
+        content_fields = row[len(EMAIL_FIELDS):len(EMAIL_FIELDS) + 3]
+        email_data["analysis_content"], email_data["raw_tokens"], email_data["tokens"] = content_fields
+        return email_data
+
+    def _fetch(self, path: str):
+        with self._lock:
+            return self._conn.execute(f"""
+                SELECT {", ".join(EMAIL_COLUMNS.values())}, analysis_content, raw_tokens, tokens, normalized_with,
+                       size, mtime_ns, sha256
+                FROM parsed_emails WHERE path = ?
+            """, (path,)).fetchone()
+
+    def _touch(self, path: str, size: int, mtime_ns: int):
+        with self._lock:
+            self._conn.execute("UPDATE parsed_emails SET size = ?, mtime_ns = ? WHERE path = ?", (size, mtime_ns, path))
+            self._conn.commit()
+
+    def _put(self, path: str, size: int, mtime_ns: int, sha256: str, email_data: dict):
+        with self._lock:
+            self._conn.execute(f"""
+                INSERT OR REPLACE INTO parsed_emails
+                (path, size, mtime_ns, sha256, {", ".join(EMAIL_COLUMNS.values())},
+                 analysis_content, raw_tokens, tokens, normalized_with, sender, sent_at, parsed_at)
+                VALUES ({", ".join("?" * (len(EMAIL_COLUMNS) + 11))})
+            """, (path, size, mtime_ns, sha256, *[email_data.get(field, "") for field in EMAIL_FIELDS],
+                  email_data["analysis_content"], email_data["raw_tokens"], email_data["tokens"],
+                  normalization_fingerprint(), sender_address(email_data.get("from", "")), parse_sent_at(email_data.get("date", "")), time.time()))
+            self._conn.commit()
+
+    def _put_content(self, path: str, email_data: dict):
+        with self._lock:
+            self._conn.execute("""
+                UPDATE parsed_emails SET analysis_content = ?, raw_tokens = ?, tokens = ?, normalized_with = ?
+                WHERE path = ?
+            """, (email_data["analysis_content"], email_data["raw_tokens"], email_data["tokens"],
+                  normalization_fingerprint(), path))
+            self._conn.commit()
+
+    def _delete(self, paths: list):
+        with self._lock:
+            self._conn.executemany("DELETE FROM parsed_emails WHERE path = ?", [(path,) for path in paths])
+            self._conn.commit()
+
+    def find_by_hash(self, sha256: str):
+        """Return the path of a stored email with this content hash whose file still exists, or None"""
+        with self._lock:
+            rows = self._conn.execute("SELECT path FROM parsed_emails WHERE sha256 = ?", (sha256,)).fetchall()
+        for (path,) in rows:
+            if Path(path).exists():
+                return path
+        return None
+
+    def _paths(self) -> list:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT path FROM parsed_emails")]
+
+    def _list(self, directory: str, conditions: List[str], params: list, offset: int, limit: int) -> Tuple[int, list]:
+        where = " AND ".join(["substr(path, 1, ?) = ?"] + conditions)
+        params = [len(directory), directory] + params
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) FROM parsed_emails WHERE {where}", params).fetchone()[0]
+            rows = self._conn.execute(f"""
+                SELECT path, from_addr, to_addr, subject, date, sent_at, raw_tokens, tokens FROM parsed_emails
+                WHERE {where} ORDER BY sent_at IS NULL, sent_at DESC, path LIMIT ? OFFSET ?
+            """, params + [limit, offset]).fetchall()
+        return total, rows
+
+    def _search(self, query: str, directory: str, conditions: List[str], params: list,
+                offset: int, limit: int) -> Tuple[int, list]:
+        where = " AND ".join(["email_fts MATCH ?", "substr(p.path, 1, ?) = ?"] + conditions)
+        params = [query, len(directory), directory] + params
+        with self._lock:
+            total = self._conn.execute(f"""
+                SELECT COUNT(*) FROM email_fts JOIN parsed_emails p ON p.id = email_fts.rowid WHERE {where}
+            """, params).fetchone()[0]
+            rows = self._conn.execute(f"""
+                SELECT p.id, p.path, p.from_addr, p.to_addr, p.subject, p.date, p.sent_at,
+                       bm25(email_fts, {SEARCH_WEIGHTS}) AS score
+                FROM email_fts JOIN parsed_emails p ON p.id = email_fts.rowid
+                WHERE {where} ORDER BY score LIMIT ? OFFSET ?
+            """, params + [limit, offset]).fetchall()
+            # Snippets only for the page: computed in the ranking query they would be built for every match
+            snippets = dict(self._conn.execute(f"""
+                SELECT rowid, snippet(email_fts, -1, ?, ?, '…', ?) FROM email_fts
+                WHERE email_fts MATCH ? AND rowid IN ({", ".join("?" * len(rows))})
+            """, [HIGHLIGHT_START, HIGHLIGHT_END, SNIPPET_TOKENS, query] + [row[0] for row in rows]).fetchall())
+        return total, [row[1:7] + (snippets.get(row[0]), row[7]) for row in rows]
+
+    def _clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM parsed_emails")
+            self._conn.commit()
+
+    async def get(self, file_path: Path, parser: Callable[[Path], Awaitable[dict]]) -> dict:
+        """Return the parsed email, re-parsing with parser only when the file changed"""
+        path = str(file_path)
+        stat = await asyncio.to_thread(os.stat, file_path)
+        row = await asyncio.to_thread(self._fetch, path)
+
+        size, mtime_ns, stored_sha256 = row[-3:] if row is not None else (None, None, None)
+        if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+            self.hits += 1
+            return await self._normalized(path, row)
+
+        sha256 = await asyncio.to_thread(hash_file, file_path)
+        if stored_sha256 == sha256:
+            # Touched but unchanged content: refresh the fingerprint and keep the parsed data
+            await asyncio.to_thread(self._touch, path, stat.st_size, stat.st_mtime_ns)
+            self.hits += 1
+            return await self._normalized(path, row)
+
+        self.misses += 1
+        print(colored(f"Parsing {file_path.name} into the email store...", "cyan"))
+        email_data = dict(await parser(file_path))
+        # Quoted history, signatures and boilerplate are stripped once here rather than on every analysis
+        with span("normalize"):
+            email_data.update(await asyncio.to_thread(normalize_email, email_data))
+        await asyncio.to_thread(self._put, path, stat.st_size, stat.st_mtime_ns, sha256, email_data)
+        return email_data
+
+    async def _normalized(self, path: str, row) -> dict:
+        """The stored email, normalized again if it was stored under other normalization settings"""
+        email_data = self._row_to_email(row)
+        if row[-4] != normalization_fingerprint():
+            with span("normalize"):
+                email_data.update(await asyncio.to_thread(normalize_email, email_data))
+            await asyncio.to_thread(self._put_content, path, email_data)
+        return email_data
+
+    async def list_emails(self, directory: Path, offset: int = 0, limit: int = 100, sender: Optional[str] = None,
+                          sent_after: Optional[float] = None, sent_before: Optional[float] = None) -> Tuple[int, List[dict]]:
+        """Return (matching count, one page of stored emails in directory), newest first, without their bodies"""
+        conditions, params = self._filters(sender, sent_after, sent_before)
+        directory = str(Path(directory)) + os.sep
+        total, rows = await asyncio.to_thread(self._list, directory, conditions, params, offset, limit)
+        return total, [{"filename": Path(row[0]).name, **dict(zip(LISTING_FIELDS, row[1:]))} for row in rows]
+
+    async def search(self, query: str, directory: Path, offset: int = 0, limit: int = 20, sender: Optional[str] = None,
+                     sent_after: Optional[float] = None, sent_before: Optional[float] = None) -> Tuple[int, List[dict]]:
+        """Return (matching count, one page of best matches) for an FTS5 query over subject, from, to, date and body
+
+        The query supports AND/OR/NOT, "phrases", prefix* terms, NEAR() and field filters such as subject:budget.
+        Raises ValueError for a malformed query.
+        """
+        conditions, params = self._filters(sender, sent_after, sent_before, prefix="p.")
+        directory = str(Path(directory)) + os.sep
+        try:
+            total, rows = await asyncio.to_thread(self._search, search_query(query), directory, conditions, params,
+                                                  offset, limit)
+        except sqlite3.OperationalError as e:
+            raise ValueError(f"Invalid search query: {str(e)}") from e
+        return total, [{
+            "filename": Path(row[0]).name,
+            **dict(zip(("from", "to", "subject", "date", "sent_at"), row[1:6])),
+            "snippet": highlight_snippet(row[6]),
+            "score": round(-row[7], 4)
+        } for row in rows]
+
+    @staticmethod
+    def _filters(sender: Optional[str], sent_after: Optional[float], sent_before: Optional[float],
+                 prefix: str = "") -> Tuple[List[str], list]:
+        conditions, params = [], []
+        if sender:
+            condition, condition_params = sender_filter(f"{prefix}sender", sender)
+            conditions.append(condition)
+            params += condition_params
+        if sent_after is not None:
+            conditions.append(f"{prefix}sent_at >= ?")
+            params.append(sent_after)
+        if sent_before is not None:
+            conditions.append(f"{prefix}sent_at < ?")
+            params.append(sent_before)
+        return conditions, params
+
+    async def invalidate(self, file_paths: Iterable[Path]):
+        """Forget the parsed data for the given files"""
+        await asyncio.to_thread(self._delete, [str(path) for path in file_paths])
+
+    async def prune_missing(self) -> int:
+        """Drop entries whose files no longer exist on disk"""
+        missing = [path for path in await asyncio.to_thread(self._paths) if not Path(path).exists()]
+        if missing:
+            await asyncio.to_thread(self._delete, missing)
+            print(colored(f"Removed {len(missing)} deleted emails from the email store", "yellow"))
+        return len(missing)
+
+    async def clear(self):
+        """Remove every parsed email"""
+        await asyncio.to_thread(self._clear)
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the number of stored emails"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM parsed_emails").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
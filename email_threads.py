@@ -0,0 +1,217 @@
+import os
+import re
+import hashlib
+from dataclasses import dataclass, field
+from typing import Dict, List
+from termcolor import colored
+from analysis_schema import EmailAnalysis, Match
+from email_parser import parse_sent_at
+from token_utils import estimate_tokens, pack_by_tokens
+
+from dotenv import load_dotenv
+load_dotenv()
+
+THREAD_TOKEN_BUDGET = int(os.getenv("THREAD_TOKEN_BUDGET", 8000))  # Max tokens of thread content per LLM request
+SIMHASH_MAX_DISTANCE = int(os.getenv("SIMHASH_MAX_DISTANCE", 6))  # Differing bits that still count as a duplicate
+SIMHASH_BITS = 64
+SHINGLE_WORDS = 3
+SIMHASH_MIN_WORDS = 20  # Shorter bodies ("Thanks!") are identical across unrelated emails, so never collapsed
+MIN_SUBJECT_CHARS = 8  # Shorter normalized subjects ("hi", "update") are too generic to link emails by
+THREAD_FIELDS = ("message_id", "in_reply_to", "references")  # Headers that link a reply to earlier messages
+
+SUBJECT_PREFIX = re.compile(r"^\s*((re|fwd?|fw|aw|sv|wg)\s*(\[\d+\])?\s*:|\[[^\]]{1,30}\])\s*", re.IGNORECASE)
+MESSAGE_ID = re.compile(r"<[^<>\s]+>")
+
+# Threads and near duplicates over the emails of one analysis. Replies quote what came before, so a thread's
+# members are cut down to the lines no earlier member already contained, analyzed together once, and the
+# findings are mapped back to the member each matched snippet came from.
+
+@dataclass
+class ThreadPlan:
+    units: List[List[int]]  # Email indices analyzed by one request; several indices when they form a thread
+    duplicate_of: Dict[int, int] = field(default_factory=dict)  # Near duplicate -> the email analyzed instead
+    thread_of: Dict[int, int] = field(default_factory=dict)  # Email -> thread id (its earliest member's index)
+
+def normalize_subject(subject: str) -> str:
+    """Subject without Re:/Fwd:/[tag] prefixes, lowercased and with collapsed whitespace"""
+    subject = subject or ""
+    while True:
+        stripped = SUBJECT_PREFIX.sub("", subject, count=1)
+        if stripped == subject:
+            break
+        subject = stripped
+    return " ".join(subject.lower().split())
+
+def message_ids(value: str) -> List[str]:
+    return [message_id.lower() for message_id in MESSAGE_ID.findall(value or "")]
+
+def _body(content: str) -> str:
+    # analysis_content is headers, a blank line, then the body
+    return content.split("\n\n", 1)[1] if "\n\n" in content else ""
+
+def simhash(text: str) -> int:
+    """64-bit SimHash of the distinct word shingles of text"""
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    # Count the set bits of every position at once: planes[k] holds bit k of all 64 per-position counters
+    planes = []
+    for shingle in shingles:
+        carry = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for k in range(len(planes)):
+            planes[k], carry = planes[k] ^ carry, planes[k] & carry
+            if not carry:
+                break
+        if carry:
+            planes.append(carry)
+    fingerprint = 0
+    for bit in range(SIMHASH_BITS):
+        ones = sum((plane >> bit & 1) << k for k, plane in enumerate(planes))
+        if 2 * ones > len(shingles):
+            fingerprint |= 1 << bit
+    return fingerprint
+
+def near_duplicates(texts: Dict[int, str], max_distance: int = SIMHASH_MAX_DISTANCE) -> Dict[int, int]:
+    """Map each near-duplicate index to the first index (in key order) it duplicates"""
+    # With max_distance + 1 bands, two fingerprints that close agree exactly on at least one band
+    bands = max_distance + 1
+    band_bits = SIMHASH_BITS // bands
+    band_mask = (1 << band_bits) - 1
+    buckets: Dict[tuple, List[int]] = {}
+    hashes = {}
+    duplicate_of = {}
+    for index, text in texts.items():
+        if len(re.findall(r"\w+", text)) < SIMHASH_MIN_WORDS:
+            continue
+        hashes[index] = simhash(text)
+        keys = [(band, hashes[index] >> (band * band_bits) & band_mask) for band in range(bands)]
+        original = next((
+            candidate
+            for key in keys for candidate in buckets.get(key, [])
+            if bin(hashes[index] ^ hashes[candidate]).count("1") <= max_distance
+        ), None)
+        if original is not None:
+            duplicate_of[index] = original
+            continue
+        for key in keys:
+            buckets.setdefault(key, []).append(index)
+    return duplicate_of
+
+class _UnionFind:
+    def __init__(self, items):
+        self.parent = {item: item for item in items}
+
+    def find(self, item):
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, a, b):
+        self.parent[self.find(a)] = self.find(b)
+
+def build_threads(emails: List[dict], indices: List[int]) -> List[List[int]]:
+    """Group emails into threads by Message-ID/In-Reply-To/References, then by reply subject; oldest first"""
+    groups = _UnionFind(indices)
+    by_message_id = {}
+    for index in indices:
+        for message_id in message_ids(emails[index].get("message_id")):
+            by_message_id.setdefault(message_id, index)
+    for index in indices:
+        email = emails[index]
+        for message_id in message_ids(email.get("in_reply_to")) + message_ids(email.get("references")):
+            if message_id in by_message_id:
+                groups.union(index, by_message_id[message_id])
+
+    # Replies whose headers were lost (e.g. .msg exports) join the thread of the same normalized subject
+    by_subject = {}
+    for index in indices:
+        subject = emails[index].get("subject") or ""
+        normalized = normalize_subject(subject)
+        if len(normalized) < MIN_SUBJECT_CHARS:
+            continue
+        if normalized in by_subject and (SUBJECT_PREFIX.match(subject) or
+                                         SUBJECT_PREFIX.match(emails[by_subject[normalized]].get("subject") or "")):
+            groups.union(index, by_subject[normalized])
+        by_subject.setdefault(normalized, index)
+
+    threads: Dict[int, List[int]] = {}
+    for index in indices:
+        threads.setdefault(groups.find(index), []).append(index)
+    order = lambda index: (parse_sent_at(emails[index].get("date") or "") or 0, index)
+    return [sorted(members, key=order) for members in threads.values()]
+
+def unique_lines(texts: List[str]) -> List[str]:
+    """Each text without the lines an earlier text already contained"""
+    seen = set()
+    result = []
+    for text in texts:
+        kept = []
+        for line in text.split("\n"):
+            key = " ".join(line.lower().split())
+            if key and key in seen:
+                continue
+            seen.add(key)
+            kept.append(line)
+        result.append("\n".join(kept).strip())
+    return result
+
+def plan_threads(emails: List[dict], indices: List[int], model: str = "gpt-4o") -> ThreadPlan:
+    """Collapse near duplicates and group the rest into threads of requests within THREAD_TOKEN_BUDGET"""
+    duplicate_of = near_duplicates({index: _body(emails[index]["content"]) for index in indices})
+    originals = [index for index in indices if index not in duplicate_of]
+    plan = ThreadPlan(units=[], duplicate_of=duplicate_of)
+    for members in build_threads(emails, originals):
+        for index in members:
+            plan.thread_of[index] = members[0]
+        # Long threads are analyzed in consecutive chunks that each fit the budget
+        plan.units.extend(pack_by_tokens(
+            members, lambda index: estimate_tokens(emails[index]["content"], model), THREAD_TOKEN_BUDGET
+        ))
+    for duplicate, original in duplicate_of.items():
+        plan.thread_of[duplicate] = plan.thread_of.get(original, original)
+    threads = sum(1 for unit in plan.units if len(unit) > 1)
+    print(colored(f"Threading: {len(duplicate_of)} near duplicates collapsed, "
+                  f"{len(originals)} emails in {len(plan.units)} requests ({threads} multi-email threads)", "blue"))
+    return plan
+
+def thread_document(emails: List[dict], members: List[int]) -> tuple:
+    """Return (text of the thread for one analysis, each member's headers and unique body)"""
+    split = [emails[index]["content"].split("\n\n", 1) for index in members]
+    bodies = unique_lines([parts[1] if len(parts) > 1 else "" for parts in split])
+    member_texts = [f"{parts[0]}\n\n{body}" for parts, body in zip(split, bodies)]
+    sections = [
+        f"### Message {number} of {len(members)}\n{text}"
+        for number, text in enumerate(member_texts, start=1)
+    ]
+    return "\n\n".join(sections), member_texts
+
+def _normalized(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+def _owner(snippet: str, member_texts: List[str]) -> int:
+    """Position of the member whose text contains the snippet, or shares most of its words"""
+    needle = _normalized(snippet)
+    normalized = [_normalized(text) for text in member_texts]
+    for position, text in enumerate(normalized):
+        if needle and needle in text:
+            return position
+    words = set(needle.split())
+    overlaps = [len(words & set(text.split())) for text in normalized]
+    return max(range(len(member_texts)), key=lambda position: (overlaps[position], position))
+
+def split_thread_analysis(analysis: EmailAnalysis, member_texts: List[str],
+                          search_terms: List[str]) -> List[EmailAnalysis]:
+    """Map one thread analysis back to its members: each gets the matches quoted from its own text"""
+    member_matches: List[Dict[str, List[Match]]] = [{term: [] for term in search_terms} for _ in member_texts]
+    for term in search_terms:
+        for match in analysis.semantic_matches.get(term) or []:
+            member_matches[_owner(match.text, member_texts)][term].append(match)
+    results = []
+    for matches in member_matches:
+        found = any(matches.values())
+        results.append(EmailAnalysis(
+            semantic_matches=matches,
+            overall_relevance_score=analysis.overall_relevance_score if found else 0,
+            key_insights=list(analysis.key_insights) if found else []
+        ))
+    return results
@@ -0,0 +1,326 @@
+import os
+import json
+import orjson
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+from termcolor import colored
+from analysis_schema import coerce_analysis
+from email_parser import parse_sent_at, sender_address
+from email_store import sender_filter
+
+from dotenv import load_dotenv
+load_dotenv()
+
+JOBS_DB_PATH = Path(os.getenv("JOBS_DB_PATH", "cache/jobs.db"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 1))  # Jobs run at once; each job runs its own concurrent LLM calls
+
+# Job and email states
+QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED = "queued", "running", "completed", "failed", "cancelled"
+PENDING, DONE = "pending", "done"
+
+# Columns added to job_emails after the first release, with their types, for databases created before them
+JOB_EMAIL_FILTER_COLUMNS = {"sender": "TEXT", "sent_at": "REAL", "relevance_score": "INTEGER", "matched": "INTEGER"}
+RESULT_ORDERS = {"position": "position", "score": "relevance_score DESC, position"}
+
+# Runs the analysis for (job emails, search terms, options) and yields (position, result) as each finishes
+AnalyzeFn = Callable[[List[dict], List[str], dict], AsyncIterator[Tuple[int, dict]]]
+# Reloads the content of job emails by filename before a job (re)starts
+LoadFn = Callable[[List[dict]], Awaitable[List[dict]]]
+
+class JobManager:
+    """Persistent background queue for analysis jobs with progress, partial results and cancellation"""
+
+    def __init__(self, analyze: AnalyzeFn, load_emails: LoadFn, db_path: Path = JOBS_DB_PATH,
+                 workers: int = JOB_WORKERS):
+        self.analyze = analyze
+        self.load_emails = load_emails
+        self.db_path = Path(db_path)
+        self.num_workers = max(1, workers)
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._running: dict = {}  # job_id -> asyncio.Task
+        self._cancel_requested = set()
+        self._lock = threading.Lock()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                search_terms TEXT NOT NULL,
+                options TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                completed INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_emails (
+                job_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                subject TEXT,
+                status TEXT NOT NULL,
+                result TEXT,
+                completed_at REAL,
+                PRIMARY KEY (job_id, position)
+            )
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(job_emails)")}
+        for column, column_type in JOB_EMAIL_FILTER_COLUMNS.items():
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE job_emails ADD COLUMN {column} {column_type}")
+        # One row per (result, term with matches), so results can be filtered by term through an index
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_email_terms (
+                job_id TEXT NOT NULL,
+                term TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                PRIMARY KEY (job_id, term, position)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_job_emails_status ON job_emails (job_id, status)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_job_emails_score ON job_emails (job_id, relevance_score)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_job_emails_sender ON job_emails (job_id, sender)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_job_emails_sent_at ON job_emails (job_id, sent_at)")
+        self._conn.commit()
+
+    def _execute(self, query: str, params: tuple = ()):
+        with self._lock:
+            self._conn.execute(query, params)
+            self._conn.commit()
+
+    def _query(self, query: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    async def start(self):
+        """Start the worker pool and re-queue jobs left unfinished by a previous run"""
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+        unfinished = await asyncio.to_thread(
+            self._query, "SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)
+        )
+        for (job_id,) in unfinished:
+            await asyncio.to_thread(self._set_status, job_id, QUEUED)
+            self._queue.put_nowait(job_id)
+        if unfinished:
+            print(colored(f"Resuming {len(unfinished)} unfinished analysis jobs", "yellow"))
+
+    async def stop(self):
+        """Stop the workers; running jobs stay resumable"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def _set_status(self, job_id: str, status: str, error: Optional[str] = None):
+        self._execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                      (status, error, time.time(), job_id))
+
+    async def submit(self, emails: List[dict], search_terms: List[str], options: dict,
+                     precomputed: Optional[dict] = None) -> str:
+        """Persist a new job and queue it; precomputed maps email positions to results known up front"""
+        job_id = uuid.uuid4().hex
+        precomputed = precomputed or {}
+        now = time.time()
+
+        def insert():
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, status, search_terms, options, total, completed, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, QUEUED, json.dumps(search_terms), json.dumps(options), len(emails), len(precomputed), now, now)
+                )
+                self._conn.executemany(
+                    "INSERT INTO job_emails (job_id, position, filename, subject, status, sender, sent_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(job_id, i, email["filename"], email["subject"], PENDING,
+                      sender_address(email.get("from") or ""), parse_sent_at(email.get("date") or ""))
+                     for i, email in enumerate(emails)]
+                )
+                for position, result in precomputed.items():
+                    self._store_result(job_id, position, result, now)
+                self._conn.commit()
+
+        await asyncio.to_thread(insert)
+        self._queue.put_nowait(job_id)
+        print(colored(f"Queued analysis job {job_id} with {len(emails)} emails", "blue"))
+        return job_id
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            task = asyncio.create_task(self._run_job(job_id))
+            self._running[job_id] = task
+            try:
+                await task
+            except asyncio.CancelledError:
+                # Re-raise only when the worker itself is stopping, not when the job was cancelled
+                if job_id not in self._cancel_requested:
+                    raise
+            finally:
+                self._running.pop(job_id, None)
+                self._cancel_requested.discard(job_id)
+
+    async def _run_job(self, job_id: str):
+        rows = await asyncio.to_thread(self._query, "SELECT status, search_terms, options FROM jobs WHERE id = ?", (job_id,))
+        if not rows or rows[0][0] != QUEUED:
+            return
+        search_terms, options = json.loads(rows[0][1]), json.loads(rows[0][2])
+
+        pending = await asyncio.to_thread(
+            self._query,
+            "SELECT position, filename, subject FROM job_emails WHERE job_id = ? AND status = ? ORDER BY position",
+            (job_id, PENDING)
+        )
+        await asyncio.to_thread(self._set_status, job_id, RUNNING)
+        print(colored(f"Running analysis job {job_id}: {len(pending)} emails pending", "blue"))
+
+        try:
+            loaded = await self.load_emails([
+                {"position": position, "filename": filename, "subject": subject}
+                for position, filename, subject in pending
+            ])
+            # Emails that can no longer be read are recorded as failed instead of aborting the job
+            emails = []
+            for email in loaded:
+                if "error" in email:
+                    await asyncio.to_thread(self._record_result, job_id, email["position"], {
+                        "filename": email["filename"],
+                        "subject": email["subject"],
+                        "analysis": None,
+                        "error": email["error"]
+                    })
+                else:
+                    emails.append(email)
+
+            async for index, result in self.analyze(emails, search_terms, options):
+                await asyncio.to_thread(self._record_result, job_id, emails[index]["position"], result)
+            await asyncio.to_thread(self._set_status, job_id, COMPLETED)
+            print(colored(f"✓ Analysis job {job_id} completed", "green"))
+        except asyncio.CancelledError:
+            # A server shutdown leaves the job running so the next start resumes it
+            if job_id in self._cancel_requested:
+                await asyncio.to_thread(self._set_status, job_id, CANCELLED)
+                print(colored(f"Analysis job {job_id} cancelled", "yellow"))
+            raise
+        except Exception as e:
+            print(colored(f"Error in analysis job {job_id}: {str(e)}", "red"))
+            await asyncio.to_thread(self._set_status, job_id, FAILED, str(e))
+
+    def _store_result(self, job_id: str, position: int, result: dict, completed_at: float):
+        """Write one result with its filter columns; the caller holds the lock and commits"""
+        analysis = coerce_analysis(result.get("analysis"))
+        terms = [term for term, matches in analysis.semantic_matches.items() if matches] if analysis else []
+        self._conn.execute(
+            "UPDATE job_emails SET status = ?, result = ?, completed_at = ?, relevance_score = ?, matched = ? "
+            "WHERE job_id = ? AND position = ?",
+            (DONE, orjson.dumps(result).decode(), completed_at,
+             analysis.overall_relevance_score if analysis else None, 1 if terms else 0, job_id, position)
+        )
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO job_email_terms (job_id, term, position) VALUES (?, ?, ?)",
+            [(job_id, term, position) for term in terms]
+        )
+
+    def _record_result(self, job_id: str, position: int, result: dict):
+        with self._lock:
+            self._store_result(job_id, position, result, time.time())
+            self._conn.execute(
+                "UPDATE jobs SET completed = completed + 1, updated_at = ? WHERE id = ?", (time.time(), job_id)
+            )
+            self._conn.commit()
+
+    async def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job; finished results are kept"""
+        status = await self.get_status(job_id)
+        if status is None or status["status"] not in (QUEUED, RUNNING):
+            return False
+        task = self._running.get(job_id)
+        if task is not None:
+            self._cancel_requested.add(job_id)
+            task.cancel()
+        await asyncio.to_thread(self._set_status, job_id, CANCELLED)
+        return True
+
+    def _job_to_dict(self, row) -> dict:
+        job_id, status, search_terms, options, total, completed, error, created_at, updated_at = row
+        return {
+            "job_id": job_id,
+            "status": status,
+            "search_terms": json.loads(search_terms),
+            "options": json.loads(options),
+            "total": total,
+            "completed": completed,
+            "progress": round(completed / total, 4) if total else 1.0,
+            "error": error,
+            "created_at": created_at,
+            "updated_at": updated_at
+        }
+
+    async def get_status(self, job_id: str) -> Optional[dict]:
+        """Return a job's status and progress, or None if it does not exist"""
+        rows = await asyncio.to_thread(self._query, "SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return self._job_to_dict(rows[0]) if rows else None
+
+    async def list_jobs(self, limit: int = 50) -> List[dict]:
+        """Return the most recent jobs"""
+        rows = await asyncio.to_thread(self._query, "SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))
+        return [self._job_to_dict(row) for row in rows]
+
+    @staticmethod
+    def _result_filters(job_id: str, filters: dict) -> Tuple[str, list]:
+        conditions, params = ["job_id = ?", "status = ?"], [job_id, DONE]
+        if filters.get("term"):
+            conditions.append("position IN (SELECT position FROM job_email_terms WHERE job_id = ? AND term = ?)")
+            params += [job_id, filters["term"]]
+        if filters.get("matched") is not None:
+            conditions.append("matched = ?")
+            params.append(1 if filters["matched"] else 0)
+        if filters.get("min_score") is not None:
+            conditions.append("relevance_score >= ?")
+            params.append(filters["min_score"])
+        if filters.get("max_score") is not None:
+            conditions.append("relevance_score <= ?")
+            params.append(filters["max_score"])
+        if filters.get("sender"):
+            condition, condition_params = sender_filter("sender", filters["sender"])
+            conditions.append(condition)
+            params += condition_params
+        if filters.get("sent_after") is not None:
+            conditions.append("sent_at >= ?")
+            params.append(filters["sent_after"])
+        if filters.get("sent_before") is not None:
+            conditions.append("sent_at < ?")
+            params.append(filters["sent_before"])
+        return " AND ".join(conditions), params
+
+    async def get_results(self, job_id: str, offset: int = 0, limit: int = 100, order: str = "position",
+                          **filters) -> List[dict]:
+        """Return finished results of a job in input order, or by relevance with order="score"
+
+        filters: term, matched, min_score, max_score, sender, sent_after and sent_before (unix timestamps).
+        """
+        where, params = self._result_filters(job_id, filters)
+        rows = await asyncio.to_thread(
+            self._query,
+            f"SELECT result FROM job_emails WHERE {where} ORDER BY {RESULT_ORDERS[order]} LIMIT ? OFFSET ?",
+            (*params, limit, offset)
+        )
+        return [orjson.loads(row[0]) for row in rows]
+
+    async def count_results(self, job_id: str, **filters) -> int:
+        """Number of finished results matching the get_results filters"""
+        where, params = self._result_filters(job_id, filters)
+        rows = await asyncio.to_thread(self._query, f"SELECT COUNT(*) FROM job_emails WHERE {where}", tuple(params))
+        return rows[0][0]
@@ -0,0 +1,282 @@
+import os
+import re
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
+from typing import Optional
+import openai
+from openai import AsyncOpenAI
+from termcolor import colored
+from metrics import span, record_llm_usage
+
+from dotenv import load_dotenv
+load_dotenv()
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 6))  # Retries per call after the first attempt
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 1.0))  # Seconds; doubled on every retry
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", 60.0))  # Upper bound for a single backoff sleep
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 120.0))  # Seconds per HTTP request
+LLM_INITIAL_CONCURRENCY = int(os.getenv("LLM_INITIAL_CONCURRENCY", 10))  # Starting AIMD limit
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 50))  # AIMD never grows past this
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", 5))  # Consecutive failures that open the circuit
+LLM_CIRCUIT_RESET_SECONDS = float(os.getenv("LLM_CIRCUIT_RESET_SECONDS", 30.0))  # Open time before a trial call
+LLM_CIRCUIT_MAX_WAIT = float(os.getenv("LLM_CIRCUIT_MAX_WAIT", 300.0))  # Longest a call waits for an open circuit
+CIRCUIT_TRIAL_POLL_SECONDS = 0.5  # How often calls waiting on a half-open trial check whether it finished
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    """Raised without calling the API when the circuit breaker stays open longer than a call may wait"""
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parse rate-limit reset values such as '20ms', '1.5s' or '6m0s' into seconds"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """Read how long the server asked us to wait from retry-after-ms or retry-after (seconds or HTTP date)"""
+    if headers is None:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except Exception:
+            return None
+
+class AdaptiveConcurrency:
+    """AIMD limit on in-flight calls: grows by one per window of successes, halves on rate limiting"""
+
+    def __init__(self, initial: int = LLM_INITIAL_CONCURRENCY, maximum: int = LLM_MAX_CONCURRENCY):
+        self.maximum = max(1, maximum)
+        self.limit = float(min(max(1, initial), self.maximum))
+        self.in_flight = 0
+        self.paused_until = 0.0  # Shared pause requested by Retry-After or exhausted rate-limit headers
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout=pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                await self._condition.wait()
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_rate_limited(self, wait: float = 0.0):
+        now = time.monotonic()
+        # One burst of 429s from calls already in flight only halves the limit once
+        if now - self._last_decrease > 1.0:
+            self.limit = max(1.0, self.limit / 2)
+            self._last_decrease = now
+        self.pause(wait)
+
+    def pause(self, seconds: float):
+        if seconds > 0:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class CircuitBreaker:
+    """Fails fast after repeated consecutive failures, then lets one trial call through after a cool-down"""
+
+    def __init__(self, failure_threshold: int = LLM_CIRCUIT_FAILURES, reset_seconds: float = LLM_CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    async def before_call(self, max_wait: float = LLM_CIRCUIT_MAX_WAIT) -> bool:
+        """Wait while the circuit is open; returns True if this call is the half-open trial
+
+        Raises CircuitOpenError if the circuit is still open after max_wait seconds.
+        """
+        deadline = time.monotonic() + max_wait
+        while True:
+            state = self.state
+            if state == "closed":
+                return False
+            if state == "half-open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            now = time.monotonic()
+            if now >= deadline:
+                raise CircuitOpenError(f"LLM circuit breaker stayed open for {max_wait:.0f}s after "
+                                       f"{self.failures} consecutive failures")
+            # Open: sleep until the trial is due; half-open: check again once the trial may have finished
+            wait = self.reset_seconds - (now - self.opened_at) if state == "open" else CIRCUIT_TRIAL_POLL_SECONDS
+            await asyncio.sleep(min(max(wait, 0.01), deadline - now) + random.uniform(0, 0.05))
+
+    def on_success(self):
+        if self.opened_at is not None:
+            print(colored("LLM circuit breaker closed", "green"))
+        self.failures = 0
+        self.opened_at = None
+
+    def on_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                print(colored(f"LLM circuit breaker opened after {self.failures} consecutive failures", "red"))
+            self.opened_at = time.monotonic()
+
+    def end_call(self, trial: bool):
+        # Whatever the trial's outcome, a half-open breaker may let the next trial call through
+        if trial:
+            self._trial_in_flight = False
+
+class ResilientLLMClient:
+    """Chat completions with retries, backoff with jitter, header-driven rate limiting, AIMD and a circuit breaker"""
+
+    def __init__(self, client: Optional[AsyncOpenAI] = None, max_retries: int = LLM_MAX_RETRIES):
+        # The SDK's own retries are disabled so every attempt goes through the limiter and breaker
+        self.client = client or AsyncOpenAI(max_retries=0, timeout=LLM_REQUEST_TIMEOUT)
+        self.max_retries = max_retries
+        self.concurrency = AdaptiveConcurrency()
+        self.breaker = CircuitBreaker()
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, asyncio.TimeoutError)):
+            return True
+        if isinstance(error, openai.RateLimitError):
+            # An exhausted quota will not recover by waiting
+            return getattr(error, "code", None) != "insufficient_quota"
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in RETRYABLE_STATUS_CODES
+        return False
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return min(LLM_BACKOFF_MAX, retry_after) + random.uniform(0, LLM_BACKOFF_BASE)
+        return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))  # Full jitter
+
+    def _observe_rate_limit_headers(self, headers):
+        """Pause new calls until the window resets when the provider reports no requests or tokens left"""
+        if headers is None:
+            return
+        for resource in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{resource}")
+            if remaining is not None and remaining.strip() == "0":
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{resource}"))
+                if reset:
+                    self.concurrency.pause(reset)
+
+    async def _attempt(self, kwargs: dict):
+        create = self.client.chat.completions
+        raw_create = getattr(getattr(create, "with_raw_response", None), "create", None)
+        if raw_create is None:
+            return await create.create(**kwargs)
+        raw = await raw_create(**kwargs)
+        self._observe_rate_limit_headers(raw.headers)
+        return raw.parse()
+
+    async def create(self, **kwargs):
+        """Create a chat completion, retrying transient failures; raises once retries are exhausted"""
+        model = kwargs.get("model", "unknown")
+        with span("llm_call", model=model):
+            completion = await self._create_with_retries(kwargs)
+        record_llm_usage(model, getattr(completion, "usage", None))
+        return completion
+
+    async def _create_with_retries(self, kwargs: dict):
+        for attempt in range(self.max_retries + 1):
+            # Waiting out an open circuit does not use up an attempt
+            try:
+                trial = await self.breaker.before_call()
+            except CircuitOpenError as e:
+                self.failures += 1
+                print(colored(f"LLM call failed: {str(e)}", "red"))
+                raise
+            await self.concurrency.acquire()
+            try:
+                self.calls += 1
+                completion = await self._attempt(kwargs)
+            except Exception as e:
+                if not self._is_retryable(e):
+                    self.failures += 1
+                    raise
+
+                headers = getattr(getattr(e, "response", None), "headers", None)
+                retry_after = retry_after_seconds(headers)
+                if isinstance(e, openai.RateLimitError):
+                    # Rate limiting is the provider pacing us, not an outage, so it does not trip the breaker
+                    self.rate_limited += 1
+                    self.concurrency.on_rate_limited(retry_after or 0.0)
+                else:
+                    self.breaker.on_failure()
+
+                if attempt == self.max_retries:
+                    self.failures += 1
+                    print(colored(f"LLM call failed after {attempt + 1} attempts: {str(e)}", "red"))
+                    raise
+                delay = self._backoff(attempt, retry_after)
+                self.retries += 1
+                print(colored(f"LLM call failed ({type(e).__name__}), retry {attempt + 1}/{self.max_retries} "
+                              f"in {delay:.1f}s (concurrency limit {int(self.concurrency.limit)})", "yellow"))
+            else:
+                self.breaker.on_success()
+                self.concurrency.on_success()
+                return completion
+            finally:
+                self.breaker.end_call(trial)
+                await self.concurrency.release()
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        """Return call counters, the current AIMD limit and the circuit breaker state"""
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "failures": self.failures,
+            "concurrency_limit": int(self.concurrency.limit),
+            "in_flight": self.concurrency.in_flight,
+            "circuit": self.breaker.state
+        }
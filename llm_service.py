@@ -1,17 +1,30 @@
-from openai import AsyncOpenAI
 import os
-import json
-from typing import List, Dict
+import orjson
+import asyncio
+import dataclasses
+from typing import List, Dict, Optional, Tuple
 from termcolor import colored
-from prompts import EMAIL_ANALYSIS_SYSTEM_PROMPT, EMAIL_SUMMARY_SYSTEM_PROMPT, EMAIL_ANALYSIS_USER_PROMPT_TEMPLATE
+from prompts import (EMAIL_ANALYSIS_SYSTEM_PROMPT, EMAIL_SUMMARY_SYSTEM_PROMPT, EMAIL_ANALYSIS_USER_PROMPT_TEMPLATE,
+                     EMAIL_ANALYSIS_PACKED_USER_PROMPT_TEMPLATE, PACKED_EMAIL_TEMPLATE,
+                     EMAIL_CHUNK_SUMMARY_SYSTEM_PROMPT, EMAIL_CHUNK_SUMMARY_USER_PROMPT_TEMPLATE,
+                     EMAIL_SUMMARY_REDUCE_USER_PROMPT_TEMPLATE)
+from analysis_cache import AnalysisCache
+from analysis_schema import (EmailAnalysis, parse_analysis, coerce_analysis, dump_analysis, parse_matches,
+                             analysis_response_format, packed_response_format)
+from llm_client import ResilientLLMClient
+from token_utils import estimate_tokens, pack_by_tokens, truncate_to_tokens
 
 from dotenv import load_dotenv  
 load_dotenv()
 
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", 12000))  # Max input tokens per summary call
+SUMMARY_MAX_CONCURRENCY = int(os.getenv("SUMMARY_MAX_CONCURRENCY", 5))  # Chunk summaries run in parallel
+
 class LLMService:
     def __init__(self):
-        self.client = AsyncOpenAI()
+        self.client = ResilientLLMClient()  # Retries, backs off and adapts concurrency on rate limits
         self.MODEL = "gpt-4o"  # Using the specified model
+        self.cache = AnalysisCache()
 
     def extract_email_content(self, email_raw: str) -> Dict[str, str]:
         """Extract subject and body from email, removing headers"""
@@ -39,54 +52,291 @@ class LLMService:
                 "body": email_raw  # Fallback to using entire content
             }
 
-    async def analyze_email_content(self, email_content: str, search_terms: List[str]) -> dict:
-        """Analyze email content for semantic matches with search terms"""
+    def for_terms(self, analysis: EmailAnalysis, search_terms: List[str]) -> EmailAnalysis:
+        """Key a cached analysis by the requested terms; the cache key ignores term case and duplicates"""
+        matches_by_term = {self.cache.normalize_term(term): matches
+                           for term, matches in analysis.semantic_matches.items()}
+        return dataclasses.replace(analysis, semantic_matches={
+            term: matches_by_term.get(self.cache.normalize_term(term)) or [] for term in search_terms
+        })
+
+    async def _get_cached_analysis(self, cache_key: str, search_terms: List[str]) -> Optional[EmailAnalysis]:
+        """Return a cached analysis, treating cache failures and unreadable entries as misses"""
         try:
-            # Format the user prompt with the search terms and email content
-            user_prompt = EMAIL_ANALYSIS_USER_PROMPT_TEMPLATE.format(
-                search_terms=', '.join(search_terms),
-                email_content=email_content
-            )
-
-            completion = await self.client.chat.completions.create(
-                model=self.MODEL,
-                messages=[
-                    {"role": "system", "content": EMAIL_ANALYSIS_SYSTEM_PROMPT},
-                    {"role": "user", "content": user_prompt}
-                ],
-                response_format={"type": "json_object"}
-            )
-
-            return completion.choices[0].message.content
+            cached = coerce_analysis(await self.cache.get(cache_key))
+            if cached is not None:
+                print(colored("Analysis cache hit, skipping API call", "cyan"))
+                cached = self.for_terms(cached, search_terms)
+            return cached
+        except Exception as e:
+            print(colored(f"Warning: analysis cache lookup failed: {str(e)}", "yellow"))
+            return None
+
+    async def _cache_analysis(self, cache_key: str, result: EmailAnalysis):
+        """Store an analysis in the cache without failing the request on cache errors"""
+        try:
+            await self.cache.set(cache_key, dump_analysis(result))
+        except Exception as e:
+            print(colored(f"Warning: failed to store analysis in cache: {str(e)}", "yellow"))
+
+    def analysis_request(self, email_content: str, search_terms: List[str]) -> dict:
+        """Build the chat-completion parameters for analyzing one email; also used for batch files"""
+        user_prompt = EMAIL_ANALYSIS_USER_PROMPT_TEMPLATE.format(
+            search_terms=', '.join(search_terms),
+            email_content=email_content
+        )
+        return {
+            "model": self.MODEL,
+            "messages": [
+                {"role": "system", "content": EMAIL_ANALYSIS_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            "response_format": analysis_response_format(search_terms)
+        }
+
+    async def cached_term_results(self, content_key: str, search_terms: List[str]) -> Tuple[dict, List[str]]:
+        """Return ({normalized term: per-term result} from the cache, search terms still to analyze)"""
+        terms = list(dict.fromkeys(self.cache.normalize_term(term) for term in search_terms if term.strip()))
+        try:
+            term_results = await self.cache.get_terms(content_key, terms)
+        except Exception as e:
+            print(colored(f"Warning: term cache lookup failed: {str(e)}", "yellow"))
+            term_results = {}
+        missing = [term for term in dict.fromkeys(t.strip() for t in search_terms if t.strip())
+                   if self.cache.normalize_term(term) not in term_results]
+        return term_results, missing
+
+    def split_term_results(self, analysis: EmailAnalysis, search_terms: List[str]) -> dict:
+        """Split an analysis of search_terms into {normalized term: per-term result}"""
+        matches_by_term = {self.cache.normalize_term(term): matches
+                           for term, matches in analysis.semantic_matches.items()}
+        term_results = {}
+        for term in search_terms:
+            normalized = self.cache.normalize_term(term)
+            matches = matches_by_term.get(normalized) or []
+            term_results[normalized] = {
+                "matches": [{"text": match.text, "relevance": match.relevance} for match in matches],
+                # The score covers all terms of the call, so terms without matches do not inherit it
+                "score": analysis.overall_relevance_score if matches else 0,
+                "key_insights": analysis.key_insights
+            }
+        return term_results
+
+    async def store_term_results(self, content_key: str, analysis: EmailAnalysis, search_terms: List[str]) -> dict:
+        """Split an analysis of search_terms into per-term results and cache them"""
+        term_results = self.split_term_results(analysis, search_terms)
+        try:
+            await self.cache.set_terms([(content_key, term, result) for term, result in term_results.items()])
+        except Exception as e:
+            print(colored(f"Warning: failed to store term results in cache: {str(e)}", "yellow"))
+        return term_results
+
+    def merge_term_results(self, search_terms: List[str], term_results: dict) -> EmailAnalysis:
+        """Assemble the per-email analysis for search_terms from per-term results"""
+        analysis = EmailAnalysis(semantic_matches={})
+        for term in search_terms:
+            result = term_results.get(self.cache.normalize_term(term)) or {}
+            analysis.semantic_matches[term] = parse_matches(result.get("matches", []))
+            analysis.overall_relevance_score = max(analysis.overall_relevance_score, result.get("score", 0))
+            for insight in result.get("key_insights", []):
+                if insight not in analysis.key_insights:
+                    analysis.key_insights.append(insight)
+        return analysis
+
+    async def analyze_email_content(self, email_content: str, search_terms: List[str]) -> EmailAnalysis:
+        """Analyze email content for semantic matches with search terms
+
+        Results are cached per (email, term), so only terms this email was never analyzed for are requested.
+        """
+        try:
+            # Return the stored analysis if this email was already analyzed for these terms
+            cache_key = self.cache.make_key(email_content, search_terms, self.MODEL)
+            cached = await self._get_cached_analysis(cache_key, search_terms)
+            if cached is not None:
+                return cached
+
+            content_key = self.cache.make_content_key(email_content, self.MODEL)
+            term_results, missing = await self.cached_term_results(content_key, search_terms)
+            if missing:
+                if term_results:
+                    print(colored(f"Reusing {len(term_results)} cached terms, analyzing {len(missing)} new terms", "cyan"))
+                completion = await self.client.create(**self.analysis_request(email_content, missing))
+                analysis = parse_analysis(completion.choices[0].message.content)
+                term_results.update(await self.store_term_results(content_key, analysis, missing))
+
+            result = self.merge_term_results(search_terms, term_results)
+            await self._cache_analysis(cache_key, result)
+            return result
 
         except Exception as e:
             print(colored(f"Error in analyze_email_content: {str(e)}", "red"))
             raise
 
-    async def generate_summary(self, all_emails: List[str], search_terms: List[str]) -> str:
-        """Generate a summary of all emails focusing on semantic matches to search terms"""
+    async def _analyze_packed(self, email_contents: List[str], search_terms: List[str]) -> List[Optional[EmailAnalysis]]:
+        """Analyze several emails in one request; entries the response missed or mangled are None"""
+        email_ids = [f"email_{n + 1}" for n in range(len(email_contents))]
+        packed_emails = "\n\n".join(
+            PACKED_EMAIL_TEMPLATE.format(email_id=email_id, email_content=content)
+            for email_id, content in zip(email_ids, email_contents)
+        )
+        user_prompt = EMAIL_ANALYSIS_PACKED_USER_PROMPT_TEMPLATE.format(
+            search_terms=', '.join(search_terms),
+            emails=packed_emails,
+            email_ids=', '.join(email_ids)
+        )
+
+        print(colored(f"Analyzing {len(email_contents)} emails in one packed request...", "cyan"))
+        completion = await self.client.create(
+            model=self.MODEL,
+            messages=[
+                {"role": "system", "content": EMAIL_ANALYSIS_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            response_format=packed_response_format(email_ids, search_terms)
+        )
+
+        try:
+            packed_results = orjson.loads(completion.choices[0].message.content).get("results", {})
+        except Exception as e:
+            print(colored(f"Warning: could not parse packed analysis: {str(e)}", "yellow"))
+            packed_results = {}
+        if not isinstance(packed_results, dict):
+            packed_results = {}
+        return [coerce_analysis(packed_results.get(email_id)) for email_id in email_ids]
+
+    async def analyze_email_pack(self, email_contents: List[str], search_terms: List[str]) -> List[EmailAnalysis]:
+        """Analyze several emails in one request, falling back to per-email calls for invalid output"""
+        try:
+            results = [None] * len(email_contents)
+            cache_keys = [self.cache.make_key(content, search_terms, self.MODEL) for content in email_contents]
+            for i, cache_key in enumerate(cache_keys):
+                results[i] = await self._get_cached_analysis(cache_key, search_terms)
+
+            # Emails missing the same terms share a packed request for just those terms
+            content_keys, term_results, groups = {}, {}, {}
+            for i, result in enumerate(results):
+                if result is not None:
+                    continue
+                content_keys[i] = self.cache.make_content_key(email_contents[i], self.MODEL)
+                term_results[i], missing = await self.cached_term_results(content_keys[i], search_terms)
+                if missing:
+                    groups.setdefault(tuple(missing), []).append(i)
+                else:
+                    results[i] = self.merge_term_results(search_terms, term_results[i])
+                    await self._cache_analysis(cache_keys[i], results[i])
+
+            packed = set()
+            for missing, indices in groups.items():
+                if len(indices) < 2:
+                    continue
+                packed.update(indices)
+                analyses = await self._analyze_packed([email_contents[i] for i in indices], list(missing))
+                for i, analysis in zip(indices, analyses):
+                    if analysis is None:
+                        continue
+                    term_results[i].update(await self.store_term_results(content_keys[i], analysis, list(missing)))
+                    results[i] = self.merge_term_results(search_terms, term_results[i])
+                    await self._cache_analysis(cache_keys[i], results[i])
+
+            # Anything the packed response missed or mangled is analyzed on its own
+            fallback = [i for i, result in enumerate(results) if result is None]
+            if fallback:
+                if packed.intersection(fallback):
+                    print(colored(f"Falling back to per-email analysis for {len(packed.intersection(fallback))} "
+                                  f"emails", "yellow"))
+                fallback_results = await asyncio.gather(
+                    *[self.analyze_email_content(email_contents[i], search_terms) for i in fallback]
+                )
+                for i, result in zip(fallback, fallback_results):
+                    results[i] = result
+
+            return results
+
+        except Exception as e:
+            print(colored(f"Error in analyze_email_pack: {str(e)}", "red"))
+            raise
+
+    @staticmethod
+    def _analysis_digest(subject: str, analysis) -> Optional[str]:
+        """Condense a per-email analysis into the text used for summarization"""
+        analysis = coerce_analysis(analysis)
+        if analysis is None:
+            return None
+
+        lines = [f"Subject: {subject}", f"Relevance: {analysis.overall_relevance_score}"]
+        for term, matches in analysis.semantic_matches.items():
+            for match in matches:
+                if match.text:
+                    lines.append(f"- [{term}] {match.text}")
+        for insight in analysis.key_insights:
+            lines.append(f"* {insight}")
+        return "\n".join(lines)
+
+    async def _complete_text(self, system_prompt: str, user_prompt: str) -> str:
+        """Run a plain-text chat completion"""
+        completion = await self.client.create(
+            model=self.MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ]
+        )
+        return completion.choices[0].message.content.strip()
+
+    async def generate_summary(self, all_emails: List[str], search_terms: List[str],
+                               analyses: Optional[List[EmailAnalysis]] = None) -> str:
+        """Generate a summary of all emails with hierarchical map-reduce over token-bounded chunks
+
+        When per-email analyses are given they are summarized instead of the raw email bodies.
+        """
         try:
-            system_prompt = EMAIL_SUMMARY_SYSTEM_PROMPT.format(terms=', '.join(search_terms))
+            terms = ', '.join(search_terms)
+            system_prompt = EMAIL_SUMMARY_SYSTEM_PROMPT.format(terms=terms)
+            chunk_system_prompt = EMAIL_CHUNK_SUMMARY_SYSTEM_PROMPT.format(terms=terms)
             
-            # Process emails to extract subjects and bodies
+            # Process emails to extract subjects and bodies, preferring the compact analysis digests
             processed_emails = [self.extract_email_content(email) for email in all_emails]
+            formatted_emails = []
+            for i, email in enumerate(processed_emails):
+                digest = self._analysis_digest(email['subject'], analyses[i]) if analyses else None
+                formatted_emails.append(digest or f"Subject: {email['subject']}\n\nBody:\n{email['body']}")
             formatted_emails = [
-                f"Subject: {email['subject']}\n\nBody:\n{email['body']}"
-                for email in processed_emails
+                truncate_to_tokens(text, SUMMARY_CHUNK_TOKENS, self.MODEL) for text in formatted_emails
             ]
-            
-            user_prompt = f"Generate a semantic analysis summary for these emails:\n\n" + "\n---\n".join(formatted_emails)
-            
-            completion = await self.client.chat.completions.create(
-                model=self.MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ]
-            )
-            
-            return completion.choices[0].message.content.strip()
+
+            semaphore = asyncio.Semaphore(SUMMARY_MAX_CONCURRENCY)
+
+            async def summarize_chunk(chunk: List[str], part: int, total_parts: int) -> str:
+                async with semaphore:
+                    user_prompt = EMAIL_CHUNK_SUMMARY_USER_PROMPT_TEMPLATE.format(
+                        part=part, total_parts=total_parts, content="\n---\n".join(chunk)
+                    )
+                    return await self._complete_text(chunk_system_prompt, user_prompt)
+
+            def chunk(texts: List[str]) -> List[List[str]]:
+                return pack_by_tokens(texts, lambda text: estimate_tokens(text, self.MODEL), SUMMARY_CHUNK_TOKENS)
+
+            # Map: summarize chunks in parallel; reduce: repeat on the summaries until they fit one prompt
+            texts = formatted_emails
+            level = 0
+            while len(chunk(texts)) > 1:
+                chunks = chunk(texts)
+                level += 1
+                print(colored(f"Summary level {level}: summarizing {len(chunks)} chunks in parallel...", "cyan"))
+                summaries = await asyncio.gather(
+                    *[summarize_chunk(c, i + 1, len(chunks)) for i, c in enumerate(chunks)]
+                )
+                # Cap each summary so every reduce level packs several of them and the loop always converges
+                texts = [truncate_to_tokens(summary, SUMMARY_CHUNK_TOKENS // 4, self.MODEL) for summary in summaries]
+
+            if level == 0:
+                user_prompt = f"Generate a semantic analysis summary for these emails:\n\n" + "\n---\n".join(texts)
+            else:
+                user_prompt = EMAIL_SUMMARY_REDUCE_USER_PROMPT_TEMPLATE.format(summaries="\n---\n".join(texts))
+
+            print(colored("Generating final summary...", "cyan"))
+            return await self._complete_text(system_prompt, user_prompt)
             
         except Exception as e:
             print(colored(f"Error in LLM summary generation: {str(e)}", "red"))
-            raise 
\ No newline at end of file
+            raise
@@ -0,0 +1,179 @@
+import os
+import time
+import uuid
+import asyncio
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from termcolor import colored
+from metrics import span
+from upload_handler import (UploadResult, iter_mbox, iter_maildir, is_maildir, store_message,
+                            mailbox_message_name)
+
+from dotenv import load_dotenv
+load_dotenv()
+
+INGEST_ROOT = Path(os.getenv("INGEST_ROOT", "mail_imports"))  # Server-side mbox files and Maildirs /ingest may read
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 200))  # Messages written to disk per step, then indexed together
+INGEST_HISTORY_TTL_SECONDS = int(os.getenv("INGEST_HISTORY_TTL_SECONDS", 24 * 3600))  # Finished ingestions kept this long
+INGEST_HISTORY_MAX = int(os.getenv("INGEST_HISTORY_MAX", 100))  # Most finished ingestions kept; the oldest go first
+
+RUNNING, COMPLETED, FAILED, CANCELLED = "running", "completed", "failed", "cancelled"
+
+class MailboxIngestor:
+    """Streams server-side mbox files and Maildirs into uploaded emails in the background, tracking progress"""
+
+    def __init__(self, dest_dir: Path, find_duplicate: Callable[[str], Optional[str]],
+                 index_email: Callable[[Path], Awaitable[dict]], root: Path = INGEST_ROOT):
+        self.dest_dir = Path(dest_dir)
+        self.find_duplicate = find_duplicate
+        self.index_email = index_email
+        self.root = Path(root)
+        self._ingestions: Dict[str, dict] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._cancel_requested = set()
+
+    def resolve(self, path: str) -> Path:
+        """Return the mailbox path under the ingest root; anything outside it is a ValueError"""
+        root = self.root.resolve()
+        source = (root / path).resolve()
+        if source != root and root not in source.parents:
+            raise ValueError(f"Mailboxes must be under {self.root}")
+        if not source.exists():
+            raise FileNotFoundError(f"No mailbox at {path}")
+        if not (is_maildir(source) or (source.is_file() and source.suffix.lower() == ".mbox")):
+            raise ValueError(f"{path} is neither an .mbox file nor a Maildir (cur/new/tmp)")
+        return source
+
+    def _prune(self):
+        """Forget finished ingestions past INGEST_HISTORY_TTL_SECONDS, then the oldest above INGEST_HISTORY_MAX"""
+        finished = sorted((status for status in self._ingestions.values() if status["finished_at"] is not None),
+                          key=lambda status: status["finished_at"])
+        expired = [status for status in finished if time.time() - status["finished_at"] > INGEST_HISTORY_TTL_SECONDS]
+        excess = finished[len(expired):][:max(0, len(finished) - len(expired) - INGEST_HISTORY_MAX)]
+        for status in expired + excess:
+            del self._ingestions[status["ingestion_id"]]
+
+    def start(self, path: str) -> dict:
+        """Start ingesting a mailbox under the ingest root and return its status"""
+        source = self.resolve(path)
+        self._prune()
+        ingestion_id = uuid.uuid4().hex
+        self._ingestions[ingestion_id] = {
+            "ingestion_id": ingestion_id,
+            "source": path,
+            "format": "maildir" if source.is_dir() else "mbox",
+            "status": RUNNING,
+            "messages": 0,
+            "stored": 0,
+            "duplicates": 0,
+            "failed": 0,
+            "bytes_read": 0,
+            "total_bytes": None if source.is_dir() else source.stat().st_size,
+            "total_messages": None,
+            "progress": 0.0,
+            "error": None,
+            "started_at": time.time(),
+            "finished_at": None,
+            "elapsed_seconds": 0.0
+        }
+        self._tasks[ingestion_id] = asyncio.create_task(self._run(ingestion_id, source))
+        return self.get_status(ingestion_id)
+
+    def get_status(self, ingestion_id: str) -> Optional[dict]:
+        status = self._ingestions.get(ingestion_id)
+        return dict(status) if status is not None else None
+
+    def list_ingestions(self) -> List[dict]:
+        self._prune()
+        return sorted((dict(status) for status in self._ingestions.values()),
+                      key=lambda status: status["started_at"], reverse=True)
+
+    def cancel(self, ingestion_id: str) -> bool:
+        """Stop a running ingestion; messages stored so far are kept"""
+        task = self._tasks.get(ingestion_id)
+        if task is None or task.done():
+            return False
+        # Stopped between messages, so the mailbox is never closed under the worker thread
+        self._cancel_requested.add(ingestion_id)
+        return True
+
+    def _open(self, source: Path, status: dict):
+        if source.is_dir():
+            status["total_messages"] = sum(
+                1 for folder in ("new", "cur") for entry in os.scandir(source / folder) if entry.is_file()
+            )
+            return None, iter_maildir(source)
+        handle = open(source, 'rb')
+        return handle, iter_mbox(handle)
+
+    def _write_batch(self, messages, handle, result: UploadResult, status: dict) -> Tuple[List[Path], bool]:
+        """Store the next INGEST_BATCH_SIZE messages as .eml files, returning (their paths, whether the
+        mailbox is exhausted); runs in a worker thread"""
+        stored = []
+        exhausted = True
+        for count, message in enumerate(messages, start=1):
+            if status["ingestion_id"] in self._cancel_requested:
+                exhausted = False
+                break
+            status["messages"] += 1
+            path = store_message(message, mailbox_message_name(status["source"], status["messages"]), result)
+            if path is not None:
+                stored.append(path)
+            if count == INGEST_BATCH_SIZE:
+                exhausted = False
+                break
+        if handle is not None:
+            status["bytes_read"] = handle.tell()
+        status["duplicates"] += len(result.duplicates)
+        total, done = ((status["total_bytes"], status["bytes_read"]) if handle is not None
+                       else (status["total_messages"], status["messages"]))
+        status["progress"] = 1.0 if exhausted or not total else round(min(done / total, 0.9999), 4)
+        return stored, exhausted
+
+    async def _run(self, ingestion_id: str, source: Path):
+        status = self._ingestions[ingestion_id]
+        handle = None
+        print(colored(f"Ingesting {status['format']} mailbox {status['source']}...", "blue"))
+        try:
+            handle, messages = await asyncio.to_thread(self._open, source, status)
+            while ingestion_id not in self._cancel_requested:
+                # Duplicates from earlier batches are found in the email store, which has indexed them by now
+                result = UploadResult(self.dest_dir, self.find_duplicate)
+                with span("ingest_write", format=status["format"]):
+                    stored, exhausted = await asyncio.to_thread(self._write_batch, messages, handle, result, status)
+                if stored:
+                    # Index each batch as it lands so the emails are searchable before the mailbox is finished
+                    with span("ingest_index", format=status["format"]):
+                        parsed = await asyncio.gather(*[self.index_email(path) for path in stored],
+                                                      return_exceptions=True)
+                    for path, parse_result in zip(stored, parsed):
+                        if isinstance(parse_result, Exception):
+                            status["failed"] += 1
+                            print(colored(f"Warning: could not index {path.name}: {str(parse_result)}", "yellow"))
+                    status["stored"] += len(stored)
+                status["elapsed_seconds"] = round(time.time() - status["started_at"], 2)
+                print(colored(f"Ingested {status['messages']} messages from {status['source']} "
+                              f"({status['progress']:.0%})", "cyan"))
+                if exhausted:
+                    break
+            if ingestion_id in self._cancel_requested:
+                status["status"] = CANCELLED
+                print(colored(f"Ingestion of {status['source']} cancelled after {status['messages']} messages", "yellow"))
+            else:
+                status["status"] = COMPLETED
+                print(colored(f"✓ Ingested {status['source']}: {status['stored']} stored, "
+                              f"{status['duplicates']} duplicates, {status['failed']} failed", "green"))
+        except asyncio.CancelledError:
+            status["status"] = CANCELLED
+            raise
+        except Exception as e:
+            status["status"] = FAILED
+            status["error"] = str(e)
+            print(colored(f"Error ingesting {status['source']}: {str(e)}", "red"))
+        finally:
+            if handle is not None:
+                handle.close()
+            status["finished_at"] = time.time()
+            status["elapsed_seconds"] = round(status["finished_at"] - status["started_at"], 2)
+            self._tasks.pop(ingestion_id, None)
+            self._cancel_requested.discard(ingestion_id)
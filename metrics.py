@@ -0,0 +1,279 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+from termcolor import colored
+
+from dotenv import load_dotenv
+load_dotenv()
+
+METRICS_PREFIX = "email_analyser"
+LOG_SPANS = os.getenv("LOG_SPANS", "false").lower() == "true"  # Also print every finished span
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.1))  # Seconds between event-loop lag probes
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+COST_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+# USD per million (prompt, completion) tokens, used for cost estimates only
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def _label_key(labels: dict) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metric:
+    """Base class for a named metric family with label sets"""
+    type_name = ""
+
+    def __init__(self, name: str, description: str):
+        self.name = f"{METRICS_PREFIX}_{name}"
+        self.description = description
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self.values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in self.values.items()]
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[LabelKey, list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self.series.setdefault(key, [0] * (len(self.buckets) + 2))
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, series in self.series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+class Registry:
+    """Holds every metric plus collectors that refresh gauges from other components at scrape time"""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format"""
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(colored(f"Warning: metrics collector failed: {str(e)}", "yellow"))
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+SPAN_SECONDS = registry.register(Histogram("span_duration_seconds", "Duration of instrumented operations"))
+SPAN_ERRORS = registry.register(Counter("span_errors_total", "Instrumented operations that raised"))
+IN_FLIGHT = registry.register(Gauge("in_flight", "Instrumented operations currently running"))
+HTTP_SECONDS = registry.register(Histogram("http_request_duration_seconds", "HTTP request latency by route"))
+HTTP_REQUESTS = registry.register(Counter("http_requests_total", "HTTP requests by route and status"))
+LLM_TOKENS = registry.register(Counter("llm_tokens_total", "Tokens reported by the API usage field"))
+LLM_CALL_TOKENS = registry.register(Histogram("llm_call_tokens", "Prompt and completion tokens per LLM call",
+                                              buckets=TOKEN_BUCKETS))
+LLM_COST = registry.register(Counter("llm_cost_usd_total", "Estimated LLM spend in USD"))
+REQUEST_COST = registry.register(Histogram("http_request_llm_cost_usd", "Estimated LLM spend per HTTP request",
+                                           buckets=COST_BUCKETS))
+CACHE_HITS = registry.register(Gauge("cache_hits", "Cache hits since start"))
+CACHE_MISSES = registry.register(Gauge("cache_misses", "Cache misses since start"))
+CACHE_HIT_RATE = registry.register(Gauge("cache_hit_rate", "Cache hit rate since start"))
+CACHE_ENTRIES = registry.register(Gauge("cache_entries", "Entries currently stored in each cache"))
+EVENT_LOOP_LAG = registry.register(Histogram("event_loop_lag_seconds", "Delay of a periodic event-loop probe",
+                                             buckets=LAG_BUCKETS))
+EVENT_LOOP_LAG_MAX = registry.register(Gauge("event_loop_lag_max_seconds", "Largest event-loop probe delay since start"))
+PEAK_RSS = registry.register(Gauge("peak_rss_bytes", "Peak resident set size of this process and its finished children"))
+LLM_CLIENT = registry.register(Gauge("llm_client", "Retry counters, AIMD concurrency limit and in-flight calls of the LLM client"))
+
+# Accumulates the LLM usage of the HTTP request being served, set by MetricsMiddleware
+_request_usage: ContextVar[Optional[dict]] = ContextVar("request_usage", default=None)
+
+@contextmanager
+def span(name: str, **labels):
+    """Time a block into the span histogram and track it in the in-flight gauge"""
+    IN_FLIGHT.inc(span=name)
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        SPAN_ERRORS.inc(span=name, **labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        IN_FLIGHT.dec(span=name)
+        SPAN_SECONDS.observe(elapsed, span=name, **labels)
+        if LOG_SPANS:
+            details = " ".join(f"{key}={value}" for key, value in labels.items())
+            print(colored(f"[span] {name} {details} {elapsed * 1000:.1f}ms", "magenta"))
+
+async def monitor_event_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Measure how late a periodic sleep wakes up; long synchronous work on the loop shows up as lag"""
+    loop = asyncio.get_running_loop()
+    worst = 0.0
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        EVENT_LOOP_LAG.observe(lag)
+        if lag > worst:
+            worst = lag
+            EVENT_LOOP_LAG_MAX.set(worst)
+
+def record_peak_rss():
+    """Publish peak RSS from getrusage, including worker processes that have exited"""
+    try:
+        import resource
+    except ImportError:
+        return
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    PEAK_RSS.set(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, process="self")
+    PEAK_RSS.set(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale, process="children")
+
+registry.add_collector(record_peak_rss)
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Estimated USD cost of a call; unknown models fall back to the closest priced prefix or zero"""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        matches = [known for known in MODEL_PRICES if model.startswith(known)]
+        prices = MODEL_PRICES[max(matches, key=len)] if matches else (0.0, 0.0)
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000
+
+def record_llm_usage(model: str, usage):
+    """Count the tokens and estimated cost from a completion's usage field"""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    cost = estimate_cost(model, prompt_tokens, completion_tokens)
+    LLM_TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+    LLM_TOKENS.inc(completion_tokens, model=model, kind="completion")
+    LLM_CALL_TOKENS.observe(prompt_tokens, model=model, kind="prompt")
+    LLM_CALL_TOKENS.observe(completion_tokens, model=model, kind="completion")
+    LLM_COST.inc(cost, model=model)
+
+    request_usage = _request_usage.get()
+    if request_usage is not None:
+        request_usage["calls"] += 1
+        request_usage["prompt_tokens"] += prompt_tokens
+        request_usage["completion_tokens"] += completion_tokens
+        request_usage["cost_usd"] += cost
+
+def record_cache_stats(cache: str, stats: dict):
+    """Publish a component's stats() counters as cache gauges"""
+    hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+    CACHE_HITS.set(hits, cache=cache)
+    CACHE_MISSES.set(misses, cache=cache)
+    CACHE_HIT_RATE.set(round(hits / (hits + misses), 4) if hits + misses else 0.0, cache=cache)
+    CACHE_ENTRIES.set(stats.get("entries", 0), cache=cache)
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and LLM cost of every HTTP request, including streamed ones"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+        token = _request_usage.set(usage)
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_usage.reset(token)
+            # The matched route template keeps label cardinality bounded
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_SECONDS.observe(time.perf_counter() - start, method=scope["method"], route=route)
+            HTTP_REQUESTS.inc(method=scope["method"], route=route, status=status["code"])
+            if usage["calls"]:
+                REQUEST_COST.observe(usage["cost_usd"], route=route)
@@ -0,0 +1,237 @@
+import struct
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Minimal writer for Outlook .msg files: a Compound File Binary (CFB v3) container holding MAPI property
+# streams. It covers what this app reads back through extract_msg: sender, recipients, subject, date,
+# plain and HTML bodies. Attachments and named properties are not written.
+
+SECTOR_SIZE = 512
+MINI_SECTOR_SIZE = 64
+MINI_STREAM_CUTOFF = 4096
+DIFAT_IN_HEADER = 109
+
+FREESECT = 0xFFFFFFFF
+ENDOFCHAIN = 0xFFFFFFFE
+FATSECT = 0xFFFFFFFD
+NOSTREAM = 0xFFFFFFFF
+
+STORAGE, STREAM, ROOT = 1, 2, 5
+
+PT_LONG = 0x0003
+PT_SYSTIME = 0x0040
+PT_UNICODE = 0x001F
+PT_BINARY = 0x0102
+
+PROP_FLAGS = 0x00000006  # readable | writable
+STORE_UNICODE_OK = 0x00040000
+FILETIME_EPOCH = datetime(1601, 1, 1, tzinfo=timezone.utc)
+
+class _Entry:
+    def __init__(self, name: str, kind: int, data: bytes = b""):
+        self.name = name
+        self.kind = kind
+        self.data = data
+        self.children: List["_Entry"] = []
+        self.id = 0
+        self.left = self.right = self.child = NOSTREAM
+        self.start = ENDOFCHAIN
+        self.size = 0
+
+    def add(self, entry: "_Entry") -> "_Entry":
+        self.children.append(entry)
+        return entry
+
+def _sort_key(entry: _Entry):
+    # CFB orders siblings by name length first, then by upper-cased name
+    return len(entry.name), entry.name.upper()
+
+def _link_tree(storage: _Entry):
+    """Arrange a storage's children as a balanced binary search tree through sibling pointers"""
+    def build(entries: List[_Entry]) -> int:
+        if not entries:
+            return NOSTREAM
+        middle = len(entries) // 2
+        node = entries[middle]
+        node.left = build(entries[:middle])
+        node.right = build(entries[middle + 1:])
+        return node.id
+
+    storage.child = build(sorted(storage.children, key=_sort_key))
+    for child in storage.children:
+        if child.kind == STORAGE:
+            _link_tree(child)
+
+def _directory_entry(entry: Optional[_Entry]) -> bytes:
+    if entry is None:
+        return b"\x00" * 64 + struct.pack("<HBBIII", 0, 0, 0, NOSTREAM, NOSTREAM, NOSTREAM) + b"\x00" * 36 + \
+            struct.pack("<IQ", 0, 0)
+    name = (entry.name + "\x00").encode("utf-16-le")
+    if len(name) > 64:
+        raise ValueError(f"CFB entry name too long: {entry.name}")
+    return (name.ljust(64, b"\x00")
+            + struct.pack("<HBBIII", len(name), entry.kind, 1, entry.left, entry.right, entry.child)
+            + b"\x00" * 16  # CLSID
+            + b"\x00" * 4  # state bits
+            + b"\x00" * 16  # creation and modification times
+            + struct.pack("<IQ", entry.start, entry.size))
+
+def _chain(table: list, start: int, count: int):
+    for offset in range(count):
+        table[start + offset] = start + offset + 1 if offset < count - 1 else ENDOFCHAIN
+
+def write_cfb(root: _Entry) -> bytes:
+    """Serialize a tree of storages and streams into a CFB v3 file"""
+    entries: List[_Entry] = []
+
+    def collect(entry: _Entry):
+        entry.id = len(entries)
+        entries.append(entry)
+        for child in entry.children:
+            collect(child)
+
+    collect(root)
+    _link_tree(root)
+    streams = [entry for entry in entries if entry.kind == STREAM]
+
+    # Small streams live in the mini stream, addressed in 64-byte mini sectors
+    mini_stream = bytearray()
+    mini_fat: list = []
+    for stream in streams:
+        stream.size = len(stream.data)
+        if stream.size == 0 or stream.size >= MINI_STREAM_CUTOFF:
+            continue
+        count = -(-stream.size // MINI_SECTOR_SIZE)
+        stream.start = len(mini_fat)
+        mini_fat.extend([0] * count)
+        _chain(mini_fat, stream.start, count)
+        mini_stream += stream.data.ljust(count * MINI_SECTOR_SIZE, b"\x00")
+
+    sectors: List[bytes] = []
+    fat: list = []
+
+    def allocate(data: bytes) -> int:
+        count = max(1, -(-len(data) // SECTOR_SIZE))
+        start = len(sectors)
+        for offset in range(count):
+            sectors.append(data[offset * SECTOR_SIZE:(offset + 1) * SECTOR_SIZE].ljust(SECTOR_SIZE, b"\x00"))
+        fat.extend([0] * count)
+        _chain(fat, start, count)
+        return start
+
+    for stream in streams:
+        if stream.size >= MINI_STREAM_CUTOFF:
+            stream.start = allocate(stream.data)
+    if mini_stream:
+        root.start = allocate(bytes(mini_stream))
+        root.size = len(mini_stream)
+
+    mini_fat_start, mini_fat_count = ENDOFCHAIN, 0
+    if mini_fat:
+        mini_fat_bytes = struct.pack(f"<{len(mini_fat)}I", *mini_fat)
+        mini_fat_start = allocate(mini_fat_bytes)
+        mini_fat_count = -(-len(mini_fat_bytes) // SECTOR_SIZE)
+
+    directory = b"".join(_directory_entry(entry) for entry in entries)
+    padding = -len(entries) % (SECTOR_SIZE // 128)
+    directory += b"".join(_directory_entry(None) for _ in range(padding))
+    directory_start = allocate(directory)
+
+    # FAT sectors describe themselves too, so size them until they cover every sector
+    fat_count = 1
+    while fat_count * (SECTOR_SIZE // 4) < len(sectors) + fat_count:
+        fat_count += 1
+    if fat_count > DIFAT_IN_HEADER:
+        raise ValueError("Message too large for this writer")
+    fat_start = len(sectors)
+    fat.extend([FATSECT] * fat_count)
+    fat.extend([FREESECT] * (fat_count * (SECTOR_SIZE // 4) - len(fat)))
+    fat_bytes = struct.pack(f"<{len(fat)}I", *fat)
+    sectors.extend(fat_bytes[i * SECTOR_SIZE:(i + 1) * SECTOR_SIZE] for i in range(fat_count))
+
+    difat = [fat_start + i for i in range(fat_count)] + [FREESECT] * (DIFAT_IN_HEADER - fat_count)
+    header = (b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1" + b"\x00" * 16
+              + struct.pack("<HHHHH", 0x003E, 0x0003, 0xFFFE, 9, 6) + b"\x00" * 6
+              + struct.pack("<IIIIIIIII", 0, fat_count, directory_start, 0, MINI_STREAM_CUTOFF,
+                            mini_fat_start, mini_fat_count, ENDOFCHAIN, 0)
+              + struct.pack(f"<{DIFAT_IN_HEADER}I", *difat))
+    return header + b"".join(sectors)
+
+def _filetime(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int((value - FILETIME_EPOCH).total_seconds() * 10_000_000)
+
+def _property_storage(storage: _Entry, properties: Dict[int, tuple], header: bytes):
+    """Write a __properties_version1.0 stream plus one substream per variable-length property"""
+    records = [header]
+    for prop_id, (prop_type, value) in sorted(properties.items()):
+        tag = (prop_id << 16) | prop_type
+        if prop_type in (PT_UNICODE, PT_BINARY):
+            # Readers take strings verbatim from the stream, so the terminator only counts in the size
+            data = value.encode("utf-16-le") if prop_type == PT_UNICODE else value
+            size = len(data) + 2 if prop_type == PT_UNICODE else len(data)
+            storage.add(_Entry(f"__substg1.0_{prop_id:04X}{prop_type:04X}", STREAM, data))
+            records.append(struct.pack("<IIII", tag, PROP_FLAGS, size, 0))
+        elif prop_type == PT_SYSTIME:
+            records.append(struct.pack("<IIQ", tag, PROP_FLAGS, _filetime(value)))
+        else:
+            records.append(struct.pack("<IIiI", tag, PROP_FLAGS, int(value), 0))
+    storage.add(_Entry("__properties_version1.0", STREAM, b"".join(records)))
+
+def build_msg(sender: str, to: List[str], subject: str, body: str, html_body: str = "",
+              date: Optional[datetime] = None, sender_name: str = "") -> bytes:
+    """Build the bytes of an Outlook .msg file for a plain or HTML email"""
+    date = date or datetime.now(timezone.utc)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    transport_headers = (
+        f"From: {sender}\r\n"
+        f"To: {', '.join(to)}\r\n"
+        f"Subject: {subject}\r\n"
+        f"Date: {format_datetime(date)}\r\n"
+        "MIME-Version: 1.0\r\n"
+        f"Content-Type: {'text/html' if html_body else 'text/plain'}; charset=utf-8\r\n\r\n"
+    )
+
+    root = _Entry("Root Entry", ROOT)
+    message_properties = {
+        0x001A: (PT_UNICODE, "IPM.Note"),  # PR_MESSAGE_CLASS
+        0x0037: (PT_UNICODE, subject),  # PR_SUBJECT
+        0x0039: (PT_SYSTIME, date),  # PR_CLIENT_SUBMIT_TIME
+        0x007D: (PT_UNICODE, transport_headers),  # PR_TRANSPORT_MESSAGE_HEADERS
+        0x0C1A: (PT_UNICODE, sender_name or sender),  # PR_SENDER_NAME
+        0x0C1F: (PT_UNICODE, sender),  # PR_SENDER_EMAIL_ADDRESS
+        0x0E04: (PT_UNICODE, "; ".join(to)),  # PR_DISPLAY_TO
+        0x0E06: (PT_SYSTIME, date),  # PR_MESSAGE_DELIVERY_TIME
+        0x0E07: (PT_LONG, 1),  # PR_MESSAGE_FLAGS: read
+        0x1000: (PT_UNICODE, body),  # PR_BODY
+        0x340D: (PT_LONG, STORE_UNICODE_OK),  # PR_STORE_SUPPORT_MASK: strings are UTF-16
+    }
+    if html_body:
+        message_properties[0x1013] = (PT_BINARY, html_body.encode("utf-8"))  # PR_HTML
+    header = struct.pack("<8xIIII8x", len(to), 0, len(to), 0)
+    _property_storage(root, message_properties, header)
+
+    for number, address in enumerate(to):
+        recipient = root.add(_Entry(f"__recip_version1.0_#{number:08X}", STORAGE))
+        _property_storage(recipient, {
+            0x0C15: (PT_LONG, 1),  # PR_RECIPIENT_TYPE: To
+            0x3001: (PT_UNICODE, address),  # PR_DISPLAY_NAME
+            0x3002: (PT_UNICODE, "SMTP"),  # PR_ADDRTYPE
+            0x3003: (PT_UNICODE, address),  # PR_EMAIL_ADDRESS
+            0x39FE: (PT_UNICODE, address),  # PR_SMTP_ADDRESS
+        }, b"\x00" * 8)
+
+    nameid = root.add(_Entry("__nameid_version1.0", STORAGE))
+    for stream_name in ("__substg1.0_00020102", "__substg1.0_00030102", "__substg1.0_00040102"):
+        nameid.add(_Entry(stream_name, STREAM))
+    return write_cfb(root)
+
+def write_msg_file(path: Path, **fields) -> Path:
+    """Write an Outlook .msg file; fields are the arguments of build_msg"""
+    path = Path(path)
+    path.write_bytes(build_msg(**fields))
+    return path
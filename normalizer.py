@@ -0,0 +1,189 @@
+import os
+import re
+from typing import List
+from bs4 import BeautifulSoup
+from email_parser import format_email_for_analysis
+from token_utils import estimate_tokens, truncate_to_tokens
+
+from dotenv import load_dotenv
+load_dotenv()
+
+NORMALIZE_EMAILS = os.getenv("NORMALIZE_EMAILS", "true").lower() == "true"  # false sends the raw headers and body
+EMAIL_TOKEN_BUDGET = int(os.getenv("EMAIL_TOKEN_BUDGET", 4000))  # Max tokens of one email sent to the LLM
+NORMALIZE_MODEL = "gpt-4o"  # Tokenizer used for the budget and the savings report
+MAX_RECIPIENTS = 5  # Addresses kept from To before the rest are counted
+QUOTE_HEADER_LINES = 4  # Header lines closer than this to the previous one belong to the same quote header
+SIGNATURE_MAX_LINES = 6  # Lines a "-- " signature block may have; a delimiter further up is body text
+NAME_BLOCK_LINES = 3  # Lines (name, title) a sign-off may be followed by and still be cut off with it
+SIGNATURE_LINE_CHARS = 50  # Longer lines below a sign-off or delimiter are body text
+DISCLAIMER_MAX_PARAGRAPHS = 3  # Trailing paragraphs checked for disclaimers; earlier ones are body text
+MIN_DEDUPE_CHARS = 40  # Shorter lines ("Thanks,") may legitimately repeat
+TRUNCATION_MARKER = "\n[... truncated]"
+NORMALIZE_VERSION = "3"  # Bump whenever normalization changes so stored emails are normalized again
+
+# Lines that start the quoted previous message of a reply or forward
+QUOTE_HEADERS = [
+    re.compile(r"^On\b.{0,300}\bwrote:$", re.IGNORECASE),
+    re.compile(r"^-{2,}\s*(Original|Forwarded) Message\s*-{2,}$", re.IGNORECASE),
+    re.compile(r"^Begin forwarded message:$", re.IGNORECASE),
+]
+OUTLOOK_FROM = re.compile(r"^\*?From:\*?\s", re.IGNORECASE)
+OUTLOOK_SENT = re.compile(r"^\*?(Sent|Date):\*?\s", re.IGNORECASE)
+FORWARD_SUBJECT = re.compile(r"^\s*(fwd?|fw)\s*:", re.IGNORECASE)
+
+SIGNATURE_DELIMITER = "-- "  # RFC 3676; clean_lines leaves this line untouched
+SIGN_OFF = re.compile(
+    r"^(best|kind|warm|many)?\s*(regards|thanks|thank you|cheers|sincerely|best wishes|best)\s*[,.!]?$",
+    re.IGNORECASE
+)
+SENTENCE = re.compile(r"\b[a-z]+[.!?;](\s|$)|[!?]")  # "...is signed." but not "ACME Inc." or "J. Smith"
+MOBILE_FOOTER = re.compile(r"^(sent from my \w+|get outlook for \w+|sent from (yahoo )?mail for \w+)", re.IGNORECASE)
+# Paragraphs of the legal/marketing footer; only matched in the last DISCLAIMER_MAX_PARAGRAPHS of an email
+DISCLAIMER = re.compile(
+    r"^(disclaimer|confidentiality notice|legal notice)\s*:"
+    r"|\bif you are not the intended recipient\b"
+    r"|\bif you have received this (e-?mail|message|communication) in error\b"
+    r"|\bthis (e-?mail|message|communication)( and any (attachments|files)[\w ]{0,40}?)? (is|are|may be|contains?)"
+    r" (strictly )?(confidential|privileged)"
+    r"|\bthis (e-?mail|message) has been scanned\b"
+    r"|\bplease consider the environment before printing\b"
+    r"|^(to )?unsubscribe\b|\bclick here to unsubscribe\b",
+    re.IGNORECASE
+)
+
+# HTML-to-text residue: inline image placeholders and the <url> Outlook appends after link text
+INLINE_JUNK = re.compile(r"\[cid:[^\]]*\]|<(https?|mailto):[^>\s]*>", re.IGNORECASE)
+HORIZONTAL_SPACE = re.compile(r"[ \t\u00a0\u2000-\u200a\u202f\u3000]+")
+BLOCK_TAGS = ["p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "table"]
+INVISIBLE = re.compile(r"[\u200b-\u200d\u2060\ufeff\u00ad\r]")
+
+def html_to_text(html_body: str) -> str:
+    """Visible text of an HTML body, one block element per line"""
+    soup = BeautifulSoup(html_body, "html.parser")
+    for element in soup(["script", "style", "head"]):
+        element.decompose()
+    for element in soup(BLOCK_TAGS):
+        element.append("\n")
+    return soup.get_text()
+
+def clean_lines(text: str) -> List[str]:
+    """Strip invisible characters and inline junk, and collapse horizontal whitespace on every line"""
+    text = INLINE_JUNK.sub("", INVISIBLE.sub("", text))
+    return [line if line == SIGNATURE_DELIMITER else HORIZONTAL_SPACE.sub(" ", line).strip()
+            for line in text.split("\n")]
+
+def _quote_header_at(lines: List[str], index: int) -> bool:
+    line = lines[index]
+    following = lines[index + 1] if index + 1 < len(lines) else ""
+    if any(pattern.match(line) or pattern.match(f"{line} {following}") for pattern in QUOTE_HEADERS):
+        return True
+    # Outlook puts From:/Sent:/To:/Subject: lines above the quoted message
+    return bool(OUTLOOK_FROM.match(line)) and any(OUTLOOK_SENT.match(later) for later in lines[index + 1:index + 4])
+
+def strip_quoted_history(lines: List[str], forwarded: bool = False) -> List[str]:
+    """Drop ">" quoted lines and everything from the first reply header on
+
+    In a forward, or a reply with nothing above the quote, the first quoted message is the content being
+    shared, so only the history below it is dropped.
+    """
+    lines = [line for line in lines if not line.startswith(">")]
+    headers = []
+    for index in range(len(lines)):
+        # A "Forwarded message" line followed by From:/Date: lines is one header, not two
+        if _quote_header_at(lines, index) and not (headers and index - headers[-1] <= QUOTE_HEADER_LINES):
+            headers.append(index)
+    if headers and (forwarded or not any(lines[:headers[0]])):
+        headers = headers[1:]
+    if not headers:
+        return lines
+    return lines[:headers[0]]
+
+def _signature_block(lines: List[str], max_lines: int) -> bool:
+    """Whether lines are a short name/contact block rather than body text"""
+    content = [line for line in lines if line]
+    return len(content) <= max_lines and all(
+        len(line) <= SIGNATURE_LINE_CHARS and not SENTENCE.search(line) for line in content
+    )
+
+def strip_signature(lines: List[str]) -> List[str]:
+    """Drop mobile footers, a "-- " signature block at the end and a sign-off followed only by a name block"""
+    lines = [line for line in lines if not MOBILE_FOOTER.match(line)]
+    content = [index for index, line in enumerate(lines) if line]
+    for index in reversed(content[-(SIGNATURE_MAX_LINES + 1):]):
+        if lines[index] == SIGNATURE_DELIMITER and _signature_block(lines[index + 1:], SIGNATURE_MAX_LINES):
+            lines = lines[:index]
+            content = [position for position in content if position < index]
+            break
+    for index in reversed(content[-(NAME_BLOCK_LINES + 1):]):
+        if SIGN_OFF.match(lines[index]) and _signature_block(lines[index + 1:], NAME_BLOCK_LINES):
+            return lines[:index]
+    return lines
+
+def strip_disclaimers(paragraphs: List[str]) -> List[str]:
+    """Drop the disclaimer paragraphs that end an email, stopping at the first one that is not a disclaimer"""
+    end = len(paragraphs)
+    checked = 0
+    while end and checked < DISCLAIMER_MAX_PARAGRAPHS:
+        paragraph = paragraphs[end - 1]
+        if paragraph.strip():
+            if not DISCLAIMER.search(paragraph):
+                break
+            checked += 1
+        end -= 1
+    return paragraphs[:end]
+
+def clean_paragraphs(lines: List[str]) -> str:
+    """Join lines into paragraphs, dropping a trailing disclaimer and lines repeated earlier in the email"""
+    paragraphs = []
+    seen = set()
+    for paragraph in strip_disclaimers("\n".join(lines).split("\n\n")):
+        kept = []
+        for line in paragraph.split("\n"):
+            key = line.lower()
+            if len(key) >= MIN_DEDUPE_CHARS:
+                if key in seen:
+                    continue
+                seen.add(key)
+            if line:
+                kept.append(line)
+        if kept:
+            paragraphs.append("\n".join(kept))
+    return "\n\n".join(paragraphs)
+
+def compact_recipients(recipients: str) -> str:
+    addresses = [address.strip() for address in recipients.split(",") if address.strip()]
+    if len(addresses) <= MAX_RECIPIENTS:
+        return ", ".join(addresses)
+    return ", ".join(addresses[:MAX_RECIPIENTS]) + f" (+{len(addresses) - MAX_RECIPIENTS} more)"
+
+def normalize_body(email_data: dict) -> str:
+    """Body text with quoted history, signatures, disclaimers, duplicates and extra whitespace removed"""
+    body = email_data.get("body") or ""
+    if not body.strip() and email_data.get("html_body"):
+        body = html_to_text(email_data["html_body"])
+    forwarded = bool(FORWARD_SUBJECT.match(email_data.get("subject") or ""))
+    lines = strip_quoted_history(clean_lines(body), forwarded)
+    return clean_paragraphs(strip_signature(lines))
+
+def normalization_fingerprint() -> str:
+    """Identifies the settings stored analysis content was produced with, so it is redone when they change"""
+    return f"{NORMALIZE_VERSION}:{NORMALIZE_EMAILS}:{EMAIL_TOKEN_BUDGET}:{NORMALIZE_MODEL}"
+
+def normalize_email(email_data: dict, token_budget: int = EMAIL_TOKEN_BUDGET, model: str = NORMALIZE_MODEL) -> dict:
+    """Return {analysis_content, raw_tokens, tokens}: the text sent to the LLM and its size before and after"""
+    raw_content = format_email_for_analysis(email_data)
+    raw_tokens = estimate_tokens(raw_content, model)
+    if not NORMALIZE_EMAILS:
+        return {"analysis_content": raw_content, "raw_tokens": raw_tokens, "tokens": raw_tokens}
+
+    content = format_email_for_analysis({
+        **email_data,
+        "to": compact_recipients(email_data.get("to") or ""),
+        "body": normalize_body(email_data)
+    })
+    tokens = estimate_tokens(content, model)
+    if tokens > token_budget:
+        content = truncate_to_tokens(content, token_budget - estimate_tokens(TRUNCATION_MARKER, model), model)
+        content += TRUNCATION_MARKER
+        tokens = estimate_tokens(content, model)
+    return {"analysis_content": content, "raw_tokens": raw_tokens, "tokens": tokens}
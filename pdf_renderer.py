@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import zipfile
+from pathlib import Path
+from typing import Callable, List
+from concurrent.futures import Executor
+from termcolor import colored
+from metrics import span
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak
+from bs4 import BeautifulSoup
+import html2text
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+from dotenv import load_dotenv
+load_dotenv()
+
+PDF_CACHE_DIR = Path(os.getenv("PDF_CACHE_DIR", "cache/pdfs"))
+PDF_CACHE_TTL_SECONDS = int(os.getenv("PDF_CACHE_TTL_SECONDS", 7 * 24 * 3600))  # Unused PDFs older than this are deleted
+PDF_CACHE_MAX_ENTRIES = int(os.getenv("PDF_CACHE_MAX_ENTRIES", 5000))  # Least recently used PDFs above this are deleted
+PDF_CACHE_SWEEP_SECONDS = 3600  # Expired PDFs are looked for at most this often
+PDF_RENDER_VERSION = "1"  # Bump whenever the PDF layout changes so cached PDFs are re-rendered
+
+PDF_FIELDS = ("from", "to", "subject", "date", "body", "html_body")
+
+# Rendering functions are synchronous and module-level so they can run in a ProcessPoolExecutor
+
+def pdf_cache_key(email_data: dict) -> str:
+    """Hash of the rendered fields, so identical emails share one cached PDF"""
+    payload = json.dumps([PDF_RENDER_VERSION] + [email_data.get(field) or "" for field in PDF_FIELDS])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def build_email_story(email_data: dict) -> list:
+    """Build the reportlab flowables for one email"""
+    story = []
+    styles = getSampleStyleSheet()
+
+    value_style = ParagraphStyle(
+        'ValueStyle',
+        parent=styles['Normal'],
+        fontSize=10
+    )
+
+    # Define custom colors
+    header_bg_color = colors.Color(red=(0.95), green=(0.95), blue=(0.95))  # Light grey for header
+
+    # Add email header information
+    header_data = [
+        ['From:', email_data.get('from', 'N/A')],
+        ['To:', email_data.get('to', 'N/A')],
+        ['Subject:', email_data.get('subject', 'N/A')],
+        ['Date:', email_data.get('date', 'N/A')]
+    ]
+
+    # Create header table
+    header_table = Table(header_data, colWidths=[1*inch, 5*inch])
+    header_table.setStyle(TableStyle([
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+        ('BACKGROUND', (0, 0), (-1, -1), colors.whitesmoke),
+    ]))
+    story.append(header_table)
+    story.append(Spacer(1, 20))
+
+    # Process email body
+    body_content = email_data.get('html_body', '') or email_data.get('body', '')
+
+    if body_content:
+        if email_data.get('html_body'):
+            # Parse HTML content
+            soup = BeautifulSoup(body_content, 'html.parser')
+
+            # Handle tables in HTML
+            for table in soup.find_all('table'):
+                # Convert HTML table to reportlab table
+                table_data = []
+                for row in table.find_all('tr'):
+                    table_row = []
+                    for cell in row.find_all(['td', 'th']):
+                        table_row.append(Paragraph(cell.get_text(), value_style))
+                    table_data.append(table_row)
+
+                if table_data:
+                    pdf_table = Table(table_data)
+                    pdf_table.setStyle(TableStyle([
+                        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+                        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+                        ('FONTSIZE', (0, 0), (-1, -1), 10),
+                        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+                        ('BACKGROUND', (0, 0), (-1, 0), header_bg_color),
+                    ]))
+                    story.append(pdf_table)
+                    story.append(Spacer(1, 12))
+
+            # Convert remaining HTML to text
+            h = html2text.HTML2Text()
+            h.body_width = 0
+            text_content = h.handle(str(soup))
+        else:
+            text_content = body_content
+
+        # Split content into paragraphs and add to story
+        for paragraph in text_content.split('\n\n'):
+            if paragraph.strip():
+                story.append(Paragraph(paragraph.replace('\n', '<br/>'), value_style))
+                story.append(Spacer(1, 12))
+
+    return story
+
+def _build_pdf(story: list, output_path: Path):
+    """Build a PDF into a temporary file and move it into place, so readers never see a partial file"""
+    temp_path = output_path.with_name(f".{output_path.name}.{uuid.uuid4().hex}.part")
+    try:
+        doc = SimpleDocTemplate(
+            str(temp_path),
+            pagesize=A4,
+            rightMargin=72,
+            leftMargin=72,
+            topMargin=72,
+            bottomMargin=72
+        )
+        doc.build(story)
+        os.replace(temp_path, output_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+def render_email_pdf(email_data: dict, output_path: str):
+    """Render one email to a PDF file"""
+    _build_pdf(build_email_story(email_data), Path(output_path))
+
+def render_merged_pdf(emails: List[dict], output_path: str):
+    """Render several emails into a single PDF, each starting on a new page"""
+    story = []
+    for number, email_data in enumerate(emails):
+        if number:
+            story.append(PageBreak())
+        story.extend(build_email_story(email_data))
+    _build_pdf(story, Path(output_path))
+
+def merge_pdfs(pdf_paths: List[str], output_path: str):
+    """Concatenate rendered PDFs into one file"""
+    writer = PdfWriter()
+    for pdf_path in pdf_paths:
+        writer.append(pdf_path)
+    temp_path = f"{output_path}.{uuid.uuid4().hex}.part"
+    try:
+        with open(temp_path, 'wb') as f:
+            writer.write(f)
+        os.replace(temp_path, output_path)
+    finally:
+        Path(temp_path).unlink(missing_ok=True)
+
+def write_pdf_zip(entries: List[tuple], output_path: str):
+    """Write (archive name, pdf path) entries into a ZIP; PDFs are already compressed so they are stored"""
+    with zipfile.ZipFile(output_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, pdf_path in entries:
+            archive.write(pdf_path, arcname=name)
+
+class PdfRenderer:
+    """Renders email PDFs in a process pool and caches them on disk by content hash, least recently used first out"""
+
+    def __init__(self, get_executor: Callable[[], Executor], cache_dir: Path = PDF_CACHE_DIR,
+                 ttl_seconds: int = PDF_CACHE_TTL_SECONDS, max_entries: int = PDF_CACHE_MAX_ENTRIES):
+        self.get_executor = get_executor
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._in_flight = {}  # cache key -> future, so concurrent requests render an email once
+        self._last_sweep = 0.0
+        # Kept up to date as PDFs are rendered and evicted, so stats() never lists the directory
+        self.entries = self._evict()
+
+    def _evict(self) -> int:
+        """Delete expired PDFs, then the least recently used above max_entries; returns the PDFs left"""
+        now = time.time()
+        self._last_sweep = now
+        pdfs = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".pdf") and not entry.name.startswith("."):
+                try:
+                    pdfs.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+        pdfs.sort(reverse=True)
+        expired = [path for mtime, path in pdfs if now - mtime > self.ttl_seconds]
+        kept = [path for mtime, path in pdfs if now - mtime <= self.ttl_seconds]
+        evicted = expired + kept[self.max_entries:]
+        for path in evicted:
+            Path(path).unlink(missing_ok=True)
+        self.evictions += len(evicted)
+        if evicted:
+            print(colored(f"PDF cache evicted {len(evicted)} files", "yellow"))
+        return len(pdfs) - len(evicted)
+
+    async def _render_cached(self, key: str, render_fn, *args) -> Path:
+        pdf_path = self.cache_dir / f"{key}.pdf"
+        if pdf_path.exists():
+            self.hits += 1
+            # The modification time is the last use, which eviction goes by
+            pdf_path.touch()
+            return pdf_path
+
+        future = self._in_flight.get(key)
+        if future is None:
+            self.misses += 1
+            loop = asyncio.get_running_loop()
+            future = asyncio.ensure_future(loop.run_in_executor(self.get_executor(), render_fn, *args, str(pdf_path)))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            future.add_done_callback(self._rendered)
+        with span("pdf_render", kind="merged" if key.startswith("merged-") else "email"):
+            await asyncio.shield(future)
+        return pdf_path
+
+    def _rendered(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.entries += 1
+        if self.entries > self.max_entries or time.time() - self._last_sweep > PDF_CACHE_SWEEP_SECONDS:
+            self._last_sweep = time.time()
+            asyncio.ensure_future(self._sweep())
+
+    async def _sweep(self):
+        self.entries = await asyncio.to_thread(self._evict)
+
+    async def render(self, email_data: dict) -> Path:
+        """Return the path of the email's PDF, rendering it only if it is not cached"""
+        email_data = {field: email_data.get(field) or "" for field in PDF_FIELDS}
+        return await self._render_cached(pdf_cache_key(email_data), render_email_pdf, email_data)
+
+    async def render_many(self, emails: List[dict]) -> List[Path]:
+        """Render several emails in parallel, returning their PDF paths in input order"""
+        return list(await asyncio.gather(*[self.render(email_data) for email_data in emails]))
+
+    async def render_merged(self, emails: List[dict]) -> Path:
+        """Return one PDF containing all the emails in order
+
+        Each email is rendered (or taken from the cache) in parallel and the PDFs are concatenated, so a
+        changed selection only renders the emails that are new to it.
+        """
+        emails = [{field: email_data.get(field) or "" for field in PDF_FIELDS} for email_data in emails]
+        keys = [pdf_cache_key(email_data) for email_data in emails]
+        key = "merged-" + hashlib.sha256("".join(keys).encode('utf-8')).hexdigest()
+        if PdfWriter is None:
+            print(colored("Warning: pypdf is not installed, rendering the merged PDF in one pass", "yellow"))
+            return await self._render_cached(key, render_merged_pdf, emails)
+        pdf_paths = await self.render_many(emails)
+        return await self._render_cached(key, merge_pdfs, [str(pdf_path) for pdf_path in pdf_paths])
+
+    async def render_zip(self, names: List[str], emails: List[dict], output_path: Path) -> Path:
+        """Render the emails in parallel and bundle them into a ZIP of <name>.pdf files"""
+        pdf_paths = await self.render_many(emails)
+        entries = [(f"{Path(name).name}.pdf", str(pdf_path)) for name, pdf_path in zip(names, pdf_paths)]
+        with span("pdf_zip"):
+            await asyncio.to_thread(write_pdf_zip, entries, str(output_path))
+        print(colored(f"Bundled {len(entries)} PDFs into {output_path.name}", "green"))
+        return output_path
+
+    def clear(self) -> int:
+        """Delete every cached PDF"""
+        removed = 0
+        for pdf_path in self.cache_dir.glob("*.pdf"):
+            pdf_path.unlink(missing_ok=True)
+            removed += 1
+        self.entries = 0
+        return removed
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the number of cached PDFs"""
+        return {
+            "entries": self.entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "max_entries": self.max_entries
+        }
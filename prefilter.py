@@ -0,0 +1,168 @@
+import os
+import re
+import math
+import hashlib
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from termcolor import colored
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    np = None
+    SentenceTransformer = None
+
+from dotenv import load_dotenv
+load_dotenv()
+
+PREFILTER_MIN_SCORE = float(os.getenv("PREFILTER_MIN_SCORE", 0.0))  # Emails at or below this BM25 score are skipped
+PREFILTER_EMBEDDING_MODEL = os.getenv("PREFILTER_EMBEDDING_MODEL", "")  # e.g. all-MiniLM-L6-v2; empty disables
+PREFILTER_MIN_SIMILARITY = float(os.getenv("PREFILTER_MIN_SIMILARITY", 0.3))  # Cosine similarity that keeps an email
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "in", "is", "it",
+    "its", "of", "on", "or", "that", "the", "this", "to", "was", "were", "will", "with", "we", "you"
+}
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens without stopwords"""
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in STOPWORDS]
+
+class Prefilter:
+    """Incremental BM25 inverted index with optional offline embeddings for cheap relevance scoring"""
+
+    def __init__(self, embedding_model: str = PREFILTER_EMBEDDING_MODEL):
+        # plan() runs in worker threads, so the index is only read or changed while holding this lock
+        self._lock = threading.Lock()
+        self.postings: Dict[str, Dict[str, int]] = {}  # term -> {doc_id: term frequency}
+        self._doc_terms: Dict[str, List[str]] = {}  # doc_id -> distinct terms, for removal
+        self.doc_lengths: Dict[str, int] = {}
+        self.doc_hashes: Dict[str, str] = {}
+        self.total_length = 0
+
+        self.embedding_model_name = embedding_model
+        self._embedder = None
+        self._embeddings: Dict[str, "np.ndarray"] = {}  # content hash -> normalized vector, for indexed emails only
+
+    def _remove(self, doc_id: str):
+        for term in self._doc_terms.pop(doc_id, ()):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(doc_id, 0)
+        self.doc_hashes.pop(doc_id, None)
+
+    def _add(self, doc_id: str, text: str, content_hash: str):
+        tokens = tokenize(text)
+        counts = Counter(tokens)
+        for term, frequency in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = frequency
+        self._doc_terms[doc_id] = list(counts)
+        self.doc_lengths[doc_id] = len(tokens)
+        self.doc_hashes[doc_id] = content_hash
+        self.total_length += len(tokens)
+
+    def sync(self, documents: Dict[str, str]):
+        """Bring the index in line with the given {doc_id: text}, re-indexing only changed documents"""
+        with self._lock:
+            self._sync(documents)
+
+    def _sync(self, documents: Dict[str, str]):
+        removed = [doc_id for doc_id in self.doc_hashes if doc_id not in documents]
+        for doc_id in removed:
+            self._remove(doc_id)
+
+        changed = 0
+        for doc_id, text in documents.items():
+            content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            if self.doc_hashes.get(doc_id) == content_hash:
+                continue
+            self._remove(doc_id)
+            self._add(doc_id, text, content_hash)
+            changed += 1
+        if (removed or changed) and self._embeddings:
+            # Vectors live as long as an indexed email has their content, so they never outgrow the index
+            indexed = set(self.doc_hashes.values())
+            for content_hash in [content_hash for content_hash in self._embeddings if content_hash not in indexed]:
+                del self._embeddings[content_hash]
+        if changed:
+            print(colored(f"Prefilter index updated for {changed} emails ({len(self.doc_lengths)} indexed)", "cyan"))
+
+    def bm25_scores(self, query: str) -> Dict[str, float]:
+        """Score every indexed document against the query"""
+        num_docs = len(self.doc_lengths)
+        if not num_docs:
+            return {}
+        average_length = self.total_length / num_docs or 1
+        scores = {doc_id: 0.0 for doc_id in self.doc_lengths}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                length_norm = 1 - BM25_B + BM25_B * self.doc_lengths[doc_id] / average_length
+                scores[doc_id] += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+        return scores
+
+    def _get_embedder(self):
+        if not self.embedding_model_name:
+            return None
+        if SentenceTransformer is None:
+            print(colored("Warning: sentence-transformers is not installed (pip install -r requirements-embeddings.txt), "
+                          "embedding prefilter disabled", "yellow"))
+            self.embedding_model_name = ""
+            return None
+        if self._embedder is None:
+            print(colored(f"Loading embedding model {self.embedding_model_name}...", "blue"))
+            self._embedder = SentenceTransformer(self.embedding_model_name)
+        return self._embedder
+
+    def similarity_scores(self, documents: Dict[str, str], search_terms: List[str]) -> Optional[Dict[str, float]]:
+        """Max cosine similarity between each document and any search term, or None without embeddings"""
+        embedder = self._get_embedder()
+        if embedder is None:
+            return None
+
+        missing = {self.doc_hashes[doc_id]: text for doc_id, text in documents.items()
+                   if self.doc_hashes[doc_id] not in self._embeddings}
+        if missing:
+            vectors = embedder.encode(list(missing.values()), normalize_embeddings=True)
+            self._embeddings.update(zip(missing.keys(), vectors))
+
+        doc_ids = list(documents)
+        matrix = np.stack([self._embeddings[self.doc_hashes[doc_id]] for doc_id in doc_ids])
+        term_vectors = embedder.encode(search_terms, normalize_embeddings=True)
+        similarities = (matrix @ term_vectors.T).max(axis=1)
+        return {doc_id: float(similarity) for doc_id, similarity in zip(doc_ids, similarities)}
+
+    def plan(self, documents: Dict[str, str], search_terms: List[str],
+             min_score: float = PREFILTER_MIN_SCORE,
+             min_similarity: float = PREFILTER_MIN_SIMILARITY) -> Tuple[List[str], List[str], Dict[str, float]]:
+        """Split documents into (to analyze ordered by relevance, skipped) and return their scores
+
+        A document is kept when any search term scores above min_score with BM25, or, when embeddings
+        are enabled, when its similarity to a search term reaches min_similarity.
+        """
+        with self._lock:
+            self._sync(documents)
+            scores = {doc_id: 0.0 for doc_id in documents}
+            for term in search_terms:
+                for doc_id, score in self.bm25_scores(term).items():
+                    if doc_id in scores:
+                        scores[doc_id] = max(scores[doc_id], score)
+            similarities = self.similarity_scores(documents, search_terms) or {}
+
+        keep = [doc_id for doc_id in documents
+                if scores[doc_id] > min_score or similarities.get(doc_id, -1.0) >= min_similarity]
+        kept = set(keep)
+        skipped = [doc_id for doc_id in documents if doc_id not in kept]
+        keep.sort(key=lambda doc_id: (scores[doc_id], similarities.get(doc_id, 0.0)), reverse=True)
+        return keep, skipped, scores
@@ -1,52 +1,30 @@
-EMAIL_ANALYSIS_SYSTEM_PROMPT = """You are an expert email analyzer with deep understanding of business context and semantic meaning.
-Your task is to analyze emails and find relevant content based on search terms, considering:
-
-1. Semantic Relevance: Look for content that matches the meaning and intent of search terms, not just exact matches
-2. Context Understanding: Consider the broader context of discussions and implied meanings
-3. Business Intelligence: Identify business-relevant information related to the search terms
-4. Key Information: Extract important details even if they use different wording than the search terms
-5. Related Concepts: Include relevant content that uses synonyms or related business concepts
-6. Indirect References: Capture indirect mentions and implied connections to the search terms
-
-For each search term:
-- Find ALL relevant content, including semantic matches and contextually related information
-- Include surrounding context to ensure the meaning is clear
-- Consider business implications and relationships
-- Look for both explicit and implicit references
-- Consider industry-specific terminology and jargon
-
-Return a structured analysis with:
-1. Semantic matches for each term (with context)
-2. Overall relevance score (0-100)
-3. Key insights found
-4. Important context that might not directly match but is relevant"""
-
-EMAIL_ANALYSIS_USER_PROMPT_TEMPLATE = """Analyze this email content for the following search terms: {search_terms}
+EMAIL_ANALYSIS_SYSTEM_PROMPT = """You are an expert email analyzer. Find content in emails that is relevant to search terms,
+including semantic matches: synonyms, related business concepts, jargon and indirect or implied references,
+not just literal occurrences.
+
+Be concise: quote short verbatim snippets, explain each in one sentence, and do not repeat content across terms."""
+
+EMAIL_ANALYSIS_USER_PROMPT_TEMPLATE = """Analyze this email for these search terms: {search_terms}
+
+For each term, list every relevant snippet (an empty list if none), rate the email's overall relevance to the
+terms from 0 to 100, and give at most 3 key insights.
 
 Email Content:
-{email_content}
+{email_content}"""
+
+EMAIL_ANALYSIS_PACKED_USER_PROMPT_TEMPLATE = """Analyze each of the following emails separately for these search terms: {search_terms}
 
-Provide a detailed analysis in JSON format with the following structure:
-{{
-    "semantic_matches": {{
-        "term": [
-            {{
-                "text": "relevant text snippet",
-                "context": "surrounding context",
-                "relevance": "explanation of relevance"
-            }}
-        ]
-    }},
-    "overall_relevance_score": number,
-    "key_insights": [
-        "insight 1",
-        "insight 2"
-    ],
-    "important_context": [
-        "context 1",
-        "context 2"
-    ]
-}}"""
+Each email is wrapped in <email id="..."> tags. Analyze every email on its own; never mix content between emails.
+For each email and term, list every relevant snippet (an empty list if none), rate the email's overall relevance
+to the terms from 0 to 100, and give at most 3 key insights.
+
+{emails}
+
+Return one result per email id: {email_ids}"""
+
+PACKED_EMAIL_TEMPLATE = """<email id="{email_id}">
+{email_content}
+</email>"""
 
 EMAIL_SUMMARY_SYSTEM_PROMPT = """You are an expert email analyst tasked with generating comprehensive summaries of email collections.
 Focus on finding semantic relationships and patterns related to these search terms: {terms}
@@ -64,4 +42,27 @@ Provide a structured summary that highlights:
 2. Key findings and insights
 3. Important patterns or trends
 4. Recommendations or action items
-5. Any potential risks or issues identified""" 
\ No newline at end of file
+5. Any potential risks or issues identified""" 
+
+EMAIL_CHUNK_SUMMARY_SYSTEM_PROMPT = """You are an expert email analyst summarizing one part of a larger email collection.
+Focus on content related to these search terms: {terms}
+
+Write a dense intermediate summary that will later be merged with summaries of the other parts. Keep:
+1. Topics and discussions related to the search terms
+2. Decisions, action items and deadlines, with dates
+3. People, teams and organizations involved
+4. Risks or issues that might need attention
+
+Do not add introductions or conclusions; only report what the emails contain."""
+
+EMAIL_CHUNK_SUMMARY_USER_PROMPT_TEMPLATE = """Summarize this part ({part} of {total_parts}) of the email collection:
+
+{content}"""
+
+EMAIL_SUMMARY_REDUCE_USER_PROMPT_TEMPLATE = """Generate a semantic analysis summary of the whole email collection from these partial summaries.
+Each partial summary covers a different group of emails:
+
+{summaries}"""
+
+# Bump whenever the analysis prompts change so cached analyses are not reused
+PROMPT_VERSION = "2"
@@ -0,0 +1,113 @@
+import time
+import asyncio
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+from termcolor import colored
+
+class RateLimiter:
+    """Sliding one-minute window budget for requests and tokens"""
+
+    WINDOW_SECONDS = 60.0
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._events = deque()  # (timestamp, tokens)
+        self._tokens_in_window = 0
+        self._lock = asyncio.Lock()
+
+    def _prune(self, now: float):
+        while self._events and now - self._events[0][0] >= self.WINDOW_SECONDS:
+            _, tokens = self._events.popleft()
+            self._tokens_in_window -= tokens
+
+    def _has_capacity(self, tokens: int) -> bool:
+        if self.requests_per_minute and len(self._events) >= self.requests_per_minute:
+            return False
+        # A single request larger than the whole budget is let through on an empty window
+        if self.tokens_per_minute and self._events and self._tokens_in_window + tokens > self.tokens_per_minute:
+            return False
+        return True
+
+    async def acquire(self, tokens: int = 0):
+        """Wait until one request of the given token cost fits in the budget"""
+        if not self.requests_per_minute and not self.tokens_per_minute:
+            return
+
+        while True:
+            # The lock only guards the window; waiting without it lets smaller requests that fit go first
+            async with self._lock:
+                now = time.monotonic()
+                self._prune(now)
+                if self._has_capacity(tokens):
+                    self._events.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+                wait = self.WINDOW_SECONDS - (now - self._events[0][0])
+            print(colored(f"Rate limit budget reached, waiting {wait:.1f}s...", "yellow"))
+            await asyncio.sleep(max(wait, 0.01))
+
+class ConcurrencyScheduler:
+    """Sliding-window work queue that keeps up to max_concurrency calls in flight"""
+
+    def __init__(self, max_concurrency: int = 10, requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.in_flight = 0
+
+    async def as_completed(self, items: List[Any], worker: Callable[[Any], Awaitable[Any]],
+                           cost_fn: Optional[Callable[[Any], int]] = None) -> AsyncIterator[Tuple[int, Any]]:
+        """Yield (index, result) pairs as soon as each item finishes"""
+        if not items:
+            return
+
+        queue = asyncio.Queue()
+        for index, item in enumerate(items):
+            queue.put_nowait((index, item))
+        results = asyncio.Queue()
+
+        async def run_worker():
+            while True:
+                try:
+                    index, item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await self.rate_limiter.acquire(cost_fn(item) if cost_fn else 0)
+                    self.in_flight += 1
+                    try:
+                        result = await worker(item)
+                    finally:
+                        self.in_flight -= 1
+                    await results.put((index, result, None))
+                except Exception as e:
+                    await results.put((index, None, e))
+
+        workers = [asyncio.create_task(run_worker()) for _ in range(min(self.max_concurrency, len(items)))]
+        try:
+            for _ in range(len(items)):
+                index, result, error = await results.get()
+                if error is not None:
+                    raise error
+                yield index, result
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def map_ordered(self, items: List[Any], worker: Callable[[Any], Awaitable[Any]],
+                          cost_fn: Optional[Callable[[Any], int]] = None) -> AsyncIterator[Tuple[int, Any]]:
+        """Yield (index, result) pairs in input order while still running items concurrently"""
+        pending = {}
+        next_index = 0
+        async for index, result in self.as_completed(items, worker, cost_fn):
+            pending[index] = result
+            while next_index in pending:
+                yield next_index, pending.pop(next_index)
+                next_index += 1
+
+    async def run(self, items: List[Any], worker: Callable[[Any], Awaitable[Any]],
+                  cost_fn: Optional[Callable[[Any], int]] = None) -> List[Any]:
+        """Run every item and return the results in input order"""
+        return [result async for _, result in self.map_ordered(items, worker, cost_fn)]
@@ -0,0 +1,122 @@
+import json
+import time
+import asyncio
+import pytest
+import llm_service
+from types import SimpleNamespace
+from analysis_cache import AnalysisCache
+from analysis_schema import EmailAnalysis, Match
+
+class FakeCompletions:
+    """Answers analysis requests with one match per requested term and records the terms asked for"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def create(self, **kwargs):
+        response_format = kwargs["response_format"]["json_schema"]
+        schema = response_format["schema"]
+        if response_format["name"] == "packed_email_analysis":
+            email_ids = schema["properties"]["results"]["required"]
+            terms = schema["properties"]["results"]["properties"][email_ids[0]]["properties"]["semantic_matches"]["required"]
+            content = {"results": {email_id: self._analysis(terms) for email_id in email_ids}}
+        else:
+            email_ids = None
+            terms = schema["properties"]["semantic_matches"]["required"]
+            content = self._analysis(terms)
+        self.requests.append((email_ids, terms))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(content)))])
+
+    @staticmethod
+    def _analysis(terms):
+        return {
+            "semantic_matches": {term: [{"text": f"about {term}", "relevance": "mentions it"}] for term in terms},
+            "overall_relevance_score": 70,
+            "key_insights": ["Budget approved"]
+        }
+
+@pytest.fixture
+def cache(tmp_path):
+    return AnalysisCache(tmp_path / "analysis_cache.db")
+
+@pytest.fixture
+def service(cache, monkeypatch):
+    monkeypatch.setattr(llm_service, "AnalysisCache", lambda: cache)
+    completions = FakeCompletions()
+    monkeypatch.setattr(llm_service, "ResilientLLMClient", lambda: completions)
+    service = llm_service.LLMService()
+    service.requests = completions.requests
+    return service
+
+def test_make_key_ignores_term_case_order_duplicates_and_whitespace(cache):
+    key = cache.make_key("Subject: Budget\n\nQ3 numbers", ["Budget", "Deadline"], "gpt-4o")
+    assert cache.make_key("Subject: Budget\r\n\r\n\r\nQ3   numbers  ", ["deadline", " budget", "BUDGET"], "gpt-4o") == key
+    assert cache.make_key("Subject: Budget\n\nQ4 numbers", ["Budget", "Deadline"], "gpt-4o") != key
+    assert cache.make_key("Subject: Budget\n\nQ3 numbers", ["Budget", "Deadline"], "gpt-4o-mini") != key
+    assert cache.make_key("Subject: Budget\n\nQ3 numbers", ["Budget"], "gpt-4o") != key
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = AnalysisCache(tmp_path / "analysis_cache.db", ttl_seconds=60)
+    cache._set("key", "{}")
+    cache._set_terms([("content", "budget", {"matches": []})])
+    assert cache._get("key") == "{}"
+    assert cache._get_terms("content", ["budget", "deadline"]) == {"budget": {"matches": []}}
+    assert (cache.term_hits, cache.term_misses) == (1, 1)
+
+    with cache._lock:
+        cache._conn.execute("UPDATE analysis_cache SET created_at = ?", (time.time() - 120,))
+        cache._conn.execute("UPDATE term_analysis SET created_at = ?", (time.time() - 120,))
+        cache._conn.commit()
+    assert cache._get("key") is None
+    assert cache._get_terms("content", ["budget"]) == {}
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = AnalysisCache(tmp_path / "analysis_cache.db", max_entries=2)
+    for key in ("a", "b"):
+        cache._set(key, "{}")
+        time.sleep(0.01)
+    cache._get("a")
+    cache._set("c", "{}")
+    assert cache._get("b") is None
+    assert cache._get("a") == "{}" and cache._get("c") == "{}"
+
+def test_only_new_terms_are_sent_to_the_llm(service):
+    email = "Subject: Budget\n\nThe Q3 budget was approved before the deadline."
+    first = asyncio.run(service.analyze_email_content(email, ["Budget", "Deadline"]))
+    second = asyncio.run(service.analyze_email_content(email, ["budget", "Hiring"]))
+
+    assert service.requests == [(None, ["Budget", "Deadline"]), (None, ["Hiring"])]
+    assert list(first.semantic_matches) == ["Budget", "Deadline"]
+    assert list(second.semantic_matches) == ["budget", "Hiring"]
+    assert second.semantic_matches["budget"] == [Match(text="about Budget", relevance="mentions it")]
+
+def test_cached_analysis_is_keyed_by_the_requested_terms(service):
+    email = "Subject: Budget\n\nThe Q3 budget was approved."
+    asyncio.run(service.analyze_email_content(email, ["Budget", "Deadline"]))
+    cached = asyncio.run(service.analyze_email_content(email, ["deadline", "BUDGET"]))
+
+    assert len(service.requests) == 1
+    assert service.cache.hits == 1
+    assert list(cached.semantic_matches) == ["deadline", "BUDGET"]
+    assert cached.semantic_matches["BUDGET"][0].text == "about Budget"
+
+def test_terms_without_matches_do_not_inherit_the_score(service):
+    analysis = EmailAnalysis(semantic_matches={"Budget": [Match(text="Q3 budget", relevance="states it")], "Hiring": []},
+                             overall_relevance_score=80, key_insights=["Approved"])
+    results = service.split_term_results(analysis, ["budget", "hiring"])
+    assert results["budget"]["score"] == 80
+    assert results["hiring"] == {"matches": [], "score": 0, "key_insights": ["Approved"]}
+
+    merged = service.merge_term_results(["Hiring", "Budget"], results)
+    assert merged.overall_relevance_score == 80
+    assert merged.semantic_matches["Budget"][0].text == "Q3 budget"
+    assert merged.semantic_matches["Hiring"] == []
+
+def test_emails_missing_the_same_terms_share_a_packed_request(service):
+    emails = ["Subject: A\n\nBudget numbers.", "Subject: B\n\nHiring plan.", "Subject: C\n\nBudget and hiring."]
+    asyncio.run(service.analyze_email_content(emails[2], ["budget"]))
+    results = asyncio.run(service.analyze_email_pack(emails, ["Budget", "Hiring"]))
+
+    # The third email only lacks "Hiring", which no other email shares, so it gets its own request
+    assert service.requests[1:] == [(["email_1", "email_2"], ["Budget", "Hiring"]), (None, ["Hiring"])]
+    assert all(list(result.semantic_matches) == ["Budget", "Hiring"] for result in results)
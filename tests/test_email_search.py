@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+from email_store import EmailStore, search_query, highlight_snippet, HIGHLIGHT_START, HIGHLIGHT_END
+
+EMAILS = {
+    "budget.eml": {"from": "Alice <alice@example.com>", "to": "team@example.com", "subject": "Q3 budget approved",
+                   "date": "Mon, 1 Jan 2024 09:00:00 +0000", "body": "The budget for <Q3> is approved & signed."},
+    "hiring.eml": {"from": "Bob <bob@corp.example>", "to": "alice@example.com", "subject": "Hiring plan",
+                   "date": "Mon, 5 Feb 2024 09:00:00 +0000", "body": "Two engineers; the budget covers both."},
+    "party.eml": {"from": "Carol <carol@example.com>", "to": "team@example.com", "subject": "Team lunch",
+                  "date": "Fri, 1 Mar 2024 12:00:00 +0000", "body": "Lunch on Friday, budgeting not required."}
+}
+
+@pytest.fixture
+def store(tmp_path):
+    directory = tmp_path / "emails"
+    directory.mkdir()
+    store = EmailStore(tmp_path / "store.db")
+    emails = dict(EMAILS)
+
+    async def parser(path):
+        return {"html_body": "", **emails[path.name]}
+
+    async def index():
+        for name in EMAILS:
+            (directory / name).write_text(name)
+            await store.get(directory / name, parser)
+    asyncio.run(index())
+    store.directory = directory
+    store.emails = emails
+    store.parser = parser
+    return store
+
+def search(store, query, **filters):
+    total, results = asyncio.run(store.search(query, store.directory, **filters))
+    assert total == len(results)
+    return [result["filename"] for result in results], results
+
+def test_subject_matches_rank_first_and_stems_match(store):
+    names, _ = search(store, "budget")
+    assert names == ["budget.eml", "hiring.eml", "party.eml"]  # porter stemming matches "budgeting"
+
+def test_field_filters_operators_and_prefixes(store):
+    assert search(store, "subject:budget")[0] == ["budget.eml"]
+    assert search(store, "from:bob@corp.example")[0] == ["hiring.eml"]
+    assert search(store, "budget NOT engineers")[0] == ["budget.eml", "party.eml"]
+    assert search(store, '"budget covers"')[0] == ["hiring.eml"]
+    assert search(store, "engin*")[0] == ["hiring.eml"]
+
+def test_sender_and_date_filters(store):
+    assert search(store, "budget", sender="alice@example.com")[0] == ["budget.eml"]
+    assert search(store, "budget", sender="example.com")[0] == ["budget.eml", "party.eml"]
+    february = 1706745600.0  # 2024-02-01 UTC
+    assert search(store, "budget", sent_after=february)[0] == ["hiring.eml", "party.eml"]
+    assert search(store, "budget", sent_before=february)[0] == ["budget.eml"]
+
+def test_snippets_are_escaped_and_highlighted(store):
+    _, results = search(store, "signed")
+    assert results[0]["snippet"] == "The budget for &lt;Q3&gt; is approved &amp; <mark>signed</mark>."
+    assert highlight_snippet(f"<b>{HIGHLIGHT_START}x{HIGHLIGHT_END}") == "&lt;b&gt;<mark>x</mark>"
+
+def test_query_translation_quotes_non_word_terms():
+    assert search_query("from:alice@example.com budget") == 'from_addr:"alice@example.com" budget'
+    assert search_query("to:team date:2024-01-01") == 'to_addr:team date:"2024-01-01"'
+    assert search_query('"exact phrase" OR budg*') == '"exact phrase" OR budg*'
+
+@pytest.mark.parametrize("query", ["budget AND", "NEAR(", "nosuchfield:budget", '"unterminated'])
+def test_malformed_queries_raise_value_error(store, query):
+    with pytest.raises(ValueError, match="Invalid search query"):
+        asyncio.run(store.search(query, store.directory))
+
+def test_index_follows_changes_and_removals(store):
+    path = store.directory / "party.eml"
+    store.emails["party.eml"] = {**EMAILS["party.eml"], "body": "Lunch moved to the rooftop terrace."}
+    path.write_text("party.eml, edited")
+    asyncio.run(store.get(path, store.parser))
+    assert search(store, "budgeting")[0] == ["budget.eml", "hiring.eml"]
+    assert search(store, "rooftop")[0] == ["party.eml"]
+
+    asyncio.run(store.invalidate([path]))
+    assert search(store, "rooftop")[0] == []
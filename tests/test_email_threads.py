@@ -0,0 +1,83 @@
+import re
+import random
+import hashlib
+from analysis_schema import EmailAnalysis, Match
+from email_threads import (simhash, near_duplicates, build_threads, normalize_subject, plan_threads,
+                           thread_document, split_thread_analysis, unique_lines)
+
+BODY = ("The quarterly budget review has moved to Friday at ten. Please bring the revised forecast for the "
+        "marketing and hiring lines, and flag any spend above the approved limits before the meeting starts.")
+
+def email(subject, body, date="", message_id="", in_reply_to="", references=""):
+    return {"subject": subject, "date": date, "message_id": message_id, "in_reply_to": in_reply_to,
+            "references": references, "content": f"Subject: {subject}\n\n{body}"}
+
+def reference_simhash(text):
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles]
+    return sum(1 << bit for bit in range(64) if 2 * sum(h >> bit & 1 for h in hashes) > len(hashes))
+
+def test_simhash_matches_a_per_bit_count():
+    words = re.findall(r"\w+", BODY)
+    for text in (BODY, "Thanks!", "", " ".join(words[:5])):
+        assert simhash(text) == reference_simhash(text)
+    assert simhash(BODY) == simhash(BODY.upper())
+    assert bin(simhash(BODY) ^ simhash(BODY + " Thanks")).count("1") <= 6
+    assert bin(simhash(BODY) ^ simhash(" ".join(reversed(words)))).count("1") > 6
+
+def test_near_duplicates_collapse_onto_the_first_copy():
+    other = " ".join(random.Random(1).sample(BODY.split(), len(BODY.split())))
+    texts = {0: BODY, 1: other, 2: BODY + " Thanks!", 3: "Thanks!", 4: "Thanks!"}
+    assert near_duplicates(texts) == {2: 0}  # Short bodies are never collapsed
+
+def test_threads_link_by_headers_and_reply_subject():
+    emails = [
+        email("Budget review", BODY, date="Mon, 1 Jan 2024 09:00:00 +0000", message_id="<a@x>"),
+        email("Re: Budget review", "Friday works.", date="Mon, 1 Jan 2024 10:00:00 +0000", in_reply_to="<A@x>"),
+        email("RE: [ext] Fwd: budget   REVIEW", "Forwarding.", date="Tue, 2 Jan 2024 09:00:00 +0000"),
+        email("Hiring plan", "Two roles.", date="Mon, 1 Jan 2024 08:00:00 +0000"),
+        email("Budget review", "A second, unrelated thread with the same subject.")
+    ]
+    assert normalize_subject(emails[2]["subject"]) == "budget review"
+    threads = sorted(build_threads(emails, list(range(len(emails)))))
+    assert threads == [[0, 1, 2], [3], [4]]
+
+def test_plan_threads_units_and_duplicates():
+    emails = [
+        email("Budget review", BODY, message_id="<a@x>"),
+        email("Re: Budget review", "Friday works.\n\n" + "> quoted", in_reply_to="<a@x>"),
+        email("Fwd: notes", BODY),
+        email("Hiring plan", "Two roles.")
+    ]
+    plan = plan_threads(emails, [0, 1, 2, 3])
+    assert plan.duplicate_of == {2: 0}
+    assert sorted(plan.units) == [[0, 1], [3]]
+    assert plan.thread_of == {0: 0, 1: 0, 2: 0, 3: 3}
+
+def test_unique_lines_drops_quoted_repeats():
+    assert unique_lines(["Budget is approved.\nThanks", "> Budget is approved.\nbudget  IS approved.\nGreat"]) == \
+        ["Budget is approved.\nThanks", "> Budget is approved.\nGreat"]
+
+def test_split_thread_analysis_assigns_matches_to_their_member():
+    emails = [
+        email("Budget review", "The budget is approved for Q3.", message_id="<a@x>"),
+        email("Re: Budget review", "The budget is approved for Q3.\nHiring two engineers next month.",
+              in_reply_to="<a@x>"),
+        email("Re: Budget review", "Noted.", in_reply_to="<a@x>")
+    ]
+    document, member_texts = thread_document(emails, [0, 1, 2])
+    assert "### Message 3 of 3" in document
+    assert member_texts[1].count("budget is approved") == 0  # Already in the first message
+
+    analysis = EmailAnalysis(semantic_matches={
+        "budget": [Match(text="budget is approved", relevance="states it")],
+        "hiring": [Match(text="hiring two engineers next", relevance="plans it")]
+    }, overall_relevance_score=75, key_insights=["Q3 budget approved"])
+    first, second, third = split_thread_analysis(analysis, member_texts, ["budget", "hiring"])
+
+    assert [m.text for m in first.semantic_matches["budget"]] == ["budget is approved"]
+    assert first.semantic_matches["hiring"] == []
+    assert [m.text for m in second.semantic_matches["hiring"]] == ["hiring two engineers next"]
+    assert (first.overall_relevance_score, second.overall_relevance_score) == (75, 75)
+    assert third == EmailAnalysis(semantic_matches={"budget": [], "hiring": []})
@@ -0,0 +1,55 @@
+import asyncio
+from jobs import JobManager, CANCELLED, COMPLETED
+
+EMAILS = [{"filename": f"email{i}.eml", "subject": f"Subject {i}", "from": "a@example.com", "date": ""}
+          for i in range(2)]
+
+def make_manager(tmp_path, delay):
+    async def analyze(emails, search_terms, options):
+        for index, email in enumerate(emails):
+            await asyncio.sleep(delay)
+            yield index, {"filename": email["filename"], "subject": email["subject"], "analysis": None}
+
+    async def load_emails(emails):
+        return emails
+
+    return JobManager(analyze, load_emails, db_path=tmp_path / "jobs.db")
+
+async def wait_for(manager, job_id, status):
+    for _ in range(100):
+        if (await manager.get_status(job_id))["status"] == status:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"job {job_id} never reached {status}")
+
+def test_cancelling_a_job_keeps_the_worker_running(tmp_path):
+    async def run():
+        manager = make_manager(tmp_path, delay=0.05)
+        await manager.start()
+        try:
+            first = await manager.submit(EMAILS, ["budget"], {})
+            await asyncio.sleep(0.02)
+            assert await manager.cancel(first)
+            await wait_for(manager, first, CANCELLED)
+
+            # The same worker picks up the next job
+            second = await manager.submit(EMAILS, ["budget"], {})
+            await wait_for(manager, second, COMPLETED)
+            assert (await manager.get_status(second))["completed"] == 2
+            assert not manager._cancel_requested
+        finally:
+            await manager.stop()
+
+    asyncio.run(run())
+
+def test_stopping_leaves_a_running_job_resumable(tmp_path):
+    async def run():
+        manager = make_manager(tmp_path, delay=1)
+        await manager.start()
+        job_id = await manager.submit(EMAILS, ["budget"], {})
+        await asyncio.sleep(0.02)
+        await manager.stop()
+        assert manager._workers == []
+        return (await manager.get_status(job_id))["status"]
+
+    assert asyncio.run(run()) == "running"
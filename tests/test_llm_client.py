@@ -0,0 +1,110 @@
+import asyncio
+import pytest
+from llm_client import CircuitBreaker, CircuitOpenError, ResilientLLMClient
+
+class FlakyCompletions:
+    """Stands in for client.chat.completions: fails the first `failures` calls, then succeeds"""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(0.001)
+        if self.calls <= self.failures:
+            raise asyncio.TimeoutError()
+        return "completion"
+
+class FakeClient:
+    def __init__(self, completions):
+        self.chat = type("Chat", (), {"completions": completions})()
+
+def test_breaker_opens_after_threshold_and_half_opens_after_reset():
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=0.05)
+    for _ in range(2):
+        breaker.on_failure()
+    assert breaker.state == "closed"
+    breaker.on_failure()
+    assert breaker.state == "open"
+
+    async def wait_for_trial():
+        return await breaker.before_call()
+    assert asyncio.run(wait_for_trial()) is True
+    assert breaker.state == "half-open"
+
+    breaker.on_success()
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+def test_only_one_trial_runs_while_half_open():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.01)
+    breaker.on_failure()
+
+    async def scenario():
+        await asyncio.sleep(0.02)
+        trial = await breaker.before_call()
+        waiter = asyncio.create_task(breaker.before_call(max_wait=5))
+        await asyncio.sleep(0.05)
+        # A non-trial call finishing must not release the trial slot
+        breaker.end_call(False)
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        breaker.on_success()
+        breaker.end_call(trial)
+        return trial, await waiter
+
+    trial, second = asyncio.run(scenario())
+    assert trial is True
+    assert second is False  # The trial closed the circuit, so the waiter proceeds as a normal call
+
+def test_failed_trial_reopens_circuit():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.02)
+    breaker.on_failure()
+
+    async def scenario():
+        trial = await breaker.before_call()
+        breaker.on_failure()
+        breaker.end_call(trial)
+        return breaker.state
+
+    assert asyncio.run(scenario()) == "open"
+
+def test_before_call_gives_up_after_max_wait():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60)
+    breaker.on_failure()
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(breaker.before_call(max_wait=0.05))
+
+def test_open_circuit_delays_retries_instead_of_failing_them(monkeypatch):
+    monkeypatch.setattr("llm_client.LLM_BACKOFF_BASE", 0.001)
+    completions = FlakyCompletions(failures=4)
+    client = ResilientLLMClient(client=FakeClient(completions), max_retries=6)
+    client.breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.02)
+
+    async def scenario():
+        return await asyncio.gather(*[client.create(model="gpt-4o", messages=[]) for _ in range(5)])
+
+    assert asyncio.run(scenario()) == ["completion"] * 5
+    assert client.failures == 0
+    assert client.breaker.state == "closed"
+
+def test_exhausted_retries_count_as_failures(monkeypatch):
+    monkeypatch.setattr("llm_client.LLM_BACKOFF_BASE", 0.001)
+    client = ResilientLLMClient(client=FakeClient(FlakyCompletions(failures=100)), max_retries=2)
+    client.breaker = CircuitBreaker(failure_threshold=100, reset_seconds=0.01)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(client.create(model="gpt-4o", messages=[]))
+    assert client.calls == 3
+    assert client.failures == 1
+
+def test_circuit_that_stays_open_fails_the_call(monkeypatch):
+    monkeypatch.setattr(CircuitBreaker.before_call, "__defaults__", (0.05,))
+    completions = FlakyCompletions(failures=0)
+    client = ResilientLLMClient(client=FakeClient(completions), max_retries=5)
+    client.breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60)
+    client.breaker.on_failure()
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(client.create(model="gpt-4o", messages=[]))
+    assert completions.calls == 0
+    assert client.failures == 1
@@ -0,0 +1,54 @@
+import time
+import asyncio
+import pytest
+import mailbox_ingest
+from mailbox_ingest import MailboxIngestor, COMPLETED, RUNNING
+
+MBOX = b"".join(f"From sender@example.com Mon Jan  1 09:00:00 2024\nSubject: Update {n}\n\nBody {n}.\n\n".encode()
+                for n in range(1, 4))
+
+def make_ingestor(tmp_path):
+    (tmp_path / "imports").mkdir()
+    (tmp_path / "emails").mkdir()
+    indexed = []
+
+    async def index_email(path):
+        indexed.append(path.name)
+        return {}
+
+    return MailboxIngestor(tmp_path / "emails", lambda sha256: None, index_email, root=tmp_path / "imports"), indexed
+
+def test_mbox_is_ingested_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(mailbox_ingest, "INGEST_BATCH_SIZE", 2)
+    ingestor, indexed = make_ingestor(tmp_path)
+    (tmp_path / "imports" / "export.mbox").write_bytes(MBOX)
+
+    async def run():
+        status = ingestor.start("export.mbox")
+        await ingestor._tasks[status["ingestion_id"]]
+        return ingestor.get_status(status["ingestion_id"])
+
+    status = asyncio.run(run())
+    assert status["status"] == COMPLETED
+    assert (status["messages"], status["stored"], status["progress"]) == (3, 3, 1.0)
+    assert indexed == ["export_00001.eml", "export_00002.eml", "export_00003.eml"]
+
+def test_paths_outside_the_root_are_rejected(tmp_path):
+    ingestor, _ = make_ingestor(tmp_path)
+    (tmp_path / "outside.mbox").write_bytes(MBOX)
+    for path in ("../outside.mbox", str(tmp_path / "outside.mbox")):
+        with pytest.raises(ValueError):
+            ingestor.resolve(path)
+    with pytest.raises(FileNotFoundError):
+        ingestor.resolve("missing.mbox")
+
+def test_finished_ingestions_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(mailbox_ingest, "INGEST_HISTORY_MAX", 2)
+    ingestor, _ = make_ingestor(tmp_path)
+    now = time.time()
+    finished_at = {"expired": now - mailbox_ingest.INGEST_HISTORY_TTL_SECONDS - 1,
+                   "oldest": now - 30, "older": now - 20, "newest": now - 10, "running": None}
+    for ingestion_id, finished in finished_at.items():
+        ingestor._ingestions[ingestion_id] = {"ingestion_id": ingestion_id, "finished_at": finished, "started_at": now,
+                                              "status": RUNNING if finished is None else COMPLETED}
+    assert {status["ingestion_id"] for status in ingestor.list_ingestions()} == {"older", "newest", "running"}
@@ -0,0 +1,70 @@
+import asyncio
+import normalizer
+from email_store import EmailStore
+from normalizer import clean_paragraphs, normalize_body, normalize_email
+
+def paragraphs(*blocks):
+    return "\n\n".join(blocks).split("\n")
+
+def test_trailing_disclaimer_is_dropped():
+    text = clean_paragraphs(paragraphs(
+        "The budget review moves to Friday.",
+        "This email and any attachments are confidential and intended solely for the addressee.",
+        "If you have received this email in error please notify the sender."
+    ))
+    assert text == "The budget review moves to Friday."
+
+def test_disclaimer_wording_in_the_body_is_kept():
+    body = paragraphs(
+        "Legal asked whether the contract is confidential and intended for the board only.",
+        "Please unsubscribe the old vendor from the mailing list.",
+        "Thanks for checking."
+    )
+    text = clean_paragraphs(body)
+    assert "contract is confidential" in text
+    assert "unsubscribe the old vendor" in text
+
+def test_only_the_footer_is_searched_for_disclaimers():
+    text = clean_paragraphs(paragraphs(
+        "Disclaimer: these numbers are estimates.",
+        "Revenue grew 4% in Q3.",
+        "Please consider the environment before printing this email."
+    ))
+    assert text == "Disclaimer: these numbers are estimates.\n\nRevenue grew 4% in Q3."
+
+def test_sign_off_followed_by_content_keeps_the_content():
+    body = "Hi Bob,\nThanks!\nThe Q3 budget was approved at 2M and the vendor contract is signed.\nAlice"
+    assert normalize_body({"body": body}) == body
+
+def test_sign_off_and_name_block_are_dropped():
+    body = "Budget approved.\n\nBest regards,\nAlice Smith\nCFO, ACME Inc."
+    assert normalize_body({"body": body}) == "Budget approved."
+
+def test_only_a_trailing_rfc_signature_delimiter_cuts_the_body():
+    assert normalize_body({"body": "Status:\n--\nThe contract was terminated for fraud.\nRegards"}) == \
+        "Status:\n--\nThe contract was terminated for fraud."
+    assert normalize_body({"body": "Status:\n-- \nThe contract was terminated for fraud."}) == \
+        "Status:\n-- \nThe contract was terminated for fraud."
+    signed = "Budget approved.\n-- \nAlice Smith\nCFO | ACME Inc.\n+1 555 0100\nwww.acme.com"
+    assert normalize_body({"body": signed}) == "Budget approved."
+
+def test_stored_emails_follow_normalization_settings(tmp_path, monkeypatch):
+    email_file = tmp_path / "email.eml"
+    email_file.write_text("unused")
+    email = {"from": "a@example.com", "to": "b@example.com", "subject": "Budget", "date": "",
+             "body": "Budget approved.\n\nOn Mon, Bob wrote:\n> old thread", "html_body": ""}
+    parses = []
+
+    async def parser(path):
+        parses.append(path)
+        return email
+
+    store = EmailStore(tmp_path / "store.db")
+    normalized = asyncio.run(store.get(email_file, parser))
+    assert "old thread" not in normalized["analysis_content"]
+
+    monkeypatch.setattr(normalizer, "NORMALIZE_EMAILS", False)
+    raw = asyncio.run(store.get(email_file, parser))
+    assert "old thread" in raw["analysis_content"]
+    assert raw["analysis_content"] == normalize_email(email)["analysis_content"]
+    assert len(parses) == 1  # Re-normalized from the stored fields, not re-parsed
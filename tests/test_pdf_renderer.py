@@ -0,0 +1,51 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pypdf import PdfReader
+from pdf_renderer import PdfRenderer
+
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+def email(n):
+    return {"from": f"sender{n}@example.com", "to": "me@example.com", "subject": f"Subject {n}",
+            "date": "2024-01-01", "body": f"Body of email {n}"}
+
+def make_renderer(tmp_path, **kwargs):
+    return PdfRenderer(get_executor=lambda: EXECUTOR, cache_dir=tmp_path, **kwargs)
+
+def test_merged_pdf_reuses_the_per_email_pdfs(tmp_path):
+    renderer = make_renderer(tmp_path)
+    asyncio.run(renderer.render_many([email(1), email(2)]))
+    assert renderer.misses == 2
+
+    merged = asyncio.run(renderer.render_merged([email(1), email(2), email(3)]))
+    # Only the new email and the merge itself are rendered
+    assert renderer.misses == 4 and renderer.hits == 2
+    assert len(PdfReader(merged).pages) == 3
+    assert renderer.stats()["entries"] == 4
+
+def test_least_recently_used_pdfs_are_evicted_above_the_limit(tmp_path):
+    async def run():
+        first = await renderer.render(email(1))
+        old = time.time() - 60
+        os.utime(first, (old, old))
+        await renderer.render(email(2))
+        await renderer.render(email(3))
+        await asyncio.sleep(0.1)  # let the background sweep finish
+        return first
+
+    renderer = make_renderer(tmp_path, max_entries=2)
+    first = asyncio.run(run())
+    assert not first.exists()
+    assert renderer.stats()["entries"] == 2 and renderer.evictions == 1
+
+def test_expired_pdfs_are_evicted_on_startup(tmp_path):
+    renderer = make_renderer(tmp_path)
+    pdf_path = asyncio.run(renderer.render(email(1)))
+    old = time.time() - 3600
+    os.utime(pdf_path, (old, old))
+
+    restarted = make_renderer(tmp_path, ttl_seconds=60)
+    assert not pdf_path.exists()
+    assert restarted.stats()["entries"] == 0
@@ -0,0 +1,20 @@
+import hashlib
+from prefilter import Prefilter
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def test_bm25_keeps_matching_emails_and_skips_the_rest():
+    prefilter = Prefilter(embedding_model="")
+    analyze, skipped, _ = prefilter.plan({"a": "quarterly budget review", "b": "lunch on friday"}, ["budget"])
+    assert analyze == ["a"] and skipped == ["b"]
+
+def test_embeddings_are_dropped_with_the_emails_they_belong_to():
+    prefilter = Prefilter(embedding_model="")
+    prefilter.sync({"a": "first email", "b": "second email"})
+    prefilter._embeddings = {content_hash("first email"): [1.0], content_hash("second email"): [0.0]}
+
+    prefilter.sync({"a": "first email", "b": "second email, edited"})
+    assert list(prefilter._embeddings) == [content_hash("first email")]
+    prefilter.sync({})
+    assert prefilter._embeddings == {}
@@ -0,0 +1,94 @@
+import asyncio
+import pytest
+from scheduler import ConcurrencyScheduler, RateLimiter
+
+def collect(aiterator):
+    async def run():
+        return [item async for item in aiterator]
+    return asyncio.run(run())
+
+def test_results_arrive_as_they_finish_and_in_order_on_request():
+    delays = [0.05, 0.01, 0.03, 0.0]
+
+    async def work(delay):
+        await asyncio.sleep(delay)
+        return delay * 100
+
+    scheduler = ConcurrencyScheduler(max_concurrency=4)
+    assert [index for index, _ in collect(scheduler.as_completed(delays, work))] == [3, 1, 2, 0]
+    assert collect(scheduler.map_ordered(delays, work)) == [(0, 5.0), (1, 1.0), (2, 3.0), (3, 0.0)]
+    assert asyncio.run(scheduler.run(delays, work)) == [5.0, 1.0, 3.0, 0.0]
+
+def test_concurrency_never_exceeds_the_limit():
+    peak = 0
+
+    async def work(item):
+        nonlocal peak
+        peak = max(peak, scheduler.in_flight)
+        await asyncio.sleep(0.005)
+        return item
+
+    scheduler = ConcurrencyScheduler(max_concurrency=3)
+    assert asyncio.run(scheduler.run(list(range(20)), work)) == list(range(20))
+    assert peak == 3
+    assert scheduler.in_flight == 0
+
+def test_a_failing_item_raises_and_stops_the_workers():
+    started = []
+
+    async def work(item):
+        started.append(item)
+        await asyncio.sleep(0.01)
+        if item == 1:
+            raise ValueError("boom")
+        return item
+
+    scheduler = ConcurrencyScheduler(max_concurrency=2)
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.run(list(range(10)), work))
+    assert len(started) < 10
+
+def test_rate_limiter_waits_for_the_window(monkeypatch):
+    monkeypatch.setattr(RateLimiter, "WINDOW_SECONDS", 0.2)
+    limiter = RateLimiter(requests_per_minute=2)
+
+    async def acquire_three():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for _ in range(3):
+            await limiter.acquire()
+        return loop.time() - start
+
+    assert asyncio.run(acquire_three()) >= 0.19
+
+def test_token_budget_admits_an_oversized_request_on_an_empty_window(monkeypatch):
+    monkeypatch.setattr(RateLimiter, "WINDOW_SECONDS", 0.1)
+    limiter = RateLimiter(tokens_per_minute=100)
+    costs = [60, 30, 500]
+    scheduler = ConcurrencyScheduler(max_concurrency=5, tokens_per_minute=100)
+    scheduler.rate_limiter = limiter
+    order = []
+
+    async def work(cost):
+        order.append((cost, limiter._tokens_in_window))
+        return cost
+
+    assert asyncio.run(scheduler.run(costs, work, cost_fn=lambda cost: cost)) == costs
+    assert order == [(60, 60), (30, 90), (500, 500)]  # The 500-token call waited for an empty window
+
+def test_a_waiting_request_does_not_block_one_that_fits(monkeypatch):
+    monkeypatch.setattr(RateLimiter, "WINDOW_SECONDS", 0.2)
+    limiter = RateLimiter(tokens_per_minute=100)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        await limiter.acquire(60)
+        large = asyncio.create_task(limiter.acquire(500))
+        await asyncio.sleep(0)  # the large request is now waiting for an empty window
+        start = loop.time()
+        await limiter.acquire(30)
+        small_wait = loop.time() - start
+        await large
+        return small_wait
+
+    assert asyncio.run(run()) < 0.1
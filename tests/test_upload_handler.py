@@ -0,0 +1,69 @@
+import io
+import mailbox
+import zipfile
+import pytest
+from upload_handler import MboxSplitter, UploadResult, iter_mbox, expand_mbox, expand_archive, store_message
+
+MBOX = (b"From alice@example.com Mon Jan  1 09:00:00 2024\n"
+        b"Subject: Budget\n\nQ3 numbers.\n>From the archive, quoted.\n\n"
+        b"From bob@example.com Mon Jan  1 10:00:00 2024\n"
+        b"Subject: Re: Budget\n\nLooks good.\n\n"
+        b"From carol@example.com Mon Jan  1 11:00:00 2024\n"
+        b"Subject: Hiring\n\nTwo roles.\n")
+
+def split(data: bytes, read_size: int):
+    return list(iter_mbox(io.BytesIO(data), read_size))
+
+@pytest.mark.parametrize("read_size", [1, 3, 7, 64, 1 << 20])
+def test_split_matches_the_stdlib_at_any_read_size(tmp_path, read_size):
+    path = tmp_path / "box.mbox"
+    path.write_bytes(MBOX)
+    expected = [mailbox.mbox(str(path)).get_bytes(key) for key in mailbox.mbox(str(path)).iterkeys()]
+    assert split(MBOX, read_size) == expected
+    assert len(expected) == 3
+
+def test_crlf_mailboxes_drop_the_separator_blank_line():
+    data = MBOX.replace(b"\n", b"\r\n")
+    messages = split(data, 5)
+    assert messages[0] == b"Subject: Budget\r\n\r\nQ3 numbers.\r\n>From the archive, quoted.\r\n"
+    assert messages[2] == b"Subject: Hiring\r\n\r\nTwo roles.\r\n"
+
+def test_text_before_the_first_envelope_is_ignored():
+    splitter = MboxSplitter()
+    assert splitter.feed(b"garbage\n" + MBOX[:60]) == []
+    assert len(splitter.feed(MBOX[60:]) + splitter.close()) == 3
+    assert split(b"", 16) == []
+
+def test_expand_mbox_numbers_messages_and_skips_duplicates(tmp_path):
+    result = UploadResult(tmp_path, lambda sha256: None)
+    first_message = MBOX[:MBOX.index(b"From bob")]
+    expand_mbox(io.BytesIO(MBOX + b"\n" + first_message), "export.mbox", result)
+    assert result.uploaded_files == ["export_00001.eml", "export_00002.eml", "export_00003.eml"]
+    assert result.duplicates == [{"file": "export_00004.eml", "duplicate_of": "export_00001.eml"}]
+    assert (tmp_path / "export_00003.eml").read_bytes() == b"Subject: Hiring\n\nTwo roles.\n"
+
+def test_zip_members_are_flattened_deduplicated_and_filtered(tmp_path):
+    archive_path = tmp_path / "export.zip"
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        archive.writestr("inbox/2024/note.eml", b"Subject: One\n\nFirst.\n")
+        archive.writestr("sent/note.eml", b"Subject: Two\n\nSecond.\n")
+        archive.writestr("copy/note.EML", b"Subject: One\n\nFirst.\n")
+        archive.writestr("folder/", b"")
+        archive.writestr("readme.txt", b"not an email")
+        archive.writestr("nested/old.mbox", MBOX)
+    dest = tmp_path / "emails"
+    dest.mkdir()
+    result = UploadResult(dest, lambda sha256: None)
+    expand_archive(archive_path, "export.zip", result)
+
+    assert result.uploaded_files == ["note.eml", "note (1).eml", "old_00001.eml", "old_00002.eml", "old_00003.eml"]
+    assert result.duplicates == [{"file": "note.EML", "duplicate_of": "note.eml"}]
+    assert result.skipped == ["readme.txt"]
+    assert sorted(path.name for path in dest.iterdir()) == sorted(result.uploaded_files)  # No temporary files left
+
+def test_files_already_stored_are_duplicates(tmp_path):
+    existing = tmp_path / "stored.eml"
+    result = UploadResult(tmp_path, lambda sha256: str(existing))
+    assert store_message(b"Subject: One\n\nFirst.\n", "new.eml", result) is None
+    assert result.duplicates == [{"file": "new.eml", "duplicate_of": "stored.eml"}]
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,75 @@
+from termcolor import colored
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CHARS_PER_TOKEN = 4  # Rough average for English text when tiktoken is unavailable
+
+_encodings = {}
+
+def _get_encoding(model: str):
+    """Return a cached tiktoken encoding for the model, or None if tiktoken is unavailable"""
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(colored(f"Warning: could not load tokenizer for {model}: {str(e)}", "yellow"))
+            _encodings[model] = None
+    return _encodings[model]
+
+def estimate_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Count tokens with tiktoken when installed, otherwise estimate from the character count"""
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def pack_by_tokens(items: list, token_fn, token_budget: int, max_items: int = None) -> list:
+    """Greedily group consecutive items into packs whose total token count stays within the budget"""
+    packs = []
+    current = []
+    current_tokens = 0
+    for item in items:
+        tokens = token_fn(item)
+        if current and (current_tokens + tokens > token_budget or (max_items and len(current) >= max_items)):
+            packs.append(current)
+            current = []
+            current_tokens = 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-4o") -> str:
+    """Cut text down to at most max_tokens tokens"""
+    if estimate_tokens(text, model) <= max_tokens:
+        return text
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    return text[:max_tokens * CHARS_PER_TOKEN]
+
+def split_by_tokens(text: str, max_tokens: int, model: str = "gpt-4o") -> list:
+    """Split text into consecutive chunks of about max_tokens tokens, on paragraph boundaries where possible"""
+    pieces = []
+    for paragraph in text.split("\n\n"):
+        if estimate_tokens(paragraph, model) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        # A paragraph longer than a chunk is cut at token boundaries
+        while paragraph:
+            piece = truncate_to_tokens(paragraph, max_tokens, model)
+            pieces.append(piece)
+            paragraph = paragraph[len(piece):]
+    packs = pack_by_tokens([piece for piece in pieces if piece.strip()],
+                           lambda piece: estimate_tokens(piece, model), max_tokens)
+    return ["\n\n".join(pack) for pack in packs]
@@ -0,0 +1,203 @@
+import os
+import uuid
+import hashlib
+import mailbox
+import zipfile
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+import aiofiles
+from termcolor import colored
+from email_parser import SUPPORTED_FORMATS
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes read from the request per chunk
+ARCHIVE_FORMATS = {'.zip', '.mbox'}  # Expanded server-side into individual emails
+MBOX_SEPARATOR = b"\nFrom "  # Every line starting with "From " begins a new message, as in mailbox.mbox
+
+def temp_upload_path(dest_dir: Path) -> Path:
+    """Return a hidden temporary path in dest_dir so the final rename stays on one filesystem"""
+    return dest_dir / f".upload-{uuid.uuid4().hex}.part"
+
+def unique_path(dest_dir: Path, filename: str) -> Path:
+    """Return dest_dir/filename, adding a counter suffix if that name is already taken"""
+    filename = Path(filename).name
+    path = dest_dir / filename
+    counter = 1
+    while path.exists():
+        path = dest_dir / f"{Path(filename).stem} ({counter}){Path(filename).suffix}"
+        counter += 1
+    return path
+
+async def stream_upload_to_disk(upload, dest_dir: Path) -> Tuple[Path, str, int]:
+    """Write an UploadFile to a temporary file in fixed-size chunks, returning (path, sha256, size)"""
+    temp_path = temp_upload_path(dest_dir)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, 'wb') as f:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                await f.write(chunk)
+        return temp_path, digest.hexdigest(), size
+    except Exception:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+def _write_bytes_to_disk(data: bytes, dest_dir: Path) -> Tuple[Path, str]:
+    """Write bytes to a temporary file, returning (path, sha256)"""
+    temp_path = temp_upload_path(dest_dir)
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    return temp_path, hashlib.sha256(data).hexdigest()
+
+def _copy_stream_to_disk(source, dest_dir: Path) -> Tuple[Path, str]:
+    """Copy a binary file object to a temporary file in chunks, returning (path, sha256)"""
+    temp_path = temp_upload_path(dest_dir)
+    digest = hashlib.sha256()
+    with open(temp_path, 'wb') as f:
+        for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return temp_path, digest.hexdigest()
+
+class UploadResult:
+    """Collects stored files, duplicates and skipped entries for one upload request"""
+
+    def __init__(self, dest_dir: Path, find_duplicate: Callable[[str], Optional[str]]):
+        self.dest_dir = dest_dir
+        self.find_duplicate = find_duplicate
+        self.uploaded_files: List[str] = []
+        self.duplicates: List[dict] = []
+        self.skipped: List[str] = []
+        self._seen = {}  # sha256 -> filename stored during this request
+
+    def commit(self, temp_path: Path, sha256: str, filename: str) -> Optional[Path]:
+        """Move a hashed temporary file into place unless its content is already stored"""
+        existing = self._seen.get(sha256) or self.find_duplicate(sha256)
+        if existing:
+            temp_path.unlink(missing_ok=True)
+            self.duplicates.append({"file": filename, "duplicate_of": Path(existing).name})
+            print(colored(f"Skipping {filename} - duplicate of {Path(existing).name}", "yellow"))
+            return None
+
+        final_path = unique_path(self.dest_dir, filename)
+        os.replace(temp_path, final_path)
+        self._seen[sha256] = final_path.name
+        self.uploaded_files.append(final_path.name)
+        print(colored(f"Successfully uploaded: {final_path.name}", "green"))
+        return final_path
+
+    def to_dict(self) -> dict:
+        return {
+            "uploaded_files": self.uploaded_files,
+            "duplicates": self.duplicates,
+            "skipped": self.skipped
+        }
+
+def expand_zip(archive_path: Path, result: UploadResult):
+    """Extract supported emails (and nested mbox files) from a ZIP archive one member at a time"""
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.infolist():
+            if member.is_dir():
+                continue
+            name = Path(member.filename).name
+            extension = Path(name).suffix.lower()
+            if extension not in SUPPORTED_FORMATS and extension != '.mbox':
+                result.skipped.append(member.filename)
+                continue
+
+            with archive.open(member) as source:
+                if extension == '.mbox':
+                    expand_mbox(source, name, result)
+                    continue
+                temp_path, sha256 = _copy_stream_to_disk(source, result.dest_dir)
+            result.commit(temp_path, sha256, name)
+
+class MboxSplitter:
+    """Splits an mbox byte stream into messages as it is fed, holding at most one message in memory"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 1  # Buffer offset the separator search resumes from; 1 skips the current "From " line
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Add data, returning the messages it completed"""
+        self._buffer += data
+        messages = []
+        while True:
+            separator = self._buffer.find(MBOX_SEPARATOR, self._scanned)
+            if separator < 0:
+                # A separator may be cut off at the end of the chunk
+                self._scanned = max(1, len(self._buffer) - len(MBOX_SEPARATOR) + 1)
+                return messages
+            message = self._message(self._buffer[:separator + 1])
+            del self._buffer[:separator + 1]
+            self._scanned = 1
+            if message is not None:
+                messages.append(message)
+
+    def close(self) -> List[bytes]:
+        """Return the last message once the stream has ended"""
+        message = self._message(self._buffer)
+        self._buffer = bytearray()
+        return [message] if message is not None else []
+
+    @staticmethod
+    def _message(data: bytearray) -> Optional[bytes]:
+        # Drop the "From " envelope line; anything before the first one is not a message
+        if not data.startswith(b"From "):
+            return None
+        start = data.find(b"\n")
+        if start < 0:
+            return b""
+        end = len(data)
+        # The blank line written before the next "From " line is part of the separator
+        for separator in (b"\r\n", b"\n"):
+            if data.endswith(separator * 2):
+                end -= len(separator)
+                break
+        return bytes(data[start + 1:end])
+
+def iter_mbox(source, read_size: int = UPLOAD_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield the messages of an mbox file object in one pass, reading read_size bytes at a time"""
+    splitter = MboxSplitter()
+    for chunk in iter(lambda: source.read(read_size), b''):
+        yield from splitter.feed(chunk)
+    yield from splitter.close()
+
+def iter_maildir(maildir_path: Path) -> Iterator[bytes]:
+    """Yield the messages of a Maildir (new and cur) one at a time"""
+    box = mailbox.Maildir(str(maildir_path), factory=None, create=False)
+    for key in box.iterkeys():
+        yield box.get_bytes(key)
+
+def is_maildir(path: Path) -> bool:
+    return path.is_dir() and all((path / folder).is_dir() for folder in ("cur", "new", "tmp"))
+
+def store_message(data: bytes, filename: str, result: UploadResult) -> Optional[Path]:
+    """Store one raw message from a mailbox as an .eml file, unless its content is already stored"""
+    temp_path, sha256 = _write_bytes_to_disk(data, result.dest_dir)
+    return result.commit(temp_path, sha256, filename)
+
+def mailbox_message_name(mailbox_name: str, number: int) -> str:
+    return f"{Path(mailbox_name).stem}_{number:05d}.eml"
+
+def expand_mbox(source, archive_name: str, result: UploadResult):
+    """Split an mbox file object into individual .eml files in one streaming pass"""
+    for number, message in enumerate(iter_mbox(source), start=1):
+        store_message(message, mailbox_message_name(archive_name, number), result)
+
+def expand_archive(archive_path: Path, archive_name: str, result: UploadResult):
+    """Expand a ZIP or mbox archive into uploaded emails"""
+    extension = Path(archive_name).suffix.lower()
+    print(colored(f"Expanding archive {archive_name}...", "blue"))
+    if extension == '.zip':
+        expand_zip(archive_path, result)
+    elif extension == '.mbox':
+        with open(archive_path, 'rb') as source:
+            expand_mbox(source, archive_name, result)
+    else:
+        raise ValueError(f"Unsupported archive format: {extension}")